@@ -1,3 +1,7 @@
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import multiprocessing
 import os
 import re
 import tempfile
@@ -6,16 +10,28 @@ import zipfile
 # Not using LayerMapping as want more control, but what it does is what this does
 # from django.contrib.gis.utils import LayerMapping
 
+import django
 from django.conf import settings
-from django.contrib.gis.gdal import DataSource
+from django.contrib.gis.gdal import DataSource, OGRGeometry
+from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.gis.db.models import Collect
-from mapit.models import Area, Country, Generation
+from django.db import transaction
+from mapit.models import Area, AreaRelationBuild, Country, Generation, GeometrySimplified
 from mapit.management.command_utils import (
     save_polygons,
     fix_invalid_geos_geometry,
 )
 
 
+# How many areas' polygons to write to the database at once
+SAVE_BATCH_SIZE = 500
+
+# How many features to read and prepare ahead of writing them, and how many
+# of those to send to a worker process at once when using more than one job
+PREPARE_BATCH_SIZE = 1000
+PREPARE_CHUNK_SIZE = 20
+
+
 class Parameters:
     def __init__(
         self,
@@ -36,6 +52,8 @@ class Parameters:
         encoding,
         fix_invalid_polygons,
         ignore_blank,
+        simplify_levels=(),
+        jobs=1,
     ):
         self.commit = commit
         self.generation = generation
@@ -56,6 +74,8 @@ class Parameters:
         self.encoding = encoding
         self.fix_invalid_polygons = fix_invalid_polygons
         self.ignore_blank = ignore_blank
+        self.simplify_levels = simplify_levels or ()
+        self.jobs = jobs
 
     def validate(self):
         """Returns an error message as a string if the parameters are invalid.
@@ -100,6 +120,10 @@ class Parameters:
                 " 'code field' or 'override code'."
             )
             return error
+        if any(level <= 0 for level in self.simplify_levels):
+            return "Simplify levels must be greater than zero."
+        if self.jobs < 1:
+            return "Jobs must be at least one."
         if self.country and self.country_from_first_letter_of_code:
             error = (
                 "You have specified a country and also selected"
@@ -120,59 +144,9 @@ class Error(Exception):
     pass
 
 
-def run(filename, parameters, logger=None):
-    if zipfile.is_zipfile(filename):
-        if logger:
-            logger.info("Unzipping %s" % filename)
-
-        zipped = zipfile.ZipFile(filename)
-        shp_files = [f for f in zipped.namelist() if f.endswith(".shp")]
-        if len(shp_files) == 0:
-            raise Error("No .shp file found in the zip file.")
-
-        highest_level = min([f.count(os.sep) for f in shp_files])
-        root_shp_files = [
-            f for f in shp_files if f.count(os.sep) == highest_level
-        ]
-        if len(root_shp_files) > 1:
-            raise Error(
-                "Expected to find a single root .shp file, found %s"
-                % root_shp_files
-            )
-        root_shp_file = root_shp_files[0]
-        if logger:
-            logger.info("Found %s " % root_shp_file)
-
-        tmp_dir = tempfile.TemporaryDirectory()
-        zipped.extractall(tmp_dir.name)
-        filename = tmp_dir.name + os.sep + root_shp_file
-
-    if logger:
-        logger.info("Importing from %s" % filename)
-
-    if not parameters.commit and logger:
-        logger.info("(will not save to db as 'commit' not specified)")
-
-    current_generation = Generation.objects.current()
-    new_generation = parameters.generation
-
-    ds = DataSource(filename)
-    layer = ds[0]
-
-    if (
-        (parameters.override_name or parameters.override_code)
-        and len(layer) > 1
-        and logger
-    ):
-        message = (
-            "You have specified an override %s and this file contains more than"
-            " one feature; multiple areas with the same %s will be created"
-        )
-        if parameters.override_name:
-            logger.warning(message % ("name", "name"))
-        if parameters.override_code:
-            logger.warning(message % ("code", "code"))
-
+def read_features(layer, parameters):
+    """Generate (name, code, geometry WKB, spatial reference WKT) for each
+    feature of the layer to be imported, in order."""
     for feat in layer:
         if parameters.override_name:
             name = parameters.override_name
@@ -222,168 +196,325 @@ def run(filename, parameters, logger=None):
                     % (parameters.code_field, choices)
                 )
 
+        wkb = srs = None
+        if hasattr(feat, "geom"):
+            geom = feat.geom
+            wkb = bytes(geom.wkb)
+            srs = geom.srs.wkt if geom.srs else None
+        yield name, code, wkb, srs
+
+
+PreparedGeometry = collections.namedtuple(
+    "PreparedGeometry", ["geometry", "simplified", "valid", "fixed"]
+)
+
+
+def prepare_geometry(task):
+    """Do the CPU-heavy work on one feature's geometry: transform it to the
+    area SRID, normalise it for comparison with any previous geometry if
+    preserving areas, and check (and try to fix) its validity if asked.
+    task is a tuple (WKB, spatial reference WKT, preserve, fix invalid), and
+    the geometries returned are WKB. This is run in worker processes when
+    importing with more than one job."""
+    wkb, srs, preserve, fix_invalid_polygons = task
+    if wkb is None:
+        return PreparedGeometry(None, None, True, None)
+    g = OGRGeometry(wkb, srs=srs)
+    g.transform(settings.MAPIT_AREA_SRID)
+    geos_g = g.geos
+    simplified = bytes(geos_g.simplify(tolerance=0).wkb) if preserve else None
+    valid = True
+    fixed = None
+    if fix_invalid_polygons:
+        valid = geos_g.valid
+        if not valid:
+            fixed = fix_invalid_geos_geometry(geos_g)
+            if fixed is not None:
+                fixed = bytes(fixed.wkb)
+    return PreparedGeometry(bytes(g.wkb), simplified, valid, fixed)
+
+
+def run(filename, parameters, logger=None):
+    if zipfile.is_zipfile(filename):
         if logger:
-            logger.info(
-                "  looking at '%s'%s" % (name, " (%s)" % code if code else "")
+            logger.info("Unzipping %s" % filename)
+
+        zipped = zipfile.ZipFile(filename)
+        shp_files = [f for f in zipped.namelist() if f.endswith(".shp")]
+        if len(shp_files) == 0:
+            raise Error("No .shp file found in the zip file.")
+
+        highest_level = min([f.count(os.sep) for f in shp_files])
+        root_shp_files = [
+            f for f in shp_files if f.count(os.sep) == highest_level
+        ]
+        if len(root_shp_files) > 1:
+            raise Error(
+                "Expected to find a single root .shp file, found %s"
+                % root_shp_files
             )
+        root_shp_file = root_shp_files[0]
+        if logger:
+            logger.info("Found %s " % root_shp_file)
 
-        if parameters.country_from_first_letter_of_code and code:
-            try:
-                country = Country.objects.get(code=code[0])
-            except Country.DoesNotExist:
-                logger.warning("    No country found from first-letter")
-                country = None
-        else:
-            country = parameters.country
+        tmp_dir = tempfile.TemporaryDirectory()
+        zipped.extractall(tmp_dir.name)
+        filename = tmp_dir.name + os.sep + root_shp_file
 
-        g = None
-        if hasattr(feat, "geom"):
-            g = feat.geom.transform(settings.MAPIT_AREA_SRID, clone=True)
+    if logger:
+        logger.info("Importing from %s" % filename)
 
-        try:
-            if parameters.new:  # Always want a new area
-                raise Area.DoesNotExist
-            filters = {"type": parameters.area_type}
-            if code:
-                matching_message = "code %s of code type %s, and area type %s" % (
-                    code,
-                    parameters.code_type,
-                    parameters.area_type,
-                )
-                filters["codes__code"] = code
-                filters["codes__type"] = parameters.code_type
-            else:
-                matching_message = "name %s of area type %s" % (
-                    name,
-                    parameters.area_type,
-                )
-                filters["name"] = name
-            areas = Area.objects.filter(**filters).order_by("-generation_high")
+    if not parameters.commit and logger:
+        logger.info("(will not save to db as 'commit' not specified)")
+
+    current_generation = Generation.objects.current()
+    new_generation = parameters.generation
+
+    ds = DataSource(filename)
+    layer = ds[0]
+
+    if (
+        (parameters.override_name or parameters.override_code)
+        and len(layer) > 1
+        and logger
+    ):
+        message = (
+            "You have specified an override %s and this file contains more than"
+            " one feature; multiple areas with the same %s will be created"
+        )
+        if parameters.override_name:
+            logger.warning(message % ("name", "name"))
+        if parameters.override_code:
+            logger.warning(message % ("code", "code"))
+
+    # Polygons are saved a batch of areas at a time
+    pending = {}
+
+    def save_pending():
+        save_polygons(pending, write_to_stdout=False, refresh_relations=False)
+        pending.clear()
+
+    features = read_features(layer, parameters)
+    executor = None
+    if parameters.jobs > 1:
+        # Spawn rather than fork, so that the workers don't share our
+        # database connection; each sets up Django for itself.
+        executor = ProcessPoolExecutor(
+            max_workers=parameters.jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup,
+        )
 
-            if len(areas) == 0:
-                if logger:
-                    logger.debug(
-                        "    the area was not found - creating a new one"
+    # Areas are written along with their polygons, or not at all, so that an
+    # import that fails part way leaves no areas without polygons
+    with transaction.atomic():
+        try:
+            while True:
+                batch = list(itertools.islice(features, PREPARE_BATCH_SIZE))
+                if not batch:
+                    break
+                tasks = [
+                    (wkb, srs, parameters.preserve, parameters.fix_invalid_polygons)
+                    for name, code, wkb, srs in batch
+                ]
+                if executor:
+                    geometries = executor.map(
+                        prepare_geometry, tasks, chunksize=PREPARE_CHUNK_SIZE
                     )
-                raise Area.DoesNotExist
-
-            m = areas[0]
-            if logger:
-                logger.debug(f"    found the area {m}")
-            if parameters.preserve:
-                # Find whether we need to create a new Area:
-                previous_geos_geometry = m.polygons.aggregate(
-                    Collect("polygon")
-                )["polygon__collect"]
-                if m.generation_high < current_generation.id:
-                    # Then it was missing in current_generation:
+                else:
+                    geometries = map(prepare_geometry, tasks)
+
+                # Everything is written to the database here, in file order
+                for (name, code, wkb, srs), prepared in zip(batch, geometries):
                     if logger:
-                        logger.debug(
-                            "    area existed previously, but was missing from",
-                            current_generation,
+                        logger.info(
+                            "  looking at '%s'%s" % (name, " (%s)" % code if code else "")
                         )
-                    raise Area.DoesNotExist
-                elif g is None:
-                    if previous_geos_geometry is not None:
-                        if logger:
-                            logger.debug("    area is now empty")
-                        raise Area.DoesNotExist
+
+                    if parameters.country_from_first_letter_of_code and code:
+                        try:
+                            country = Country.objects.get(code=code[0])
+                        except Country.DoesNotExist:
+                            logger.warning("    No country found from first-letter")
+                            country = None
                     else:
+                        country = parameters.country
+
+                    g = None
+                    if prepared.geometry is not None:
+                        g = OGRGeometry(prepared.geometry, srs=settings.MAPIT_AREA_SRID)
+
+                    try:
+                        if parameters.new:  # Always want a new area
+                            raise Area.DoesNotExist
+                        filters = {"type": parameters.area_type}
+                        if code:
+                            matching_message = "code %s of code type %s, and area type %s" % (
+                                code,
+                                parameters.code_type,
+                                parameters.area_type,
+                            )
+                            filters["codes__code"] = code
+                            filters["codes__type"] = parameters.code_type
+                        else:
+                            matching_message = "name %s of area type %s" % (
+                                name,
+                                parameters.area_type,
+                            )
+                            filters["name"] = name
+                        areas = Area.objects.filter(**filters).order_by("-generation_high")
+
+                        if len(areas) == 0:
+                            if logger:
+                                logger.debug(
+                                    "    the area was not found - creating a new one"
+                                )
+                            raise Area.DoesNotExist
+
+                        m = areas[0]
                         if logger:
-                            logger.debug("    the area has remained empty")
-                elif previous_geos_geometry is None:
-                    # It was empty in the previous generation:
-                    if logger:
-                        logger.debug(
-                            "    area was empty in", current_generation
+                            logger.debug(f"    found the area {m}")
+                        if m.id in pending:
+                            # Seen earlier in this file, so its polygons are needed now
+                            save_pending()
+                        if parameters.preserve:
+                            # Find whether we need to create a new Area:
+                            previous_geos_geometry = m.polygons.aggregate(
+                                Collect("polygon")
+                            )["polygon__collect"]
+                            if m.generation_high < current_generation.id:
+                                # Then it was missing in current_generation:
+                                if logger:
+                                    logger.debug(
+                                        "    area existed previously, but was missing from",
+                                        current_generation,
+                                    )
+                                raise Area.DoesNotExist
+                            elif g is None:
+                                if previous_geos_geometry is not None:
+                                    if logger:
+                                        logger.debug("    area is now empty")
+                                    raise Area.DoesNotExist
+                                else:
+                                    if logger:
+                                        logger.debug("    the area has remained empty")
+                            elif previous_geos_geometry is None:
+                                # It was empty in the previous generation:
+                                if logger:
+                                    logger.debug(
+                                        "    area was empty in", current_generation
+                                    )
+                                raise Area.DoesNotExist
+                            else:
+                                # Otherwise, create a new Area unless the
+                                # polygons were the same in current_generation:
+                                previous_geos_geometry = previous_geos_geometry.simplify(
+                                    tolerance=0
+                                )
+                                new_geos_geometry = GEOSGeometry(
+                                    prepared.simplified, srid=settings.MAPIT_AREA_SRID
+                                )
+                                create_new_area = not previous_geos_geometry.equals(
+                                    new_geos_geometry
+                                )
+                                p = (
+                                    previous_geos_geometry.sym_difference(
+                                        new_geos_geometry
+                                    ).area
+                                    / previous_geos_geometry.area
+                                )
+                                if logger:
+                                    logger.debug(
+                                        "    change in area is: %.03f%%" % (100 * p,)
+                                    )
+                                if create_new_area:
+                                    if logger:
+                                        logger.debug(
+                                            "    the area "
+                                            + str(m)
+                                            + "has changed, creating a new area due to"
+                                            " --preserve"
+                                        )
+                                    raise Area.DoesNotExist
+                                else:
+                                    if logger:
+                                        logger.debug("    the area remained the same")
+                        else:
+                            # If preserve is not specified, the code or the name must be unique:
+                            if len(areas) > 1:
+                                raise Error(
+                                    "There was more than one area with %s, and 'preserve'"
+                                    " was not specified" % (matching_message,)
+                                )
+
+                    except Area.DoesNotExist:
+                        m = Area(
+                            name=name,
+                            type=parameters.area_type,
+                            country=country,
+                            generation_low=new_generation,
+                            generation_high=new_generation,
                         )
-                    raise Area.DoesNotExist
-                else:
-                    # Otherwise, create a new Area unless the
-                    # polygons were the same in current_generation:
-                    previous_geos_geometry = previous_geos_geometry.simplify(
-                        tolerance=0
-                    )
-                    new_geos_geometry = g.geos.simplify(tolerance=0)
-                    create_new_area = not previous_geos_geometry.equals(
-                        new_geos_geometry
-                    )
-                    p = (
-                        previous_geos_geometry.sym_difference(
-                            new_geos_geometry
-                        ).area
-                        / previous_geos_geometry.area
-                    )
-                    if logger:
-                        logger.debug(
-                            "    change in area is: %.03f%%" % (100 * p,)
+                        if parameters.use_code_as_id and code:
+                            m.id = int(code)
+
+                    # check that we are not about to skip a generation
+                    if (
+                        m.generation_high
+                        and current_generation
+                        and m.generation_high.id < current_generation.id
+                    ):
+                        raise Error(
+                            "Area %s found, but not in current generation %s"
+                            % (m, current_generation)
                         )
-                    if create_new_area:
-                        if logger:
-                            logger.debug(
-                                "    the area "
-                                + str(m)
-                                + "has changed, creating a new area due to"
-                                " --preserve"
+                    m.generation_high = new_generation
+                    if parameters.fix_invalid_polygons and g is not None:
+                        if not prepared.valid:
+                            if prepared.fixed is None:
+                                if logger:
+                                    logger.info(
+                                        "The geometry for area %s was invalid and couldn't"
+                                        " be fixed" % name
+                                    )
+                                g = None
+                            else:
+                                g = OGRGeometry(prepared.fixed, srs=settings.MAPIT_AREA_SRID)
+
+                    poly = [g] if g is not None else []
+
+                    if parameters.commit:
+                        m.save()
+                        # It may now be in a generation whose relations are stored
+                        AreaRelationBuild.objects.invalidate(m)
+                        m.names.update_or_create(
+                            type=parameters.name_type, defaults={"name": name}
+                        )
+                        if code:
+                            m.codes.update_or_create(
+                                type=parameters.code_type, defaults={"code": code}
                             )
-                        raise Area.DoesNotExist
-                    else:
-                        if logger:
-                            logger.debug("    the area remained the same")
-            else:
-                # If preserve is not specified, the code or the name must be unique:
-                if len(areas) > 1:
-                    raise Error(
-                        "There was more than one area with %s, and 'preserve'"
-                        " was not specified" % (matching_message,)
-                    )
+                        pending[m.id] = (m, poly)
+                        if len(pending) >= SAVE_BATCH_SIZE:
+                            save_pending()
 
-        except Area.DoesNotExist:
-            m = Area(
-                name=name,
-                type=parameters.area_type,
-                country=country,
-                generation_low=new_generation,
-                generation_high=new_generation,
-            )
-            if parameters.use_code_as_id and code:
-                m.id = int(code)
-
-        # check that we are not about to skip a generation
-        if (
-            m.generation_high
-            and current_generation
-            and m.generation_high.id < current_generation.id
-        ):
-            raise Error(
-                "Area %s found, but not in current generation %s"
-                % (m, current_generation)
-            )
-        m.generation_high = new_generation
-        if parameters.fix_invalid_polygons and g is not None:
-            # Make a GEOS geometry only to check for validity:
-            geos_g = g.geos
-            if not geos_g.valid:
-                geos_g = fix_invalid_geos_geometry(geos_g)
-                if geos_g is None:
-                    if logger:
-                        logger.info(
-                            "The geometry for area %s was invalid and couldn't"
-                            " be fixed" % name
-                        )
-                    g = None
-                else:
-                    g = geos_g.ogr
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+        if pending:
+            save_pending()
 
-        poly = [g] if g is not None else []
+    if parameters.commit and parameters.simplify_levels:
+        if logger:
+            logger.info("Building simplified levels %s" % (parameters.simplify_levels,))
+        GeometrySimplified.objects.build(
+            Area.objects.filter(
+                type=parameters.area_type,
+                generation_low__lte=new_generation,
+                generation_high__gte=new_generation,
+            ),
+            parameters.simplify_levels,
+        )
 
-        if parameters.commit:
-            m.save()
-            m.names.update_or_create(
-                type=parameters.name_type, defaults={"name": name}
-            )
-            if code:
-                m.codes.update_or_create(
-                    type=parameters.code_type, defaults={"code": code}
-                )
-            save_polygons({m.id: (m, poly)}, write_to_stdout=False)
+    if parameters.commit:
+        AreaRelationBuild.objects.refresh()
@@ -1,7 +1,8 @@
 from django.contrib.gis import admin
 from django.utils.html import format_html
 
-from mapit.models import Area, Code, Name, Generation, Geometry, Postcode, Type, NameType, CodeType, Country
+from mapit.models import (
+    Area, Code, Name, Generation, Geometry, Postcode, PostcodeImport, Type, NameType, CodeType, Country)
 
 
 class NameInline(admin.TabularInline):
@@ -39,6 +40,10 @@ class PostcodeAdmin(admin.GISModelAdmin):
     raw_id_fields = ('areas',)
 
 
+class PostcodeImportAdmin(admin.ModelAdmin):
+    list_display = ('imported', 'source', 'created', 'updated', 'unchanged', 'terminated', 'restored')
+
+
 class TypeAdmin(admin.GISModelAdmin):
     pass
 
@@ -59,6 +64,7 @@ admin.site.register(Area, AreaAdmin)
 admin.site.register(Geometry, GeometryAdmin)
 admin.site.register(Generation, GenerationAdmin)
 admin.site.register(Postcode, PostcodeAdmin)
+admin.site.register(PostcodeImport, PostcodeImportAdmin)
 admin.site.register(Type, TypeAdmin)
 admin.site.register(CodeType, CodeTypeAdmin)
 admin.site.register(NameType, NameTypeAdmin)
@@ -0,0 +1,85 @@
+# A per-worker cache of the dictionaries output for areas, so that responses
+# listing many areas need not fetch their codes and countries, or build their
+# dictionaries, every time.
+#
+# Turn it on by setting AREA_CACHE_SIZE to the number of areas each worker
+# should remember. Saving or deleting an area, or anything output with one
+# (its names, codes, polygons, type or countries, or a generation), bumps a
+# version number stored in the Django cache, as do bulk updates of areas and
+# polygons; every worker empties its own cache when it next sees a different
+# version. This needs a cache shared between workers, such as memcached, to
+# work across processes. Changes made outside Django, in SQL, are not noticed.
+
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def version_key():
+    return 'mapit-area-version-%s' % settings.DATABASES['default']['NAME']
+
+
+class AreaCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = None
+
+    @property
+    def size(self):
+        return getattr(settings, 'MAPIT_AREA_CACHE_SIZE', 0)
+
+    def check(self):
+        """Fetch the shared version, emptying this worker's cache if it has
+        changed since last time, and return it. This should be called once
+        per request, before using get_many or set_many."""
+        version = cache.get(version_key(), 0)
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+        return version
+
+    def get_many(self, ids):
+        """Return a dict of the cached area dictionaries for those of the
+        given IDs that are present."""
+        out = {}
+        with self.lock:
+            for id in ids:
+                if id in self.entries:
+                    self.entries.move_to_end(id)
+                    out[id] = self.entries[id]
+        return out
+
+    def set_many(self, dicts, version):
+        """Store a dict of area ID to area dictionary, if the version they
+        were created under (as returned by check) is still current."""
+        size = self.size
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries.update(dicts)
+            for id in dicts:
+                self.entries.move_to_end(id)
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def bump(self):
+        """Mark every worker's cached area dictionaries as out of date."""
+        try:
+            cache.incr(version_key())
+        except ValueError:
+            cache.set(version_key(), 1, None)
+        with self.lock:
+            self.entries.clear()
+            self.version = None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.version = None
+
+
+area_cache = AreaCache()
@@ -0,0 +1,279 @@
+# Synthetic national-scale data, and timings of the busiest endpoints
+# against it, so that how MapIt scales can be measured and compared between
+# commits. Used by the mapit_benchmark_fixtures and mapit_benchmark commands,
+# which should be run against a database of their own.
+#
+# The fixtures are a hierarchy of areas (countries, councils, wards and
+# output areas) tiling a box the size of Great Britain, each level splitting
+# its parent into a grid. The boundaries between the smallest cells are
+# wiggly lines of a given number of vertices, shared by the areas on either
+# side of them at every level, so that areas touch and cover each other as
+# real ones do, and larger areas have more vertices. Postcodes are scattered
+# over the box at random.
+
+from collections import OrderedDict
+import datetime
+import itertools
+import math
+import os
+import random
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import override_settings
+
+from mapit.iterables import iterable_to_stream
+from mapit.models import Area, Generation, Geometry, Postcode, Type
+
+# The extent of the fixtures, in WGS84
+WEST, SOUTH, EAST, NORTH = -6.0, 50.0, 2.0, 56.0
+
+# Area types of each level of the hierarchy, from the top down
+LEVELS = (
+    ('BMCTY', 'Benchmark country'),
+    ('BMCOU', 'Benchmark council'),
+    ('BMWAR', 'Benchmark ward'),
+    ('BMOA', 'Benchmark output area'),
+)
+
+# Postcodes are of the form B?9[9] 9??, using second letters not used by any
+# real postcode area, so they are valid but never clash with real ones
+POSTCODE_AREAS = 'EFGKMOPUWY'
+POSTCODE_UNITS = 'ABDEFGHJLNPQRSTUWXYZ'
+POSTCODE_REGEX = r'^B[%s][0-9]' % POSTCODE_AREAS
+MAX_POSTCODES = len(POSTCODE_AREAS) * 99 * 10 * len(POSTCODE_UNITS) ** 2
+
+
+def postcode(n):
+    """Return the nth benchmark postcode."""
+    n, unit = divmod(n, len(POSTCODE_UNITS) ** 2)
+    n, sector = divmod(n, 10)
+    n, district = divmod(n, 99)
+    return 'B%s%d%d%s%s' % (
+        POSTCODE_AREAS[n], district + 1, sector,
+        POSTCODE_UNITS[unit // len(POSTCODE_UNITS)], POSTCODE_UNITS[unit % len(POSTCODE_UNITS)])
+
+
+class Grid(object):
+    """The grid of the smallest cells, whose edges (between grid nodes) are
+    wiggly lines of the given number of vertices, the same whichever cell
+    they are asked for by."""
+
+    def __init__(self, columns, rows, vertices, seed):
+        self.columns, self.rows = columns, rows
+        self.vertices = vertices
+        self.seed = seed
+        self.width = (EAST - WEST) / columns
+        self.height = (NORTH - SOUTH) / rows
+
+    def node(self, i, j):
+        return (WEST + i * self.width, SOUTH + j * self.height)
+
+    def edge(self, direction, i, j):
+        """The points of the edge from node (i, j) to the next node east (if
+        direction is 'h') or north (if 'v'), excluding the last. Each point
+        is offset from the straight line by less than its distance from
+        either end, so edges meeting at a node never cross."""
+        rng = random.Random('%s-%s-%d-%d' % (self.seed, direction, i, j))
+        x, y = self.node(i, j)
+        points = [(x, y)]
+        for n in range(1, self.vertices + 1):
+            t = n / (self.vertices + 1)
+            offset = 0.2 * math.sin(math.pi * t) ** 2 * rng.uniform(-1, 1)
+            if direction == 'h':
+                points.append((x + t * self.width, y + offset * self.height))
+            else:
+                points.append((x + offset * self.width, y + t * self.height))
+        return points
+
+    def polygon(self, i0, j0, i1, j1):
+        """The polygon of the cells from (i0, j0) up to (i1, j1)."""
+        ring = []
+        for i in range(i0, i1):
+            ring.extend(self.edge('h', i, j0))
+        for j in range(j0, j1):
+            ring.extend(self.edge('v', i1, j))
+        for i in reversed(range(i0, i1)):
+            ring.extend(reversed(self.edge('h', i, j1)[1:] + [self.node(i + 1, j1)]))
+        for j in reversed(range(j0, j1)):
+            ring.extend(reversed(self.edge('v', i0, j)[1:] + [self.node(i0, j + 1)]))
+        ring.append(ring[0])
+        return Polygon(ring, srid=4326)
+
+
+def fixture_counts():
+    """Return the number of benchmark areas of each type, and postcodes."""
+    counts = OrderedDict((code, Area.objects.filter(type__code=code).count()) for code, _ in LEVELS)
+    counts['postcodes'] = Postcode.objects.filter(postcode__regex=POSTCODE_REGEX).count()
+    return counts
+
+
+def fixtures_exist():
+    return Type.objects.filter(code__in=[code for code, _ in LEVELS]).exists() \
+        or Postcode.objects.filter(postcode__regex=POSTCODE_REGEX).exists()
+
+
+def delete_fixtures():
+    """Remove any benchmark areas, types and postcodes."""
+    with transaction.atomic():
+        Area.objects.filter(type__code__in=[code for code, _ in LEVELS]).delete()
+        Type.objects.filter(code__in=[code for code, _ in LEVELS]).delete()
+        Postcode.objects.filter(postcode__regex=POSTCODE_REGEX).delete()
+
+
+def create_fixtures(countries=4, councils=5, wards=4, output_areas=5, vertices=10, postcodes=1000000, seed=0,
+                    stdout=None):
+    """Create the benchmark areas and postcodes. The box is split into
+    countries columns, and each country, council and ward into a square grid
+    of councils, wards and output_areas on a side respectively."""
+    splits = (countries, councils, wards, output_areas)
+    grid = Grid(
+        countries * councils * wards * output_areas, councils * wards * output_areas, vertices, seed)
+    generation = Generation.objects.current() or Generation.objects.create(
+        active=True, description='Benchmark fixtures')
+
+    # Each level's cells, as (i0, j0, i1, j1, parent Area)
+    cells = [(0, 0, grid.columns, grid.rows, None)]
+    for level, ((code, description), split) in enumerate(zip(LEVELS, splits)):
+        area_type, _ = Type.objects.get_or_create(code=code, defaults={'description': description})
+        # Every cell of a level is the same size
+        i0, j0, i1, j1, _ = cells[0]
+        columns, rows = split, 1 if level == 0 else split
+        width, height = (i1 - i0) // columns, (j1 - j0) // rows
+        children = [
+            (i0 + column * width, j0 + row * height, parent)
+            for i0, j0, i1, j1, parent in cells
+            for column, row in itertools.product(range(columns), range(rows))]
+        areas = Area.objects.bulk_create([
+            Area(name='%s %d' % (description, n), type=area_type, parent_area=parent,
+                 generation_low=generation, generation_high=generation)
+            for n, (i, j, parent) in enumerate(children, 1)])
+        cells = [(i, j, i + width, j + height, area) for (i, j, _), area in zip(children, areas)]
+        polygons = []
+        for i0, j0, i1, j1, area in cells:
+            polygon = grid.polygon(i0, j0, i1, j1)
+            polygon.transform(settings.MAPIT_AREA_SRID)
+            polygons.append((area, [bytes(polygon.wkb)]))
+        Geometry.objects.replace(polygons)
+        if stdout:
+            stdout.write('%d %s areas' % (len(cells), code))
+
+    rng = random.Random(seed)
+    lines = ('%s\tSRID=4326;POINT(%f %f)\t\n' % (
+        postcode(n), rng.uniform(WEST, EAST), rng.uniform(SOUTH, NORTH))
+        for n in range(postcodes))
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.copy_expert(
+            'COPY mapit_postcode (postcode, location, source_hash) FROM STDIN',
+            iterable_to_stream(line.encode() for line in lines))
+        if settings.MAPIT_COUNTRY == 'GB':
+            Postcode.objects.filter(postcode__regex=POSTCODE_REGEX, easting__isnull=True).update_uk_grid()
+    if stdout:
+        stdout.write('%d postcodes' % postcodes)
+
+
+def endpoints(rng, postcodes):
+    """Return a dict of endpoint name to a function returning a random URL
+    for it, given the benchmark fixtures in the database."""
+    def ids(code):
+        return list(Area.objects.filter(type__code=code).order_by('id').values_list('id', flat=True))
+    councils, wards = ids(LEVELS[1][0]), ids(LEVELS[2][0])
+    return OrderedDict([
+        ('areas_by_point', lambda: '/point/4326/%f,%f' % (rng.uniform(WEST, EAST), rng.uniform(SOUTH, NORTH))),
+        ('postcode', lambda: '/postcode/%s' % postcode(rng.randrange(postcodes))),
+        ('area_intersect', lambda: '/area/%d/touches' % rng.choice(wards)),
+        ('areas_by_type', lambda: '/areas/%s' % LEVELS[2][0]),
+        ('area_polygon', lambda: '/area/%d.geojson' % rng.choice(councils)),
+    ])
+
+
+def percentile(values, p):
+    """The nearest-rank percentile of the sorted values."""
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def measure(urls, concurrency):
+    """Fetch the URLs, in the given number of threads, returning a list of
+    (seconds, status) for each, and the total time taken."""
+    results = []
+    lock = threading.Lock()
+    urls = iter(urls)
+
+    def worker():
+        client = Client()
+        try:
+            while True:
+                with lock:
+                    url = next(urls, None)
+                if url is None:
+                    break
+                start = time.perf_counter()
+                response = client.get(url)
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                seconds = time.perf_counter() - start
+                with lock:
+                    results.append((seconds, response.status_code))
+        finally:
+            if threading.current_thread() is not threading.main_thread():
+                connection.close()
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return results, time.perf_counter() - start
+
+
+def run(requests=100, concurrency=1, names=None, warmup=5, seed=0, cache=False):
+    """Time requests to each endpoint, returning a dict of the results."""
+    rng = random.Random(seed)
+    overrides = {'ALLOWED_HOSTS': ['*'], 'DEBUG': False, 'MAPIT_RATE_LIMIT': {}}
+    if not cache:
+        overrides['CACHES'] = {'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}
+
+    counts = fixture_counts()
+    out = OrderedDict()
+    with override_settings(**overrides):
+        for name, url in endpoints(rng, counts['postcodes']).items():
+            if names and name not in names:
+                continue
+            measure([url() for _ in range(warmup)], 1)
+            results, total = measure([url() for _ in range(requests)], concurrency)
+            latencies = sorted(seconds * 1000 for seconds, status in results)
+            out[name] = OrderedDict([
+                ('requests', len(results)),
+                ('errors', sum(1 for seconds, status in results if status != 200)),
+                ('concurrency', concurrency),
+                ('seconds', round(total, 3)),
+                ('throughput', round(len(results) / total, 2)),
+                ('mean_ms', round(sum(latencies) / len(latencies), 3)),
+                ('p50_ms', round(percentile(latencies, 50), 3)),
+                ('p90_ms', round(percentile(latencies, 90), 3)),
+                ('p99_ms', round(percentile(latencies, 99), 3)),
+                ('max_ms', round(latencies[-1], 3)),
+            ])
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return OrderedDict([
+        ('commit', commit),
+        ('time', datetime.datetime.now(datetime.timezone.utc).isoformat()),
+        ('seed', seed),
+        ('fixtures', counts),
+        ('endpoints', out),
+    ])
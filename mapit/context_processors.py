@@ -6,6 +6,7 @@ def country(request):
         'country': settings.MAPIT_COUNTRY,
         'area_srid_units': 'degrees' if settings.MAPIT_AREA_SRID == 4326 else 'metres',
         'within_maximum': getattr(settings, 'MAPIT_WITHIN_MAXIMUM', 0),
+        'batch_maximum': getattr(settings, 'MAPIT_BATCH_MAXIMUM', 10000),
         'postcodes_available': settings.POSTCODES_AVAILABLE,
         'partial_postcodes_available': settings.PARTIAL_POSTCODES_AVAILABLE,
     }
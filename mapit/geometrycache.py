@@ -0,0 +1,82 @@
+# An optional on-disk cache of the serialised polygons of areas, as output by
+# the area and areas polygon views (and Area.export).
+#
+# Turn it on by setting GEOMETRY_CACHE_DIR to a directory writable by the web
+# server. Collecting, transforming, simplifying and serialising the polygons
+# of a large area can take seconds, so the KML, GeoJSON or WKT geometry of an
+# area is stored gzipped, keyed by the area's geometries, the SRID, the
+# simplification tolerance and the format, and reused until the area's
+# geometries change. To keep the number of files down, tolerances are rounded
+# to two significant figures when the cache is on. Files are created as areas
+# are requested, or all at once with mapit_geometry_cache_warm.
+
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+
+
+class GeometryCache(object):
+
+    @property
+    def directory(self):
+        return getattr(settings, 'MAPIT_GEOMETRY_CACHE_DIR', None)
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def tolerance(self, simplify_tolerance):
+        """Round a simplification tolerance to two significant figures."""
+        if not simplify_tolerance:
+            return 0
+        return float('%.2g' % simplify_tolerance)
+
+    def path(self, area_id, geometry_ids, srid, simplify_tolerance, format):
+        key = '%s|%s|%r|%s' % (
+            ','.join(str(id) for id in sorted(geometry_ids)), srid, self.tolerance(simplify_tolerance), format)
+        return os.path.join(self.directory, str(area_id), '%s.gz' % hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, area_id, geometry_ids, srid, simplify_tolerance, format):
+        """Return the stored text for the geometry of an area made up of the
+        given Geometry IDs, or None if there is none."""
+        try:
+            with gzip.open(self.path(area_id, geometry_ids, srid, simplify_tolerance, format),
+                           'rt', encoding='utf-8') as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, area_id, geometry_ids, srid, simplify_tolerance, format, text):
+        self.store(self.path(area_id, geometry_ids, srid, simplify_tolerance, format), text)
+
+    def store(self, path, text):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file and rename, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as fp:
+                fp.write(text.encode('utf-8'))
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def invalidate(self, area_id):
+        """Remove everything stored for an area."""
+        if not self.enabled:
+            return
+        shutil.rmtree(os.path.join(self.directory, str(area_id)), ignore_errors=True)
+
+    def clear(self):
+        if not self.enabled or not os.path.isdir(self.directory):
+            return
+        for entry in os.listdir(self.directory):
+            shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+
+
+geometry_cache = GeometryCache()
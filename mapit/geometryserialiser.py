@@ -1,10 +1,18 @@
+import itertools
 import json
+import logging
 
 from django.conf import settings
 from django.contrib.gis.gdal import GDALException, SRSException
-from django.contrib.gis.db.models import Collect
+from django.contrib.gis.geos import MultiPolygon
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DatabaseError, connection, transaction
 from django.utils.html import escape
 
+from mapit.geometrycache import geometry_cache
+
+logger = logging.getLogger(__name__)
+
 
 class TransformError(Exception):
     pass
@@ -13,6 +21,9 @@ class TransformError(Exception):
 # serialise a list of Area objects into .kml .geojson format
 # .wkt is supported only for a list of length 1
 class GeometrySerialiser(object):
+    # how many areas' polygons to fetch from the database at once
+    batch_size = 100
+
     kml_header =\
         """<?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
@@ -40,8 +51,8 @@ class GeometrySerialiser(object):
 
     def __init__(self, areas, srid, simplify_tolerance):
         # the geojson serialization format needs to know if we're
-        # serializer one item, or a list with one item
-        if not isinstance(areas, list):
+        # serializer one item, or a list (or other iterable) with one item
+        if not hasattr(areas, '__iter__'):
             self.single = True
             areas = [areas]
         else:
@@ -49,18 +60,15 @@ class GeometrySerialiser(object):
 
         self.areas = areas
         self.srid = srid
+        if geometry_cache.enabled:
+            simplify_tolerance = geometry_cache.tolerance(simplify_tolerance)
         self.simplify_tolerance = simplify_tolerance
 
-    # collect all polygons that make up an area
-    def __collect_polygons(self, area):
-        all_polygons = area.polygons.all()
-        if len(all_polygons) > 1:
-            all_polygons = all_polygons.aggregate(Collect('polygon'))['polygon__collect']
-        elif len(all_polygons) == 1:
-            all_polygons = all_polygons[0].polygon
-        else:
-            return None
-        return all_polygons
+    # collect the polygons that make up an area into one geometry
+    def __collect_polygons(self, polygons):
+        if len(polygons) > 1:
+            return MultiPolygon(polygons, srid=polygons[0].srid)
+        return polygons[0]
 
     # transform to a different co-ordinate system
     def __transform(self, polygons):
@@ -81,68 +89,276 @@ class GeometrySerialiser(object):
                     name, self.simplify_tolerance))
         return polygons
 
-    # apply pre-processing to self.areas before serialisation
-    def __process_polygons(self):
-        processed_areas = []
-        for area in self.areas:
-            polygons = self.__collect_polygons(area)
-            if polygons:
-                polygons = self.__transform(polygons)
-                polygons = self.__simplify(polygons, area.name)
-                processed_areas.append((polygons, area))
-        if len(processed_areas) == 0:
+    # fetch the polygons of the given areas, as a dict of area ID to the
+    # list of that area's polygons
+    def _fetch_polygons(self, area_ids, format):
+        from mapit.models import Geometry
+
+        polygons = {}
+        geometries = Geometry.objects.filter(area__in=area_ids).order_by('area_id', 'id')
+        for area_id, polygon in geometries.values_list('area_id', 'polygon'):
+            polygons.setdefault(area_id, []).append(polygon)
+        return polygons
+
+    # collect, transform, simplify and serialise the polygons of one area,
+    # as returned by _fetch_polygons
+    def _serialise_polygons(self, area, polygons, format):
+        polygons = self.__collect_polygons(polygons)
+        polygons = self.__transform(polygons)
+        polygons = self.__simplify(polygons, area.name)
+        return self.__serialise_geometry(polygons, format)
+
+    def __serialise_geometry(self, geometry, format):
+        if format == 'kml':
+            return geometry.ogr.kml
+        elif format == 'geojson':
+            return geometry.ogr.json
+        return geometry.wkt
+
+    # fetch any simplified polygons stored at import time for the given
+    # areas, at the level nearest the requested tolerance. These are only
+    # stored in SRID 4326.
+    def _fetch_simplified(self, area_ids):
+        from mapit.models import GeometrySimplified
+
+        if self.srid != 4326 or not self.simplify_tolerance:
+            return {}
+        simplified = GeometrySimplified.objects.nearest(area_ids, self.simplify_tolerance)
+        for area_id, geometry in simplified.items():
+            # Output an area of one polygon as a Polygon, as it would be unsimplified
+            if len(geometry) == 1:
+                simplified[area_id] = geometry[0]
+        return simplified
+
+    # generate (serialised polygons, area) for each area that has polygons,
+    # fetching the polygons of batch_size areas at a time. Once something
+    # has been generated, the response has started, so any area that then
+    # fails to transform or simplify is logged and left out rather than
+    # raising (as the API documentation says). If fetching a whole batch
+    # fails, its areas are fetched one at a time, so that only those that
+    # fail are left out.
+    def __serialise_areas(self, areas, format):
+        from mapit.models import Geometry
+
+        started = False
+        areas = iter(areas)
+        while True:
+            batch = list(itertools.islice(areas, self.batch_size))
+            if not batch:
+                break
+
+            geometry_ids = {}
+            ids = Geometry.objects.filter(area__in=[area.id for area in batch]).order_by('area_id', 'id')
+            for area_id, id in ids.values_list('area_id', 'id'):
+                geometry_ids.setdefault(area_id, []).append(id)
+
+            texts = {}
+            if geometry_cache.enabled:
+                for area_id, ids in geometry_ids.items():
+                    text = geometry_cache.get(area_id, ids, self.srid, self.simplify_tolerance, format)
+                    if text is not None:
+                        texts[area_id] = text
+
+            missing = [area_id for area_id in geometry_ids if area_id not in texts]
+            simplified = self._fetch_simplified(missing) if missing else {}
+            missing = [area_id for area_id in missing if area_id not in simplified]
+            polygons, errors = self.__fetch_batch(missing, format)
+
+            for area in batch:
+                if area.id not in geometry_ids:
+                    continue
+                text = texts.get(area.id)
+                if text is None:
+                    try:
+                        if area.id in errors:
+                            raise errors[area.id]
+                        elif area.id in simplified:
+                            text = self.__serialise_geometry(simplified.pop(area.id), format)
+                        elif area.id not in polygons:
+                            continue
+                        else:
+                            text = self._serialise_polygons(area, polygons.pop(area.id), format)
+                    except TransformError as e:
+                        if not started:
+                            raise
+                        self.__omit(area, format, e)
+                        continue
+                    if geometry_cache.enabled:
+                        geometry_cache.set(
+                            area.id, geometry_ids[area.id], self.srid, self.simplify_tolerance, format, text)
+                started = True
+                yield text, area
+
+    # fetch the polygons of the given areas, returning them as
+    # _fetch_polygons does, and a dict of area ID to the TransformError
+    # raised for any area whose polygons could not be fetched
+    def __fetch_batch(self, area_ids, format):
+        if not area_ids:
+            return {}, {}
+        try:
+            return self._fetch_polygons(area_ids, format), {}
+        except TransformError as e:
+            if len(area_ids) == 1:
+                return {}, {area_ids[0]: e}
+        polygons, errors = {}, {}
+        for area_id in area_ids:
+            try:
+                polygons.update(self._fetch_polygons([area_id], format))
+            except TransformError as e:
+                errors[area_id] = e
+        return polygons, errors
+
+    def __omit(self, area, format, error):
+        logger.warning(
+            'Left %s (%d) out of %s output in SRID %s, simplify tolerance %s: %s',
+            area.name, area.id, format, self.srid, self.simplify_tolerance, error)
+
+    # as __serialise_areas for self.areas, but raise if there are no polygons
+    # at all, or the first area cannot be output
+    def __process_polygons(self, format):
+        processed_areas = self.__serialise_areas(self.areas, format)
+        first = next(processed_areas, None)
+        if first is None:
             raise TransformError("No polygons found")
-        else:
-            return processed_areas
+        return itertools.chain([first], processed_areas)
 
-    # output self.areas as kml
-    def kml(self, kml_type, line_colour="70ff0000", fill_colour="3dff5500"):
+    # the serialised polygons of one area, or None if it has none
+    def serialise_area(self, area, format):
+        for text, _ in self.__serialise_areas([area], format):
+            return text
+        return None
+
+    # output self.areas as kml, as an iterator of strings
+    def kml_stream(self, kml_type, line_colour="70ff0000", fill_colour="3dff5500"):
         content_type = 'application/vnd.google-earth.kml+xml'
-        processed_areas = self.__process_polygons()
+        processed_areas = self.__process_polygons('kml')
 
         if kml_type == "full":
-            output = self.kml_header % (line_colour, fill_colour)
-            for area in processed_areas:
-                output += self.kml_placemark % (escape(area[1].name), area[0].ogr.kml)
-            output += self.kml_footer
-            return (output, content_type)
+            def output():
+                yield self.kml_header % (line_colour, fill_colour)
+                for text, area in processed_areas:
+                    yield self.kml_placemark % (escape(area.name), text)
+                yield self.kml_footer
+            return (output(), content_type)
         elif kml_type == "polygon":
+            processed_areas = list(itertools.islice(processed_areas, 2))
             if len(processed_areas) == 1:
-                return (processed_areas[0][0].ogr.kml, content_type)
+                return (iter([processed_areas[0][0]]), content_type)
             else:
                 raise Exception("kml_type: '%s' not supported for multiple areas"
                                 % (kml_type,))
         else:
             raise Exception("Unknown kml_type: '%s'" % (kml_type,))
 
+    # output self.areas as kml
+    def kml(self, kml_type, line_colour="70ff0000", fill_colour="3dff5500"):
+        output, content_type = self.kml_stream(kml_type, line_colour, fill_colour)
+        return (''.join(output), content_type)
+
+    # output self.areas as geojson, as an iterator of strings
+    def geojson_stream(self):
+        content_type = 'application/json'
+        processed_areas = self.__process_polygons('geojson')
+        if self.single:
+            return (iter([next(processed_areas)[0]]), content_type)
+
+        def output():
+            yield '{"type": "FeatureCollection", "features": ['
+            for i, (text, area) in enumerate(processed_areas):
+                if i:
+                    yield ', '
+                yield self.area_as_geojson_feature(area, text)
+            yield ']}'
+        return (output(), content_type)
+
     # output self.areas as geojson
     def geojson(self):
-        content_type = 'application/json'
-        processed_areas = self.__process_polygons()
-        if len(processed_areas) == 1 and self.single:
-            return (processed_areas[0][0].ogr.json, content_type)
-        else:
-            output = {
-                'type': 'FeatureCollection',
-                'features': [
-                    self.area_as_geojson_feature(area[1], area[0])
-                    for area in processed_areas
-                ]
-            }
-            return (json.dumps(output), content_type)
-
-    def area_as_geojson_feature(self, area, polygons):
-        return {
-            'type': 'Feature',
-            'properties': area.as_dict(),
-            'geometry': json.loads(polygons.ogr.json),
-        }
+        output, content_type = self.geojson_stream()
+        return (''.join(output), content_type)
+
+    # a geojson Feature for an area, splicing in its already serialised geometry
+    def area_as_geojson_feature(self, area, geometry):
+        return '{"type": "Feature", "properties": %s, "geometry": %s}' % (
+            json.dumps(area.as_dict(), cls=DjangoJSONEncoder), geometry)
 
     # output self.areas as wkt
     def wkt(self):
         content_type = 'text/plain'
-        processed_areas = self.__process_polygons()
+        processed_areas = list(itertools.islice(self.__process_polygons('wkt'), 2))
         if len(processed_areas) == 1:
-            return (processed_areas[0][0].wkt, content_type)
+            return (processed_areas[0][0], content_type)
         else:
             raise Exception("wkt not supported for multiple areas")
+
+
+# A GeometrySerialiser that collects, transforms, simplifies and serialises
+# each batch of areas' polygons in one database query, so that only the
+# output text is fetched into Python. PostGIS always outputs KML in WGS84, so
+# KML in any other SRID is still done in Python.
+class DatabaseGeometrySerialiser(GeometrySerialiser):
+
+    def __in_database(self, format):
+        return format != 'kml' or self.srid == 4326
+
+    def _fetch_polygons(self, area_ids, format):
+        if not self.__in_database(format):
+            return super()._fetch_polygons(area_ids, format)
+
+        geometry = 'polygon'
+        params = []
+        if self.srid != settings.MAPIT_AREA_SRID:
+            geometry = 'ST_Transform(%s, %%s)' % geometry
+            params.append(self.srid)
+        if self.simplify_tolerance:
+            # The same (non topology-preserving) simplification as GEOS
+            geometry = 'ST_Simplify(%s, %%s)' % geometry
+            params.append(self.simplify_tolerance)
+        params.append(list(area_ids))
+
+        if format == 'kml':
+            output = 'ST_AsKML(geometry)'
+        elif format == 'geojson':
+            output = 'ST_AsGeoJSON(geometry, 15, 0)'
+        else:
+            output = 'ST_AsText(geometry)'
+
+        query = '''
+SELECT area_id, %s, geometry IS NULL OR ST_IsEmpty(geometry)
+FROM (
+    SELECT area_id, %s AS geometry
+    FROM (
+        SELECT area_id,
+            CASE WHEN count(*) = 1 THEN (array_agg(polygon))[1] ELSE ST_Collect(polygon ORDER BY id) END AS polygon
+        FROM mapit_geometry
+        WHERE area_id = ANY(%%s)
+        GROUP BY area_id
+    ) collected
+) processed
+''' % (output, geometry)
+
+        polygons = {}
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(query, params)
+                for area_id, text, empty in cursor:
+                    polygons[area_id] = (text, empty)
+        except DatabaseError as e:
+            raise TransformError("Error with transform: %s" % e)
+        return polygons
+
+    def _serialise_polygons(self, area, polygons, format):
+        if not self.__in_database(format):
+            return super()._serialise_polygons(area, polygons, format)
+        text, empty = polygons
+        if empty:
+            raise TransformError("Simplifying %s with tolerance %f left no boundary at all" % (
+                area.name, self.simplify_tolerance))
+        return text
+
+
+def get_serialiser(areas, srid, simplify_tolerance):
+    """Return a GeometrySerialiser for the given areas, of the class chosen
+    by the GEOMETRY_SERIALISER setting."""
+    if getattr(settings, 'MAPIT_GEOMETRY_SERIALISER', 'python') == 'database':
+        return DatabaseGeometrySerialiser(areas, srid, simplify_tolerance)
+    return GeometrySerialiser(areas, srid, simplify_tolerance)
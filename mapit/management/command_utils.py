@@ -1,5 +1,8 @@
 # Shared functions for postcode and area importing.
 
+import argparse
+import csv
+import io
 import re
 import sys
 from xml.sax.handler import ContentHandler
@@ -7,6 +10,9 @@ import shapely.ops
 import shapely.wkt
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
 
+from mapit.iterables import iterable_to_stream
+from mapit.models import Area, AreaRelationBuild, Geometry, GeometrySimplified
+
 
 class KML(ContentHandler):
     def __init__(self, *args, **kwargs):
@@ -34,16 +40,55 @@ class KML(ContentHandler):
             self.name = self.normalize_whitespace(attr['name'])
 
 
-def save_polygons(lookup, write_to_stdout=True):
+def simplify_levels(value):
+    """Parse a comma-separated list of simplification tolerances, for use as
+    an argparse type."""
+    try:
+        levels = [float(level) for level in value.split(',') if level.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a comma-separated list of numbers" % value)
+    if any(level <= 0 for level in levels):
+        raise argparse.ArgumentTypeError("Simplify levels must be greater than zero")
+    return levels
+
+
+def copy_rows(cursor, table, columns, rows, chunk_size=1000):
+    """Stream an iterable of tuples into the given columns of a table using
+    COPY, as CSV. None is written as NULL (as are empty strings)."""
+    def lines():
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        for i, row in enumerate(rows, 1):
+            writer.writerow(['' if value is None else value for value in row])
+            if i % chunk_size == 0:
+                yield buf.getvalue().encode('utf-8')
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue().encode('utf-8')
+
+    cursor.copy_expert('COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (table, ', '.join(columns)),
+                       iterable_to_stream(lines()))
+
+
+def save_polygons(lookup, write_to_stdout=True, simplify_levels=None, refresh_relations=True):
+    """lookup is a dict of (Area, list of OGR polygons) pairs; replace each
+    area's polygons with those given. If simplify_levels is a list of
+    tolerances, also store simplified polygons of those areas at each one.
+    Unless refresh_relations is False, then update any stored relations
+    between areas involving the changed ones. The polygons are all written
+    to the database together at the end."""
+    saved = []
+    polygons = []
     for shape in lookup.values():
         m, poly = shape
         if not poly:
             continue
+        saved.append(m.id)
         if write_to_stdout:
             sys.stdout.write(".")
             sys.stdout.flush()
         # g = OGRGeometry(OGRGeomType('MultiPolygon'))
-        m.polygons.all().delete()
+        wkbs = []
         for p in poly:
             if p.geom_name == 'POLYGON':
                 shapes = [p]
@@ -57,12 +102,18 @@ def save_polygons(lookup, write_to_stdout=True):
                     continue
                 # Make sure it is two-dimensional
                 g.coord_dim = 2
-                m.polygons.create(polygon=g.wkb)
+                wkbs.append(g.wkb)
+        polygons.append((m, wkbs))
         # m.polygon = g.wkt
         # m.save()
         # Clear the polygon's list, so that if it has both an ons_code and unit_id, it's not processed twice
         poly[:] = []
     print("")
+    Geometry.objects.replace(polygons)
+    if simplify_levels and saved:
+        GeometrySimplified.objects.build(Area.objects.filter(id__in=saved), simplify_levels)
+    if refresh_relations and saved:
+        AreaRelationBuild.objects.refresh()
 
 
 def fix_with_buffer(geos_polygon):
@@ -0,0 +1,44 @@
+# This script stores which areas touch, overlap, cover or are covered by each
+# other for one generation, so that those lookups do not need a spatial join.
+# Imports update the stored relations of the areas they change; use --refresh
+# to do the same after changing polygons some other way.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from mapit.models import AreaRelation, AreaRelationBuild, Generation
+
+
+class Command(BaseCommand):
+    help = 'Precompute the relations between areas for a generation'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--generation', action='store', type=int, dest='generation',
+            help='The generation to build (default the current one)')
+        parser.add_argument(
+            '--refresh', action='store_true',
+            help='Only update the relations of areas changed since the last build, in every generation')
+
+    def handle(self, **options):
+        if options['refresh']:
+            with transaction.atomic():
+                total = AreaRelationBuild.objects.refresh()
+            self.stdout.write("%d area relations stored" % total)
+            return
+
+        if options['generation']:
+            try:
+                generation = Generation.objects.get(id=options['generation'])
+            except Generation.DoesNotExist:
+                raise CommandError("Generation %d does not exist" % options['generation'])
+        else:
+            generation = Generation.objects.current()
+            if not generation:
+                raise CommandError("There is no current generation")
+
+        with transaction.atomic():
+            AreaRelationBuild.objects.filter(generation=generation).delete()
+            AreaRelation.objects.filter(generation=generation).delete()
+            total = AreaRelation.objects.build(generation.id)
+            AreaRelationBuild.objects.create(generation=generation)
+        self.stdout.write("%s - %d area relations stored" % (generation, total))
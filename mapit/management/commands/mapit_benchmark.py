@@ -0,0 +1,63 @@
+# This script times requests to the busiest endpoints against the data
+# created by mapit_benchmark_fixtures, and outputs the latency percentiles
+# and throughput of each as JSON, to be compared with a run at another commit.
+# Requests are made in this process, straight to the views, so what is timed
+# is MapIt and the database rather than any web server in front of them.
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mapit import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Time requests to the main endpoints against the benchmark data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Requests to time per endpoint (default 200)')
+        parser.add_argument(
+            '--concurrency', type=int, default=1, help='Number of threads making requests at once (default 1)')
+        parser.add_argument(
+            '--warmup', type=int, default=10, help='Untimed requests to make to each endpoint first (default 10)')
+        parser.add_argument(
+            '--endpoints', nargs='*', choices=['areas_by_point', 'postcode', 'area_intersect', 'areas_by_type',
+                                               'area_polygon'],
+            help='Only time these endpoints (default all)')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random requests')
+        parser.add_argument(
+            '--cache', action='store_true', help='Use the configured cache, rather than none, as a server would')
+        parser.add_argument('--output', help='Write the results to this file, as well as standard output')
+        parser.add_argument(
+            '--compare', help='A previous output file to compare these results with; the comparison is printed')
+
+    def handle(self, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1 or options['warmup'] < 0:
+            raise CommandError("--requests and --concurrency must be at least 1, and --warmup not negative")
+        if not benchmark.fixtures_exist():
+            raise CommandError("There is no benchmark data; create it with mapit_benchmark_fixtures")
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as fp:
+                baseline = json.load(fp)
+
+        results = benchmark.run(
+            requests=options['requests'], concurrency=options['concurrency'], names=options['endpoints'],
+            warmup=options['warmup'], seed=options['seed'], cache=options['cache'])
+        output = json.dumps(results, indent=4)
+        self.stdout.write(output)
+        if options['output']:
+            with open(options['output'], 'w') as fp:
+                fp.write(output + '\n')
+
+        if baseline:
+            self.stderr.write('Compared with %s:' % (baseline.get('commit') or options['compare']))
+            for name, result in results['endpoints'].items():
+                before = baseline['endpoints'].get(name)
+                if not before:
+                    continue
+                self.stderr.write('%s: p50 %.3f -> %.3f ms (%.2fx), p99 %.3f -> %.3f ms (%.2fx), %.2f -> %.2f/s' % (
+                    name, before['p50_ms'], result['p50_ms'], result['p50_ms'] / before['p50_ms'],
+                    before['p99_ms'], result['p99_ms'], result['p99_ms'] / before['p99_ms'],
+                    before['throughput'], result['throughput']))
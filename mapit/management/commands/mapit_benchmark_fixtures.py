@@ -0,0 +1,47 @@
+# This script fills the database with a synthetic hierarchy of areas and
+# postcodes on the scale of a country, for mapit_benchmark to time requests
+# against. Run it against a database of its own, not one with real data.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mapit import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Create synthetic areas and postcodes to benchmark against'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--countries', type=int, default=4, help='Number of countries (default 4)')
+        parser.add_argument(
+            '--councils', type=int, default=5,
+            help='Councils along each side of a country, so 25 in each by default')
+        parser.add_argument(
+            '--wards', type=int, default=4, help='Wards along each side of a council, so 16 in each by default')
+        parser.add_argument(
+            '--output-areas', type=int, default=5, dest='output_areas',
+            help='Output areas along each side of a ward, so 25 in each by default')
+        parser.add_argument(
+            '--vertices', type=int, default=10,
+            help='Points along each edge of an output area, besides its corners (default 10)')
+        parser.add_argument('--postcodes', type=int, default=1000000, help='Number of postcodes (default 1000000)')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random boundaries and postcodes')
+        parser.add_argument('--delete', action='store_true', help='Remove any existing benchmark data first')
+
+    def handle(self, **options):
+        for option in ('countries', 'councils', 'wards', 'output_areas'):
+            if options[option] < 1:
+                raise CommandError("--%s must be at least 1" % option.replace('_', '-'))
+        if options['vertices'] < 0 or options['postcodes'] < 0:
+            raise CommandError("--vertices and --postcodes cannot be negative")
+        if options['postcodes'] > benchmark.MAX_POSTCODES:
+            raise CommandError("There can be at most %d postcodes" % benchmark.MAX_POSTCODES)
+
+        if options['delete']:
+            benchmark.delete_fixtures()
+        elif benchmark.fixtures_exist():
+            raise CommandError("There is already benchmark data; use --delete to replace it")
+
+        benchmark.create_fixtures(
+            countries=options['countries'], councils=options['councils'], wards=options['wards'],
+            output_areas=options['output_areas'], vertices=options['vertices'], postcodes=options['postcodes'],
+            seed=options['seed'], stdout=self.stdout)
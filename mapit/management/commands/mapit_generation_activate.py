@@ -1,5 +1,7 @@
 # This script activates the currently inactive generation.
 
+from django.conf import settings
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
 from mapit.models import Generation
 
@@ -19,5 +21,9 @@ class Command(BaseCommand):
         if options['commit']:
             new.save()
             self.stdout.write("%s - activated" % new)
+            if getattr(settings, 'MAPIT_POSTCODE_MEMBERSHIP', False):
+                call_command('mapit_postcode_membership_build', generation=new.id, stdout=self.stdout)
+            if getattr(settings, 'MAPIT_AREA_RELATIONS', False):
+                call_command('mapit_area_relation_build', generation=new.id, stdout=self.stdout)
         else:
             self.stdout.write("%s - not activated, dry run" % new)
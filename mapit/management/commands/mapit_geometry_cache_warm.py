@@ -0,0 +1,66 @@
+# This script fills the geometry cache (see GEOMETRY_CACHE_DIR) with the
+# polygons of the areas in a generation, so that the first requests for
+# large areas do not have to wait for them to be serialised.
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mapit.geometrycache import geometry_cache
+from mapit.geometryserialiser import get_serialiser, TransformError
+from mapit.models import Area, Generation
+
+
+class Command(BaseCommand):
+    help = 'Store the serialised polygons of areas in the geometry cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--generation', action='store', type=int, dest='generation',
+            help='The generation whose areas to store (default the current one)')
+        parser.add_argument('--type', nargs='*', help='Only store areas of these type codes')
+        parser.add_argument(
+            '--srid', nargs='*', type=int, dest='srid',
+            help='The SRIDs to store (default the area SRID and 4326)')
+        parser.add_argument(
+            '--simplify-tolerance', nargs='*', type=float, dest='simplify_tolerance', default=[0],
+            help='The simplify tolerances to store (default 0, no simplification)')
+        parser.add_argument(
+            '--format', nargs='*', choices=['kml', 'geojson', 'wkt'], default=['kml', 'geojson'],
+            help='The formats to store (default kml and geojson)')
+        parser.add_argument('--clear', action='store_true', help='Empty the cache first')
+
+    def handle(self, **options):
+        if not geometry_cache.enabled:
+            raise CommandError("GEOMETRY_CACHE_DIR is not set")
+
+        if options['generation']:
+            generation = options['generation']
+        else:
+            generation = Generation.objects.current()
+            if not generation:
+                raise CommandError("There is no current generation")
+            generation = generation.id
+
+        srids = options['srid'] or sorted(set([settings.MAPIT_AREA_SRID, 4326]))
+
+        if options['clear']:
+            geometry_cache.clear()
+
+        areas = Area.objects.filter(generation_low__lte=generation, generation_high__gte=generation)
+        if options['type']:
+            areas = areas.filter(type__code__in=options['type'])
+
+        count = 0
+        for area in areas.order_by('id').iterator():
+            for srid in srids:
+                for simplify_tolerance in options['simplify_tolerance']:
+                    serialiser = get_serialiser(area, srid, simplify_tolerance)
+                    for format in options['format']:
+                        try:
+                            if serialiser.serialise_area(area, format) is not None:
+                                count += 1
+                        except TransformError as e:
+                            self.stderr.write("%s: %s" % (area, e))
+            if int(options['verbosity']) > 1:
+                self.stdout.write("Stored %s" % area)
+        self.stdout.write("%d geometries stored" % count)
@@ -10,6 +10,7 @@ import sys
 from django.core.management.base import LabelCommand, CommandError
 
 import mapit.add_areas_from_file.core as add_areas_from_file
+from mapit.management.command_utils import simplify_levels
 from mapit.models import Generation, Type, NameType, Country, CodeType
 
 
@@ -114,6 +115,22 @@ class Command(LabelCommand):
             action="store_true",
             help="Skip over any entry with an empty name, rather than abort",
         )
+        parser.add_argument(
+            "--simplify_levels",
+            action="store",
+            type=simplify_levels,
+            dest="simplify_levels",
+            help="Comma-separated tolerances (in degrees) at which to store simplified"
+            " polygons of all areas of this type, e.g. 0.0001,0.001,0.01",
+        )
+        parser.add_argument(
+            "--jobs",
+            action="store",
+            type=int,
+            default=1,
+            help="How many processes to use for transforming and checking"
+            " geometries (default 1); areas are still saved in file order",
+        )
 
     def get_area_type(self, area_type_code, commit):
         try:
@@ -231,6 +248,8 @@ class Command(LabelCommand):
             options.get("encoding", "utf-8"),
             options.get("fix_invalid_polygons", False),
             options.get("ignore_blank", False),
+            options.get("simplify_levels", None),
+            options.get("jobs", 1),
         )
         err = parameters.validate()
         if err is not None:
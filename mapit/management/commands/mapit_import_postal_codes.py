@@ -3,13 +3,28 @@
 #   Postal code, Latitude, Longitude
 # By default in those positions, though you can specify other column numbers on
 # the command line
+#
+# With --bulk, the whole file is copied into a temporary table and compared
+# with the existing postal codes in a few queries, rather than row by row.
+# Subclasses' pre_row and post_row are used via pre_rows and post_rows, which
+# can be overridden to work on many rows at once. A hash of each postal code's
+# co-ordinates is stored so unchanged ones are skipped quickly next time, and
+# each bulk import is recorded, with every postal code it changed, in
+# PostcodeImport. With --terminate-missing, postal codes not in the file are
+# marked as terminated (but not deleted).
+#
+# In GB, each postcode's easting and northing are stored as well, so they
+# need not be worked out again when postcodes are compared or output.
 
 import csv
-from django.db import transaction
+import itertools
+import os.path
+from django.db import connection, transaction
 from django.contrib.gis.geos import Point
 from django.core.management.base import LabelCommand
 from django.conf import settings
-from mapit.models import Postcode
+from mapit.management.command_utils import copy_rows
+from mapit.models import Postcode, PostcodeImport, PostcodeMembershipBuild
 
 
 class Command(LabelCommand):
@@ -78,27 +93,51 @@ class Command(LabelCommand):
             default=False,
             help='If the CSV file actually uses tab as its separator'
         )
+        parser.add_argument(
+            '--bulk',
+            action="store_true",
+            dest='bulk',
+            default=False,
+            help='Load the whole file with COPY and update postal codes in a few queries'
+        )
+        parser.add_argument(
+            '--terminate-missing',
+            action="store_true",
+            dest='terminate-missing',
+            default=False,
+            help='With --bulk, mark any postal code not in the file as terminated'
+        )
 
     def handle_label(self, file, **options):
         self.process(file, options)
 
     def process(self, file, options):
         options.update(self.option_defaults)
+        self.count = dict.fromkeys(self.count, 0)
         if options['tabs']:
             reader = csv.reader(open(file), dialect='excel-tab')
         else:
             reader = csv.reader(open(file))
         if options['header-row']:
             next(reader)
-        for row in reader:
-            self._process_row(row, options)
+        if options.get('bulk'):
+            source = '%s %s' % (self.__module__.split('.')[-1], os.path.basename(file))
+            self.process_bulk(reader, options, source)
+        else:
+            for row in reader:
+                self._process_row(row, options)
+        PostcodeMembershipBuild.objects.invalidate()
         self.print_stats()
 
+    def row_code(self, row, options):
+        code = row[int(options['code-field']) - 1].strip()
+        if options['strip']:
+            code = code.replace(' ', '')
+        return code
+
     @transaction.atomic
     def _process_row(self, row, options):
-        self.code = row[int(options['code-field']) - 1].strip()
-        if options['strip']:
-            self.code = self.code.replace(' ', '')
+        self.code = self.row_code(row, options)
         if self.pre_row(row, options):
             pc = self.handle_row(row, options)
             self.post_row(pc)
@@ -109,19 +148,45 @@ class Command(LabelCommand):
     def post_row(self, pc):
         return True
 
+    def pre_rows(self, rows, options):
+        """The --bulk version of pre_row. Given a list of rows, return a list
+        of (postal code, (x, y) or None) for those to be imported. By default
+        this calls pre_row for each row, reading its location straight after,
+        as pre_row may change the options."""
+        out = []
+        for row in rows:
+            self.code = self.row_code(row, options)
+            if self.pre_row(row, options):
+                out.append((self.code, self.row_coordinates(row, options)))
+        return out
+
+    def post_rows(self, postcodes):
+        """The --bulk version of post_row, given a list of Postcodes once
+        they have all been saved, in file order. By default this calls
+        post_row for each, which is only right if post_row does not rely on
+        anything pre_row stored for that row."""
+        for pc in postcodes:
+            self.post_row(pc)
+
     def location_available_for_row(self, row):
         return True
 
-    def handle_row(self, row, options):
+    def row_coordinates(self, row, options):
         if not options['location'] or not self.location_available_for_row(row):
-            return self.do_postcode()
+            return None
 
         if not options['coord-field-lon']:
             options['coord-field-lon'] = int(options['coord-field-lat']) + 1
         lat = float(row[int(options['coord-field-lat']) - 1])
         lon = float(row[int(options['coord-field-lon']) - 1])
+        return lon, lat
+
+    def handle_row(self, row, options):
+        coordinates = self.row_coordinates(row, options)
+        if coordinates is None:
+            return self.do_postcode()
         srid = int(options['srid'])
-        location = Point(lon, lat, srid=srid)
+        location = Point(*coordinates, srid=srid)
         return self.do_postcode(location, srid)
 
     # Want to compare co-ordinates so can't use straightforward
@@ -138,25 +203,152 @@ class Command(LabelCommand):
                     elif srid != 4326:
                         curr_location = pc.location.transform(srid, clone=True)
                     if curr_location[0] != location[0] or curr_location[1] != location[1]:
-                        pc.location = location
+                        self.set_location(pc, location)
                         pc.save()
                         self.count['updated'] += 1
                     else:
                         self.count['unchanged'] += 1
                 else:
-                    pc.location = location
+                    self.set_location(pc, location)
                     pc.save()
                     self.count['updated'] += 1
             else:
                 self.count['unchanged'] += 1
         except Postcode.DoesNotExist:
-            pc = Postcode.objects.create(postcode=self.code, location=location)
+            pc = Postcode(postcode=self.code)
+            self.set_location(pc, location)
+            pc.save()
             self.count['created'] += 1
         self.count['total'] += 1
         if self.count['total'] % self.often == 0:
             self.print_stats()
         return pc
 
+    def set_location(self, pc, location):
+        pc.location = location
+        pc.easting = pc.northing = None
+        pc.source_hash = ''
+        if location and settings.MAPIT_COUNTRY == 'GB':
+            Postcode.objects.fill_uk_grid([pc])
+
+    def process_bulk(self, reader, options, source):
+        srid = int(options['srid'])
+        # How to compare an existing location with the one given, as in
+        # do_postcode
+        if settings.MAPIT_COUNTRY == 'GB':
+            grid = "CASE WHEN ordered.postcode LIKE 'BT%%' THEN 29902 ELSE 27700 END"
+            current = (
+                'COALESCE(mapit_postcode.easting, round(ST_X(ST_Transform(mapit_postcode.location, %s)))) = ordered.x '
+                'AND COALESCE(mapit_postcode.northing, round(ST_Y(ST_Transform(mapit_postcode.location, %s)))) '
+                '= ordered.y' % (grid, grid))
+        elif srid != 4326:
+            current = (
+                'ST_X(ST_Transform(mapit_postcode.location, %(srid)s)) = ordered.x '
+                'AND ST_Y(ST_Transform(mapit_postcode.location, %(srid)s)) = ordered.y')
+        else:
+            current = 'ST_X(mapit_postcode.location) = ordered.x AND ST_Y(mapit_postcode.location) = ordered.y'
+        location = 'ST_Transform(ST_SetSRID(ST_MakePoint(x, y), %(srid)s), 4326)'
+        source_hash = "md5(x::text || ',' || y::text)"
+
+        def rows():
+            seq = itertools.count(1)
+            while True:
+                batch = list(itertools.islice(reader, self.often))
+                if not batch:
+                    break
+                for code, coordinates in self.pre_rows(batch, options):
+                    x, y = coordinates or (None, None)
+                    yield next(seq), code, x, y
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('CREATE TEMPORARY TABLE mapit_postcode_new '
+                           '(seq bigint, postcode text, x float8, y float8) ON COMMIT DROP')
+            copy_rows(cursor, 'mapit_postcode_new', ('seq', 'postcode', 'x', 'y'), rows())
+
+            # Decide what happened to each row, treating a postal code that
+            # appears more than once as if the rows were imported in turn
+            cursor.execute('''
+CREATE TEMPORARY TABLE mapit_postcode_diff ON COMMIT DROP AS
+WITH ordered AS (
+    SELECT seq, postcode, x, y,
+        row_number() OVER (PARTITION BY postcode ORDER BY seq) AS occurrence,
+        max(seq) FILTER (WHERE x IS NOT NULL) OVER (
+            PARTITION BY postcode ORDER BY seq ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+        ) AS previous_seq
+    FROM mapit_postcode_new
+)
+SELECT ordered.seq, ordered.postcode, ordered.x, ordered.y,
+    CASE
+        WHEN ordered.occurrence = 1 AND mapit_postcode.id IS NULL THEN 'created'
+        WHEN ordered.x IS NULL THEN 'unchanged'
+        WHEN previous.seq IS NOT NULL THEN
+            CASE WHEN previous.x = ordered.x AND previous.y = ordered.y THEN 'unchanged' ELSE 'updated' END
+        WHEN mapit_postcode.source_hash = md5(ordered.x::text || ',' || ordered.y::text) THEN 'unchanged'
+        WHEN mapit_postcode.location IS NULL THEN 'updated'
+        WHEN %s THEN 'unchanged'
+        ELSE 'updated'
+    END AS result
+FROM ordered
+    LEFT JOIN mapit_postcode_new previous ON previous.seq = ordered.previous_seq
+    LEFT JOIN mapit_postcode ON mapit_postcode.postcode = ordered.postcode
+''' % current, {'srid': srid})
+            cursor.execute('SELECT result, count(*) FROM mapit_postcode_diff GROUP BY result')
+            for result, count in cursor.fetchall():
+                self.count[result] += count
+                self.count['total'] += count
+
+            cursor.execute('''
+CREATE TEMPORARY TABLE mapit_postcode_changed ON COMMIT DROP AS
+SELECT postcode, CASE WHEN bool_or(result = 'created') THEN 'created' ELSE 'updated' END AS change
+FROM mapit_postcode_diff
+WHERE result IN ('created', 'updated')
+GROUP BY postcode
+''')
+
+            # Existing postal codes take the location of their last row with
+            # one, if changed, and all store the hash of that location
+            cursor.execute('''
+UPDATE mapit_postcode
+SET location = CASE WHEN last.updated THEN last.location ELSE mapit_postcode.location END,
+    easting = CASE WHEN last.updated THEN NULL ELSE mapit_postcode.easting END,
+    northing = CASE WHEN last.updated THEN NULL ELSE mapit_postcode.northing END,
+    source_hash = last.source_hash
+FROM (
+    SELECT DISTINCT ON (postcode) postcode, changed.change IS NOT NULL AS updated,
+        CASE WHEN changed.change IS NOT NULL THEN %s END AS location, %s AS source_hash
+    FROM mapit_postcode_diff
+        LEFT JOIN mapit_postcode_changed changed USING (postcode)
+    WHERE x IS NOT NULL
+    ORDER BY postcode, seq DESC
+) last
+WHERE mapit_postcode.postcode = last.postcode
+    AND (last.updated OR mapit_postcode.source_hash != last.source_hash)
+''' % (location, source_hash), {'srid': srid})
+            cursor.execute('''
+INSERT INTO mapit_postcode (postcode, location, source_hash)
+SELECT DISTINCT ON (postcode) postcode,
+    CASE WHEN x IS NULL THEN NULL ELSE %s END, COALESCE(%s, '')
+FROM mapit_postcode_diff
+WHERE postcode IN (SELECT postcode FROM mapit_postcode_changed WHERE change = 'created')
+ORDER BY postcode, x IS NOT NULL DESC, seq DESC
+''' % (location, source_hash), {'srid': srid})
+
+            if settings.MAPIT_COUNTRY == 'GB':
+                Postcode.objects.filter(easting__isnull=True).update_uk_grid()
+
+            PostcodeImport.objects.record(
+                source, 'mapit_postcode_new', unchanged=self.count['unchanged'],
+                terminate=options.get('terminate-missing', False))
+
+            if type(self).post_row is not Command.post_row or type(self).post_rows is not Command.post_rows:
+                cursor.execute('SELECT postcode FROM mapit_postcode_new ORDER BY seq')
+                while True:
+                    codes = [code for code, in cursor.fetchmany(self.often)]
+                    if not codes:
+                        break
+                    postcodes = Postcode.objects.in_bulk(codes, field_name='postcode')
+                    self.post_rows([postcodes[code] for code in codes])
+
     def print_stats(self):
         print("Imported %d (%d new, %d changed, %d same)" % (
             self.count['total'], self.count['created'],
@@ -0,0 +1,71 @@
+# This script stores the areas containing every postcode for one generation,
+# so that postcode lookups in that generation do not need a spatial query.
+# Run it after importing postcodes or boundaries; until it is run again,
+# lookups in affected generations fall back to the spatial query.
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from mapit.models import Generation, Postcode, PostcodeMembership, PostcodeMembershipBuild
+
+
+class Command(BaseCommand):
+    help = 'Precompute the areas containing each postcode for a generation'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--generation', action='store', type=int, dest='generation',
+            help='The generation to build (default the current one)')
+        parser.add_argument(
+            '--chunk-size', action='store', type=int, dest='chunk_size', default=50000,
+            help='How large a range of postcode IDs to do in each query (default 50000)')
+        parser.add_argument(
+            '--jobs', action='store', type=int, dest='jobs', default=1,
+            help='How many queries to run at once (default 1)')
+
+    def handle(self, **options):
+        if options['generation']:
+            try:
+                generation = Generation.objects.get(id=options['generation'])
+            except Generation.DoesNotExist:
+                raise CommandError("Generation %d does not exist" % options['generation'])
+        else:
+            generation = Generation.objects.current()
+            if not generation:
+                raise CommandError("There is no current generation")
+        if options['chunk_size'] < 1 or options['jobs'] < 1:
+            raise CommandError("--chunk-size and --jobs must be positive")
+        self.build(generation, options['chunk_size'], options['jobs'])
+
+    def build(self, generation, chunk_size=50000, jobs=1):
+        # Stop lookups using the old rows before removing them
+        PostcodeMembershipBuild.objects.filter(generation=generation).delete()
+        PostcodeMembership.objects.filter(generation=generation).delete()
+
+        ids = Postcode.objects.aggregate(low=Min('id'), high=Max('id'))
+        chunks = []
+        if ids['low'] is not None:
+            chunks = range(ids['low'], ids['high'] + 1, chunk_size)
+
+        def build_chunk(low):
+            try:
+                with transaction.atomic():
+                    return PostcodeMembership.objects.build(generation.id, low, low + chunk_size)
+            finally:
+                # Each thread has its own database connection
+                if jobs > 1:
+                    connection.close()
+
+        total = 0
+        if jobs > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for count in executor.map(build_chunk, chunks):
+                    total += count
+        else:
+            for count in map(build_chunk, chunks):
+                total += count
+
+        PostcodeMembershipBuild.objects.create(generation=generation)
+        self.stdout.write("%s - %d postcode areas stored" % (generation, total))
@@ -0,0 +1,160 @@
+# Middleware to record how long each view takes, and where that time goes,
+# so it can be output in Prometheus's text format at /metrics.
+#
+# Turn it on by setting METRICS to True. Each worker process keeps its own
+# figures, in memory; requests are recorded under the name of the view
+# function that handled them (or would have, for those served from the cache).
+
+import bisect
+from collections import Counter, defaultdict
+import threading
+import time
+
+from django.db import connection
+from django.urls import Resolver404, resolve
+
+# The upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class QueryCounter(object):
+    """A database execute wrapper adding up the number of queries made, the
+    time they took, and the rows they returned."""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0
+        self.rows = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - start
+            self.queries += 1
+            self.rows += max(context['cursor'].rowcount, 0)
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.queries = Counter()
+        self.rows = Counter()
+        self.bytes = Counter()
+        self.seconds = defaultdict(Histogram)
+        self.db_seconds = defaultdict(Histogram)
+
+    def record(self, view, cache, seconds, counter, size):
+        with self.lock:
+            self.requests[view, cache] += 1
+            self.queries[view] += counter.queries
+            self.rows[view] += counter.rows
+            self.bytes[view] += size
+            self.seconds[view].observe(seconds)
+            self.db_seconds[view].observe(counter.seconds)
+
+    def render(self):
+        """Return the metrics in Prometheus's text format."""
+        from mapit.ratelimitcache import stats as ratelimit_stats
+
+        lines = []
+
+        def counter(name, help, values, labels):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+            for key, value in sorted(values.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                lines.append('%s{%s} %s' % (name, ','.join(
+                    '%s="%s"' % (label, part) for label, part in zip(labels, key)), value))
+
+        def histogram(name, help, values):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s histogram' % name)
+            for view, hist in sorted(values.items()):
+                total = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), hist.counts):
+                    total += count
+                    lines.append('%s_bucket{view="%s",le="%s"} %d' % (name, view, bound, total))
+                lines.append('%s_sum{view="%s"} %s' % (name, view, hist.sum))
+                lines.append('%s_count{view="%s"} %d' % (name, view, total))
+
+        with self.lock:
+            counter('mapit_requests_total', 'Requests handled, by view and cache result.',
+                    self.requests, ('view', 'cache'))
+            histogram('mapit_request_seconds', 'Time taken to handle and output requests.', self.seconds)
+            histogram('mapit_request_db_seconds', 'Time spent in database queries.', self.db_seconds)
+            counter('mapit_queries_total', 'Database queries made.', self.queries, ('view',))
+            counter('mapit_rows_total', 'Rows returned by database queries.', self.rows, ('view',))
+            counter('mapit_response_bytes_total', 'Bytes of output.', self.bytes, ('view',))
+        stats = dict(ratelimit_stats)
+        counter('mapit_ratelimit_requests_total', 'Requests checked by the rate limiter, by endpoint class.',
+                dict((key, value) for key, value in stats.items() if key[1] in ('allowed', 'limited')),
+                ('class', 'result'))
+        counter('mapit_ratelimit_cost_total', 'Cost charged by the rate limiter, by endpoint class.',
+                dict((key[0], value) for key, value in stats.items() if key[1] == 'cost'), ('class',))
+        counter('mapit_ratelimit_seconds_total', 'Time spent checking rate limits, by endpoint class.',
+                dict((key[0], value) for key, value in stats.items() if key[1] == 'seconds'), ('class',))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def view_name(request):
+    match = request.resolver_match
+    if match is None:
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return 'unknown'
+    return match.func.__name__
+
+
+def cache_result(request):
+    # FetchFromCacheMiddleware notes whether the response should be cached
+    # when it is missing, and not when it was found (or is not cacheable)
+    update_cache = getattr(request, '_cache_update_cache', None)
+    if update_cache is None or request.method not in ('GET', 'HEAD'):
+        return 'none'
+    return 'miss' if update_cache else 'hit'
+
+
+class MetricsMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+
+        view, cache = view_name(request), cache_result(request)
+        if response.streaming:
+            # Streamed output is generated as it is sent, so include that
+            response.streaming_content = self.stream(response.streaming_content, view, cache, start, counter)
+        else:
+            metrics.record(view, cache, time.perf_counter() - start, counter, len(response.content))
+        return response
+
+    def stream(self, content, view, cache, start, counter):
+        size = 0
+        try:
+            with connection.execute_wrapper(counter):
+                for chunk in content:
+                    size += len(chunk)
+                    yield chunk
+        finally:
+            metrics.record(view, cache, time.perf_counter() - start, counter, size)
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.5 on 2026-10-18 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit', '0007_alter_codetype_options_alter_nametype_options_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostcodeMembershipBuild',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('generation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='postcode_membership_build', to='mapit.generation')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PostcodeMembership',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('area', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='postcode_memberships', to='mapit.area')),
+                ('generation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='postcode_memberships', to='mapit.generation')),
+                ('postcode', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='mapit.postcode')),
+            ],
+            options={
+                'unique_together': {('generation', 'postcode', 'area')},
+            },
+        ),
+    ]
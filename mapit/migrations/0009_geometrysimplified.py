@@ -0,0 +1,28 @@
+# Generated by Django 5.2.5 on 2026-10-18 11:40
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit', '0008_postcodemembership'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeometrySimplified',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tolerance', models.FloatField()),
+                ('polygon', django.contrib.gis.db.models.fields.MultiPolygonField(srid=4326)),
+                ('area', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='simplified', to='mapit.area')),
+            ],
+            options={
+                'verbose_name_plural': 'simplified geometries',
+                'unique_together': {('area', 'tolerance')},
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.5 on 2026-10-18 14:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit', '0009_geometrysimplified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AreaRelationBuild',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('generation', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='area_relation_build', to='mapit.generation')),
+                ('stale', models.ManyToManyField(blank=True, related_name='+', to='mapit.area')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AreaRelation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('relation', models.CharField(choices=[('touches', 'touches'), ('overlaps', 'overlaps'), ('covers', 'covers'), ('coveredby', 'is covered by')], max_length=10)),
+                ('area', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='relations', to='mapit.area')),
+                ('generation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='area_relations', to='mapit.generation')),
+                ('other', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='mapit.area')),
+            ],
+            options={
+                'unique_together': {('generation', 'area', 'relation', 'other')},
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.5 on 2026-10-18 15:20
+
+from django.conf import settings
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit', '0010_arearelation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='area',
+            name='bbox',
+            field=django.contrib.gis.db.models.fields.PolygonField(blank=True, editable=False, null=True, srid=settings.MAPIT_AREA_SRID),
+        ),
+        migrations.AddField(
+            model_name='area',
+            name='centroid',
+            field=django.contrib.gis.db.models.fields.PointField(blank=True, editable=False, null=True, srid=settings.MAPIT_AREA_SRID),
+        ),
+        migrations.AddField(
+            model_name='area',
+            name='point_count',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='area',
+            name='total_area',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            '''
+UPDATE mapit_area
+SET bbox = extent.bbox, centroid = extent.centroid, point_count = extent.point_count, total_area = extent.total_area
+FROM (
+    SELECT area_id,
+        CASE WHEN GeometryType(ST_Envelope(ST_Collect(polygon))) = 'POLYGON'
+            THEN ST_Envelope(ST_Collect(polygon)) END AS bbox,
+        ST_Centroid(ST_Collect(polygon)) AS centroid,
+        ST_NPoints(ST_Collect(polygon)) AS point_count,
+        ST_Area(ST_Collect(polygon)) AS total_area
+    FROM mapit_geometry
+    GROUP BY area_id
+) extent
+WHERE mapit_area.id = extent.area_id
+''',
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.5 on 2026-10-18 16:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit', '0011_area_extent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postcode',
+            name='source_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+        migrations.CreateModel(
+            name='PostcodeImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=200)),
+                ('imported', models.DateTimeField(auto_now_add=True)),
+                ('created', models.IntegerField(default=0)),
+                ('updated', models.IntegerField(default=0)),
+                ('unchanged', models.IntegerField(default=0)),
+                ('terminated', models.IntegerField(default=0)),
+                ('restored', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ('-imported', '-id'),
+            },
+        ),
+        migrations.CreateModel(
+            name='PostcodeChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('change', models.CharField(choices=[('created', 'created'), ('updated', 'updated'), ('terminated', 'terminated'), ('restored', 'restored')], max_length=10)),
+                ('postcode', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='mapit.postcode')),
+                ('postcode_import', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='changes', to='mapit.postcodeimport')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PostcodeTerminated',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('postcode', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='termination', to='mapit.postcode')),
+                ('postcode_import', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='terminations', to='mapit.postcodeimport')),
+            ],
+            options={
+                'verbose_name_plural': 'terminated postcodes',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.5 on 2026-10-18 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mapit', '0012_postcodeimport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='postcode',
+            name='easting',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='postcode',
+            name='northing',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -1,19 +1,27 @@
 from __future__ import unicode_literals
 
-import re
+import hashlib
 import itertools
+import math
 
+import shapely
 from django.contrib.gis.db import models
+from django.contrib.gis.geos import GEOSGeometry
 from django.conf import settings
-from django.db import connection
+from django.core.cache import cache
+from django.db import connection, transaction
 from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.db.models.query import RawQuerySet
 from django.utils.encoding import smart_str
 from django.utils.functional import cached_property
 from django.utils.translation import gettext as _
 
 from mapit import countries
-from mapit.geometryserialiser import GeometrySerialiser
+from mapit.areacache import area_cache
+from mapit.geometrycache import geometry_cache
+from mapit.geometryserialiser import get_serialiser
+from mapit.iterables import iterable_to_stream
 from mapit.middleware import ViewException
 
 
@@ -47,6 +55,21 @@ class GenerationManager(models.Manager):
             return None
         return latest[0]
 
+    def requested(self, request):
+        """Return the ID of the one generation a request is asking about (the
+        generation parameter, or the current generation), or None if it uses
+        min_generation or max_generation to ask about a range."""
+        try:
+            args = dict((q, int(request.GET.get(q, 0))) for q in ('generation', 'min_generation', 'max_generation'))
+        except ValueError:
+            return None
+        if args['min_generation'] or args['max_generation']:
+            return None
+        if args['generation']:
+            return args['generation']
+        current = self.current()
+        return current.id if current else None
+
     def query_args(self, request, format):
         args = {}
         for q in ('generation', 'min_generation', 'max_generation'):
@@ -164,7 +187,58 @@ class Type(TypeModel):
         max_length=200, blank=True, help_text="The name of the type of area, eg 'Country', 'Constituency', etc")
 
 
-class AreaManager(models.Manager):
+def extent_covers(location):
+    """A Q to cheaply rule out areas whose stored bounding box does not cover
+    the location. Every area with polygons has one (stored whenever they
+    change), apart from those whose polygons have no area at all, which
+    cannot cover anything anyway."""
+    return Q(bbox__bbcovers=location)
+
+
+# The zoom level from which vector tiles are made from subdivided polygons
+TILE_SUBDIVIDED_ZOOM = 10
+
+
+def changed_generations(before, after):
+    """Return a list of (low, high) ranges of generation IDs covering those
+    an area has joined or left, given its (generation_low_id,
+    generation_high_id) before and after a change."""
+    if None in before:
+        return [] if None in after else [after]
+    if None in after:
+        return [before]
+    ranges = []
+    if before[0] != after[0]:
+        ranges.append((min(before[0], after[0]), max(before[0], after[0]) - 1))
+    if before[1] != after[1]:
+        ranges.append((min(before[1], after[1]) + 1, max(before[1], after[1])))
+    return ranges
+
+
+class AreaQuerySet(models.QuerySet):
+    generation_fields = ('generation_low', 'generation_low_id', 'generation_high', 'generation_high_id')
+
+    def update(self, **kwargs):
+        # Bulk updates do not send post_save, so mark cached output out of
+        # date here instead, along with the stored postcode areas and area
+        # relations of any generation the areas have joined or left
+        before = None
+        if any(field in kwargs for field in self.generation_fields):
+            before = dict((id, (low, high)) for id, low, high in self.values_list(
+                'id', 'generation_low_id', 'generation_high_id'))
+        updated = super(AreaQuerySet, self).update(**kwargs)
+        if before:
+            after = Area.objects.filter(id__in=list(before)).values_list(
+                'id', 'generation_low_id', 'generation_high_id')
+            ranges = dict((id, changed_generations(before[id], (low, high))) for id, low, high in after)
+            PostcodeMembershipBuild.objects.invalidate_generations(
+                set(itertools.chain.from_iterable(ranges.values())))
+            AreaRelationBuild.objects.invalidate_generations(ranges)
+        area_cache.bump()
+        return updated
+
+
+class AreaManager(models.Manager.from_queryset(AreaQuerySet)):
     def get_queryset(self):
         return super(AreaManager, self).get_queryset().select_related(
             'type', 'country', 'parent_area')
@@ -172,15 +246,162 @@ class AreaManager(models.Manager):
     def by_location(self, location, query):
         if not location:
             return []
-        query &= Q(polygons__subdivided__division__covers=location)
+        query &= Q(polygons__subdivided__division__covers=location) & extent_covers(location)
         return Area.objects.filter(query).distinct()
 
-    def by_postcode(self, postcode, query):
+    def by_postcode(self, postcode, query, generation=None):
+        # If the areas for this postcode have been precomputed for the
+        # generation being asked about, use those
+        if generation and PostcodeMembershipBuild.objects.filter(generation=generation).exists():
+            return list(Area.objects.filter(
+                query, postcode_memberships__generation=generation, postcode_memberships__postcode=postcode))
         return list(itertools.chain(
             self.by_location(postcode.location, query),
             postcode.areas.filter(query)
         ))
 
+    def by_points(self, points, srid, query):
+        """Given a list of (id, x, y) tuples of co-ordinates in the given SRID,
+        return a dict mapping each id to the set of IDs of areas matching the
+        query whose polygons cover that point. This is done as one spatial
+        join in the database, rather than one query per point."""
+        if not points:
+            return {}
+        ids, xs, ys = zip(*points)
+        locations = '''
+    SELECT id, ST_Transform(ST_SetSRID(ST_MakePoint(x, y), %s), %s) AS location
+    FROM unnest(%s::text[], %s::float8[], %s::float8[]) AS input(id, x, y)'''
+        params = [srid, settings.MAPIT_AREA_SRID, list(ids), list(xs), list(ys)]
+        return self._by_locations(locations, params, query)
+
+    def by_postcodes(self, postcodes, query, generation=None):
+        """Given a list of postcodes, return a dict mapping each postcode's ID
+        to the set of IDs of areas matching the query that contain it, either
+        by location or by the postcode's own areas. This takes two queries
+        however many postcodes are given."""
+        out = {}
+        if generation and PostcodeMembershipBuild.objects.filter(generation=generation).exists():
+            memberships = PostcodeMembership.objects.filter(
+                generation=generation, postcode__in=[postcode.id for postcode in postcodes],
+                area__in=self.filter(query).order_by().values('id'))
+            for postcode_id, area_id in memberships.values_list('postcode_id', 'area_id'):
+                out.setdefault(postcode_id, set()).add(area_id)
+            return out
+        located = [postcode.id for postcode in postcodes if postcode.location]
+        if located:
+            locations = '''
+    SELECT id, ST_Transform(location, %s) AS location
+    FROM mapit_postcode WHERE id = ANY(%s)'''
+            out = self._by_locations(locations, [settings.MAPIT_AREA_SRID, located], query)
+        m2m = Postcode.areas.through.objects.filter(
+            postcode__in=[postcode.id for postcode in postcodes],
+            area__in=self.filter(query).order_by().values('id'))
+        for postcode_id, area_id in m2m.values_list('postcode_id', 'area_id'):
+            out.setdefault(postcode_id, set()).add(area_id)
+        return out
+
+    def _by_locations(self, locations, params, query):
+        """locations is SQL returning rows of (id, location), with location in
+        the area SRID. Returns a dict of id to the set of IDs of areas matching
+        the query that cover that location."""
+        areas, areas_params = self.filter(query).order_by().values('id').query.sql_with_params()
+        query = '''
+WITH locations AS %s (%s
+)
+SELECT DISTINCT locations.id, mapit_geometry.area_id
+FROM locations
+    JOIN mapit_geometrysubdivided ON ST_Covers(mapit_geometrysubdivided.division, locations.location)
+    JOIN mapit_geometry ON mapit_geometrysubdivided.geometry_id = mapit_geometry.id
+WHERE mapit_geometry.area_id IN (%s)
+''' % (materialized(), locations, areas)
+        out = {}
+        with connection.cursor() as cursor:
+            cursor.execute(query, list(params) + list(areas_params))
+            for id, area_id in cursor:
+                out.setdefault(id, set()).add(area_id)
+        return out
+
+    def tile(self, query, z, x, y, extent=4096, buffer=64):
+        """Return a Mapbox vector tile (as bytes) of the areas matching the
+        query in the web mercator tile z/x/y, with one layer 'areas'. The
+        features have id, name and type attributes, plus a code_<type>
+        attribute for each of the area's codes, and their polygons are
+        simplified to the size of one of the tile's pixels. Below
+        TILE_SUBDIVIDED_ZOOM, where a tile covers much of each area, each
+        area's polygons touching the tile are simplified whole; at or above
+        it, only the area's subdivided polygons touching the tile are used,
+        unioned back together first."""
+        areas, areas_params = self.filter(query).order_by().values('id').query.sql_with_params()
+        if z < TILE_SUBDIVIDED_ZOOM:
+            polygons = '''
+        SELECT mapit_geometry.area_id, ST_Collect(ST_Simplify(mapit_geometry.polygon, bounds.pixel)) AS polygon
+        FROM bounds, mapit_geometry
+        WHERE mapit_geometry.polygon && bounds.area
+            AND mapit_geometry.area_id IN (%s)
+        GROUP BY mapit_geometry.area_id''' % areas
+        else:
+            polygons = '''
+        SELECT mapit_geometry.area_id,
+            ST_Simplify(ST_Union(mapit_geometrysubdivided.division), bounds.pixel) AS polygon
+        FROM bounds, mapit_geometrysubdivided
+            JOIN mapit_geometry ON mapit_geometrysubdivided.geometry_id = mapit_geometry.id
+        WHERE mapit_geometrysubdivided.division && bounds.area
+            AND mapit_geometry.area_id IN (%s)
+        GROUP BY mapit_geometry.area_id, bounds.pixel''' % areas
+        query = '''
+WITH bounds AS %s (
+    SELECT tile, area, (ST_XMax(area) - ST_XMin(area)) / %%s AS pixel
+    FROM (
+        SELECT ST_TileEnvelope(%%s, %%s, %%s) AS tile, ST_Transform(ST_TileEnvelope(%%s, %%s, %%s), %%s) AS area
+    ) envelope
+),
+features AS (
+    SELECT polygons.area_id, ST_AsMVTGeom(ST_Transform(polygons.polygon, 3857), bounds.tile, %%s, %%s) AS geom
+    FROM bounds, (%s
+    ) polygons
+)
+SELECT ST_AsMVT(mvt, 'areas', %%s, 'geom')
+FROM (
+    SELECT features.geom, mapit_area.id, mapit_area.name, mapit_type.code AS type,
+        (SELECT jsonb_object_agg('code_' || mapit_codetype.code, mapit_code.code)
+            FROM mapit_code JOIN mapit_codetype ON mapit_code.type_id = mapit_codetype.id
+            WHERE mapit_code.area_id = mapit_area.id) AS codes
+    FROM features
+        JOIN mapit_area ON features.area_id = mapit_area.id
+        JOIN mapit_type ON mapit_area.type_id = mapit_type.id
+    WHERE features.geom IS NOT NULL
+) mvt
+''' % (materialized(), polygons)
+        params = [extent, z, x, y, z, x, y, settings.MAPIT_AREA_SRID, extent, buffer] + list(areas_params) + [extent]
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            tile = cursor.fetchone()[0]
+        return bytes(tile) if tile else b''
+
+    def update_extent(self, area_ids):
+        """Store the bounding box, centroid, number of points and total area
+        of the polygons of the areas with the given IDs."""
+        query = '''
+UPDATE mapit_area
+SET bbox = extent.bbox, centroid = extent.centroid, point_count = extent.point_count, total_area = extent.total_area
+FROM (
+    SELECT mapit_area.id,
+        CASE WHEN GeometryType(ST_Envelope(collected.polygon)) = 'POLYGON'
+            THEN ST_Envelope(collected.polygon) END AS bbox,
+        ST_Centroid(collected.polygon) AS centroid,
+        ST_NPoints(collected.polygon) AS point_count,
+        ST_Area(collected.polygon) AS total_area
+    FROM mapit_area
+        LEFT JOIN LATERAL (
+            SELECT ST_Collect(polygon) AS polygon FROM mapit_geometry WHERE area_id = mapit_area.id
+        ) collected ON true
+    WHERE mapit_area.id = ANY(%s)
+) extent
+WHERE mapit_area.id = extent.id
+'''
+        with connection.cursor() as cursor:
+            cursor.execute(query, [list(area_ids)])
+
     # In order for this query to be performant, we have to do it ourselves.
     # We force the non-geographical part of the query to be done first, because
     # if a type is specified, that greatly speeds it up.
@@ -188,7 +409,7 @@ class AreaManager(models.Manager):
         if not isinstance(query_type, list):
             query_type = [query_type]
 
-        params = [area.id, area.id, generation.id, generation.id]
+        params = [area.id, area.id, settings.MAPIT_AREA_SRID, area.id, generation.id, generation.id]
 
         if types:
             params.append(tuple(types))
@@ -196,27 +417,77 @@ class AreaManager(models.Manager):
         else:
             query_area_type = ''
 
-        query_geo = ' OR '.join(['ST_%s(geometry_sd.division, target_sd.division)' % type for type in query_type])
+        query_geo = ' OR '.join(['ST_%s(geometry_sd.division, target.division)' % type for type in query_type])
 
+        # Every relation asked about implies that the subdivisions' bounding
+        # boxes meet, so first find the areas with a subdivision within the
+        # target's bounding box (using the spatial index), then check each of
+        # those until one pair of subdivisions matches.
         query = '''
-SELECT DISTINCT mapit_area.*
-FROM
-    mapit_area,
-    mapit_geometry geometry, mapit_geometrysubdivided geometry_sd,
-    mapit_geometry target, mapit_geometrysubdivided target_sd
+WITH target AS %s (
+    SELECT target_sd.division
+    FROM mapit_geometrysubdivided target_sd
+        JOIN mapit_geometry target ON target_sd.geometry_id = target.id
+    WHERE target.area_id = %%s
+),
+envelope AS %s (
+    SELECT COALESCE(
+        (SELECT bbox FROM mapit_area WHERE id = %%s),
+        (SELECT ST_SetSRID(ST_Extent(division)::geometry, %%s) FROM target)
+    ) AS extent
+),
+candidates AS %s (
+    SELECT DISTINCT geometry.area_id
+    FROM envelope
+        JOIN mapit_geometrysubdivided geometry_sd ON geometry_sd.division && envelope.extent
+        JOIN mapit_geometry geometry ON geometry_sd.geometry_id = geometry.id
+    WHERE geometry.area_id != %%s
+)
+SELECT mapit_area.*
+FROM mapit_area
+    JOIN candidates ON candidates.area_id = mapit_area.id
 WHERE
-    geometry_sd.geometry_id = geometry.id
-    AND target_sd.geometry_id = target.id
-    AND geometry.area_id = mapit_area.id
-    AND target.area_id = %%s
-    AND geometry.area_id != %%s
-    AND mapit_area.generation_low_id <= %%s
+    mapit_area.generation_low_id <= %%s
     AND mapit_area.generation_high_id >= %%s
+    AND (mapit_area.bbox IS NULL OR mapit_area.bbox && (SELECT extent FROM envelope))
     %s
-    AND (%s)
-''' % (query_area_type, query_geo)
+    AND EXISTS (
+        SELECT 1
+        FROM mapit_geometry geometry
+            JOIN mapit_geometrysubdivided geometry_sd ON geometry_sd.geometry_id = geometry.id
+            JOIN target ON geometry_sd.division && target.division
+        WHERE geometry.area_id = mapit_area.id
+            AND (%s)
+    )
+ORDER BY mapit_area.id
+''' % (materialized(), materialized(), materialized(), query_area_type, query_geo)
         return RawQuerySet(raw_query=query, model=self.model, params=params, using=self._db)
 
+    def intersect_ids(self, query_type, area, types, generation):
+        """As intersect, but returning a set of area IDs. The result for each
+        relation is stored in the Django cache until the areas next change,
+        so asking for several relations at once reuses any already known."""
+        if not isinstance(query_type, list):
+            query_type = [query_type]
+
+        if AreaRelationBuild.objects.fresh(generation) and \
+                area.generation_low_id <= generation.id <= area.generation_high_id:
+            return AreaRelation.objects.related_ids(query_type, area, types, generation)
+
+        version = area_cache.check()
+        ids = set()
+        for relation in query_type:
+            key = 'mapit-intersect:%s:%s:%d:%s:%d:%s' % (
+                settings.DATABASES['default']['NAME'], version, area.id, relation, generation.id,
+                ','.join(sorted(types)))
+            key = 'mapit-intersect-%s' % hashlib.md5(key.encode('utf-8')).hexdigest()
+            found = cache.get(key)
+            if found is None:
+                found = [a.id for a in self.intersect(relation, area, types, generation)]
+                cache.set(key, found, getattr(settings, 'CACHE_MIDDLEWARE_SECONDS', 86400))
+            ids.update(found)
+        return ids
+
     def get_or_create_with_name(self, country=None, type=None, name_type='', name=''):
         current_generation = Generation.objects.current()
         new_generation = Generation.objects.new()
@@ -259,6 +530,12 @@ class Area(models.Model):
     generation_low = models.ForeignKey(Generation, related_name='new_areas', null=True, on_delete=models.CASCADE)
     generation_high = models.ForeignKey(Generation, related_name='final_areas', null=True, on_delete=models.CASCADE)
 
+    # Summaries of the area's polygons, kept up to date by update_extent
+    bbox = models.PolygonField(srid=settings.MAPIT_AREA_SRID, null=True, blank=True, editable=False)
+    centroid = models.PointField(srid=settings.MAPIT_AREA_SRID, null=True, blank=True, editable=False)
+    point_count = models.IntegerField(null=True, blank=True, editable=False)
+    total_area = models.FloatField(null=True, blank=True, editable=False)
+
     objects = AreaManager()
 
     class Meta:
@@ -272,7 +549,7 @@ class Area(models.Model):
         name = self.name or '(unknown)'
         return '%s %s' % (self.type.code, name)
 
-    def as_dict(self, all_names=None):
+    def as_dict(self, all_names=None, extent=False):
         all_names = all_names or []
         out = {
             'id': self.id,
@@ -290,6 +567,28 @@ class Area(models.Model):
         countries = self.all_m2m_countries
         if countries:
             out['countries'] = countries
+        if extent:
+            out['extent'] = self.extent_dict()
+        return out
+
+    def extent_dict(self):
+        """The stored bounding box, centre, number of points and area of the
+        area's polygons, or None if it has none. The WGS84 bounds are those
+        of the transformed bounding box."""
+        if self.bbox is None:
+            return None
+        out = {'points': self.point_count}
+        if settings.MAPIT_AREA_SRID != 4326:
+            out['srid_en'] = settings.MAPIT_AREA_SRID
+            out['area'] = self.total_area
+            out['min_e'], out['min_n'], out['max_e'], out['max_n'] = self.bbox.extent
+            out['centre_e'], out['centre_n'] = self.centroid.coords
+            bbox = self.bbox.transform(4326, clone=True)
+            centroid = self.centroid.transform(4326, clone=True)
+        else:
+            bbox, centroid = self.bbox, self.centroid
+        out['min_lon'], out['min_lat'], out['max_lon'], out['max_lat'] = bbox.extent
+        out['centre_lon'], out['centre_lat'] = centroid.coords
         return out
 
     def list_countries(self):
@@ -333,10 +632,9 @@ class Area(models.Model):
         something else goes wrong with the spatial transform, then a
         TransformError exception is raised.
         """
-        all_polygons = self.polygons.all()
-        if len(all_polygons) == 0:
+        if not self.polygons.exists():
             return (None, None)
-        serialiser = GeometrySerialiser(self, srid, simplify_tolerance)
+        serialiser = get_serialiser(self, srid, simplify_tolerance)
         if export_format == 'kml':
             out, content_type = serialiser.kml(kml_type, line_colour, fill_colour)
         elif export_format in ('json', 'geojson'):
@@ -346,10 +644,65 @@ class Area(models.Model):
         return (out, content_type)
 
 
+class GeometryManager(models.Manager):
+    def replace(self, polygons):
+        """polygons is a list of (Area, list of polygons as WKB) pairs; replace
+        each area's polygons with those given. This has the same effect as
+        deleting each area's polygons and saving new ones, but copies them
+        all into the database at once and subdivides them in one query."""
+        areas = {}
+        for area, wkbs in polygons:
+            areas.setdefault(area.id, (area, []))[1].extend(wkbs)
+        if not areas:
+            return
+        area_ids = list(areas)
+
+        lines = (
+            ('%d\t\\\\x%s\n' % (area_id, bytes(wkb).hex())).encode()
+            for area_id, (area, wkbs) in areas.items() for wkb in wkbs)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('CREATE TEMPORARY TABLE mapit_geometry_new (area_id integer, polygon bytea)')
+            cursor.copy_expert('COPY mapit_geometry_new (area_id, polygon) FROM STDIN', iterable_to_stream(lines))
+            cursor.execute('''DELETE FROM mapit_geometrysubdivided WHERE geometry_id IN (
+                SELECT id FROM mapit_geometry WHERE area_id = ANY(%s))''', [area_ids])
+            cursor.execute('DELETE FROM mapit_geometry WHERE area_id = ANY(%s)', [area_ids])
+            cursor.execute('''INSERT INTO mapit_geometry (area_id, polygon)
+                SELECT area_id, ST_GeomFromWKB(polygon, %s) FROM mapit_geometry_new''', [settings.MAPIT_AREA_SRID])
+            cursor.execute('''INSERT INTO mapit_geometrysubdivided (geometry_id, division)
+                SELECT id, ST_Subdivide(polygon) FROM mapit_geometry WHERE area_id = ANY(%s)''', [area_ids])
+            cursor.execute('DROP TABLE mapit_geometry_new')
+            self.polygons_changed([area for area, wkbs in areas.values()])
+
+    def polygons_changed(self, areas):
+        """Bring everything derived from the polygons of the given areas up
+        to date: their stored extents (on the Area objects given, too), any
+        simplified polygons, precomputed relations and postcode areas, and
+        the caches. This is done once for each area, so should be called
+        after all of an area's polygons have been changed, not for each."""
+        areas = dict((area.id, area) for area in areas)
+        area_ids = list(areas)
+        with transaction.atomic():
+            GeometrySimplified.objects.filter(area__in=area_ids).delete()
+            Area.objects.update_extent(area_ids)
+            extents = Area.objects.filter(id__in=area_ids).values_list(
+                'id', 'bbox', 'centroid', 'point_count', 'total_area')
+            for id, bbox, centroid, point_count, total_area in extents:
+                area = areas[id]
+                area.bbox, area.centroid, area.point_count, area.total_area = bbox, centroid, point_count, total_area
+            for area in areas.values():
+                PostcodeMembershipBuild.objects.invalidate(area)
+                AreaRelationBuild.objects.invalidate(area)
+                geometry_cache.invalidate(area.id)
+        # Results of intersection queries may change
+        area_cache.bump()
+
+
 class Geometry(models.Model):
     area = models.ForeignKey(Area, related_name='polygons', on_delete=models.CASCADE)
     polygon = models.PolygonField(srid=settings.MAPIT_AREA_SRID)
 
+    objects = GeometryManager()
+
     class Meta:
         verbose_name_plural = 'geometries'
 
@@ -357,11 +710,17 @@ class Geometry(models.Model):
         return '%s, polygon %s' % (smart_str(self.area), self.id)
 
     def save(self, *args, **kwargs):
+        # This updates the area's extent, and everything else derived from its
+        # polygons, for every polygon saved; to add several polygons to an
+        # area, use Geometry.objects.replace (or save_polygons) instead.
         super().save(*args, **kwargs)
         GeometrySubdivided.objects.filter(geometry=self).delete()
         with connection.cursor() as cursor:
             cursor.execute('''INSERT INTO mapit_geometrysubdivided (geometry_id, division)
                 SELECT id,ST_Subdivide(polygon) FROM mapit_geometry WHERE id = %s''', [self.id])
+        # The area's stored extent is set on it too, so that saving the area
+        # afterwards does not overwrite it
+        Geometry.objects.polygons_changed([self.area])
 
 
 class GeometrySubdivided(models.Model):
@@ -375,6 +734,106 @@ class GeometrySubdivided(models.Model):
         return '%s, subdivision %s' % (smart_str(self.geometry), self.id)
 
 
+def as_multipolygon(geometry):
+    """Return the polygons in a Shapely geometry as a MultiPolygon, or None
+    if there are none."""
+    polygons = []
+    for part in shapely.get_parts(geometry):
+        if part.geom_type == 'Polygon' and not part.is_empty:
+            polygons.append(part)
+        elif part.geom_type == 'MultiPolygon':
+            polygons.extend(p for p in shapely.get_parts(part) if not p.is_empty)
+    if not polygons:
+        return None
+    return shapely.MultiPolygon(polygons)
+
+
+class GeometrySimplifiedManager(models.Manager):
+    def build(self, areas, tolerances):
+        """Store simplified versions of the polygons of the given areas at
+        each tolerance. Areas of the same type are simplified together, so
+        that boundaries they share stay shared, if they form a valid coverage
+        (no overlaps) and the installed GEOS supports it; otherwise each area
+        is simplified on its own. The areas should all be in one generation.
+        Returns the number of levels stored."""
+        count = 0
+        areas = areas.order_by('type_id', 'id').values_list('type_id', 'id')
+        for type_id, group in itertools.groupby(areas, lambda row: row[0]):
+            count += self._build_type([area_id for _, area_id in group], tolerances)
+        return count
+
+    def _build_type(self, area_ids, tolerances):
+        with connection.cursor() as cursor:
+            cursor.execute('''
+SELECT area_id, ST_AsBinary(ST_Transform(ST_Collect(polygon ORDER BY id), 4326))
+FROM mapit_geometry WHERE area_id = ANY(%s) GROUP BY area_id ORDER BY area_id''', [area_ids])
+            rows = cursor.fetchall()
+        self.filter(area__in=area_ids).delete()
+        if not rows:
+            return 0
+        ids = [area_id for area_id, _ in rows]
+        geometries = shapely.from_wkb([bytes(wkb) for _, wkb in rows])
+
+        try:
+            coverage = bool(shapely.coverage_is_valid(geometries))
+        except (AttributeError, shapely.errors.UnsupportedGEOSVersionError):
+            # Needs Shapely 2.1 and GEOS 3.12
+            coverage = False
+        levels = []
+        for tolerance in tolerances:
+            if coverage:
+                simplified = shapely.coverage_simplify(geometries, tolerance)
+            else:
+                simplified = shapely.simplify(geometries, tolerance, preserve_topology=True)
+            for area_id, geometry in zip(ids, simplified):
+                geometry = as_multipolygon(geometry)
+                if geometry is not None:
+                    levels.append(GeometrySimplified(
+                        area_id=area_id, tolerance=tolerance,
+                        polygon=GEOSGeometry(shapely.to_wkb(geometry), srid=4326)))
+
+        self.bulk_create(levels, batch_size=1000)
+        for area_id in area_ids:
+            geometry_cache.invalidate(area_id)
+        return len(levels)
+
+    def nearest(self, area_ids, tolerance):
+        """Return a dict of area ID to the stored simplified polygons (in SRID
+        4326) with the tolerance nearest to that given, for those areas with
+        a level within a factor of two of it."""
+        nearest = {}
+        levels = self.filter(area__in=area_ids, tolerance__gte=tolerance / 2, tolerance__lte=tolerance * 2)
+        for id, area_id, level in levels.values_list('id', 'area_id', 'tolerance'):
+            distance = abs(math.log(level / tolerance))
+            if area_id not in nearest or distance < nearest[area_id][1]:
+                nearest[area_id] = (id, distance)
+        if not nearest:
+            return {}
+        levels = self.filter(id__in=[id for id, _ in nearest.values()])
+        return dict(levels.values_list('area_id', 'polygon'))
+
+
+class GeometrySimplified(models.Model):
+
+    # Simplified versions of an area's polygons, made at import time with the
+    # --simplify_levels option, for serving requests with a simplify_tolerance
+    # in SRID 4326 without simplifying on every request. They are made across
+    # all the areas of a type together, so neighbouring areas still meet.
+
+    area = models.ForeignKey(Area, related_name='simplified', on_delete=models.CASCADE)
+    tolerance = models.FloatField()
+    polygon = models.MultiPolygonField(srid=4326)
+
+    objects = GeometrySimplifiedManager()
+
+    class Meta:
+        verbose_name_plural = 'simplified geometries'
+        unique_together = ('area', 'tolerance')
+
+    def __str__(self):
+        return '%s, simplified to %s' % (smart_str(self.area), self.tolerance)
+
+
 class NameType(TypeModel):
 
     # Name types are for storing different types of names. This could have
@@ -459,16 +918,69 @@ SELECT "mapit_postcode"."id", "mapit_postcode"."postcode", "mapit_postcode"."loc
 ''' % (materialized(), polygons, limit)
         return self.raw(query, params=[area.id])
 
+    def update_uk_grid(self):
+        """Store the easting and northing of each of these postcodes with a
+        location, in the Irish grid for Northern Ireland and the British
+        grid elsewhere. Returns the number of postcodes updated."""
+        sql, params = self.filter(location__isnull=False).values('id').query.sql_with_params()
+        query = '''
+UPDATE mapit_postcode SET easting = round(ST_X(grid.location)), northing = round(ST_Y(grid.location))
+FROM (
+    SELECT id, ST_Transform(location, CASE WHEN postcode LIKE 'BT%%' THEN 29902 ELSE 27700 END) AS location
+    FROM mapit_postcode WHERE id IN (%s)
+) grid
+WHERE mapit_postcode.id = grid.id
+''' % sql
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.rowcount
+
+    def fill_uk_grid(self, postcodes):
+        """Set the easting and northing of those of the given Postcodes with
+        a location but no stored grid co-ordinates (e.g. partial postcodes),
+        transforming all of them not already cached in one query."""
+        missing = [pc for pc in postcodes if pc.location and pc.easting is None]
+        keys = [(pc.location.srid or 4326, pc.location[0], pc.location[1], pc.grid_srid) for pc in missing]
+        uncached = list(dict.fromkeys(key for key in keys if key[0] != key[3] and key not in uk_grid_cache))
+        if uncached:
+            with connection.cursor() as cursor:
+                cursor.execute('''
+SELECT ST_X(grid), ST_Y(grid) FROM (
+    SELECT ST_Transform(ST_SetSRID(ST_MakePoint(x, y), srid), grid_srid) AS grid, n
+    FROM unnest(%s::int[], %s::float8[], %s::float8[], %s::int[]) WITH ORDINALITY AS p(srid, x, y, grid_srid, n)
+) points ORDER BY n''', [list(column) for column in zip(*uncached)])
+                if len(uk_grid_cache) + len(uncached) > UK_GRID_CACHE_SIZE:
+                    uk_grid_cache.clear()
+                for key, (x, y) in zip(uncached, cursor.fetchall()):
+                    uk_grid_cache[key] = (str2int(x), str2int(y))
+        for pc, key in zip(missing, keys):
+            if key[0] == key[3]:
+                pc.easting, pc.northing = str2int(key[1]), str2int(key[2])
+            else:
+                pc.easting, pc.northing = uk_grid_cache[key]
+
 
 def str2int(s):
     return int(round(float(s)))
 
 
+# A per-worker cache of grid co-ordinates computed by fill_uk_grid, keyed on
+# (from SRID, x, y, to SRID), emptied whenever it grows past this size.
+uk_grid_cache = {}
+UK_GRID_CACHE_SIZE = 10000
+
+
 class Postcode(models.Model):
     postcode = models.CharField(max_length=7, db_index=True, unique=True)
     location = models.PointField(null=True)
     # Will hopefully use PostGIS point-in-polygon tests, but if we don't have the polygons...
     areas = models.ManyToManyField(Area, related_name='postcodes', blank=True)
+    # A hash of the source data last imported, so unchanged rows can be skipped
+    source_hash = models.CharField(max_length=32, blank=True, editable=False)
+    # The location in the British (or, in Northern Ireland, Irish) grid, as
+    # output in GB; stored on import to save transforming it every request
+    easting = models.IntegerField(null=True, blank=True, editable=False)
+    northing = models.IntegerField(null=True, blank=True, editable=False)
 
     objects = PostcodeQuerySet.as_manager()
 
@@ -499,13 +1011,393 @@ class Postcode(models.Model):
             countries.augment_postcode(self, result)
         return result
 
+    @property
+    def grid_srid(self):
+        return 29902 if self.postcode[0:2] == 'BT' else 27700
+
     # Doing this via self.location.transform(27700/29902) can give incorrect results
-    # with some versions of GDAL. Via the database produces a correct result.
+    # with some versions of GDAL. Via the database produces a correct result, so
+    # if the grid co-ordinates are not stored, that is how they are found.
     def as_uk_grid(self):
-        cursor = connection.cursor()
-        srid = 29902 if self.postcode[0:2] == 'BT' else 27700
-        cursor.execute("SELECT ST_AsText(ST_Transform(ST_GeomFromText('POINT(%f %f)', 4326), %d))" % (
-            self.location[0], self.location[1], srid))
-        row = cursor.fetchone()
-        m = re.match(r'POINT\((.*?) (.*)\)', row[0])
-        return list(map(str2int, m.groups()))
+        if self.easting is None:
+            Postcode.objects.fill_uk_grid([self])
+        return [self.easting, self.northing]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Postcode, cls).from_db(db, field_names, values)
+        location = instance.__dict__.get('location')
+        instance._saved_location = location.clone() if location else None
+        return instance
+
+    def save(self, *args, **kwargs):
+        # A location set other than by a bulk import no longer matches the
+        # source data hashed, so must not be skipped by the next bulk import
+        if self.location != getattr(self, '_saved_location', None):
+            self.source_hash = ''
+        super(Postcode, self).save(*args, **kwargs)
+        self._saved_location = self.location.clone() if self.location else None
+
+
+class PostcodeImportManager(models.Manager):
+    def record(self, source, seen, unchanged=0, terminate=False, scope=None):
+        """Record a bulk import of postcodes, in the same transaction. The
+        temporary table mapit_postcode_changed (postcode, change) must list
+        each postcode the import created or updated, and the table seen
+        must have a postcode column listing every postcode in the source.
+        Any terminated postcode seen again is restored. If terminate is
+        True, every other postcode not seen (and matching the SQL condition
+        scope on mapit_postcode, if given) is marked as terminated. Returns
+        the new PostcodeImport."""
+        postcode_import = self.create(source=source, unchanged=unchanged)
+        params = {'import': postcode_import.id}
+        queries = ['''
+INSERT INTO mapit_postcodechange (postcode_import_id, postcode_id, change)
+SELECT DISTINCT %(import)s, mapit_postcode.id, changed.change
+FROM mapit_postcode_changed changed
+    JOIN mapit_postcode ON mapit_postcode.postcode = changed.postcode
+''', '''
+WITH restored AS (
+    DELETE FROM mapit_postcodeterminated
+    USING mapit_postcode
+    WHERE mapit_postcodeterminated.postcode_id = mapit_postcode.id
+        AND mapit_postcode.postcode IN (SELECT postcode FROM %s)
+    RETURNING mapit_postcodeterminated.postcode_id
+)
+INSERT INTO mapit_postcodechange (postcode_import_id, postcode_id, change)
+SELECT %%(import)s, postcode_id, 'restored' FROM restored
+''' % seen]
+        if terminate:
+            queries.append('''
+WITH terminated AS (
+    INSERT INTO mapit_postcodeterminated (postcode_id, postcode_import_id)
+    SELECT mapit_postcode.id, %%(import)s
+    FROM mapit_postcode
+    WHERE NOT EXISTS (SELECT 1 FROM %s seen WHERE seen.postcode = mapit_postcode.postcode)
+        AND NOT EXISTS (SELECT 1 FROM mapit_postcodeterminated WHERE postcode_id = mapit_postcode.id)
+        AND %s
+    RETURNING postcode_id
+)
+INSERT INTO mapit_postcodechange (postcode_import_id, postcode_id, change)
+SELECT %%(import)s, postcode_id, 'terminated' FROM terminated
+''' % (seen, scope or 'true'))
+        with connection.cursor() as cursor:
+            for query in queries:
+                cursor.execute(query, params)
+        counts = postcode_import.changes.values('change').annotate(count=models.Count('id'))
+        for count in counts:
+            setattr(postcode_import, count['change'], count['count'])
+        postcode_import.save()
+        return postcode_import
+
+
+class PostcodeImport(models.Model):
+
+    # A record of each bulk postcode import, with a PostcodeChange for every
+    # postcode it changed, so that anything caching postcode lookups can
+    # find which ones to forget.
+
+    source = models.CharField(max_length=200)
+    imported = models.DateTimeField(auto_now_add=True)
+    created = models.IntegerField(default=0)
+    updated = models.IntegerField(default=0)
+    unchanged = models.IntegerField(default=0)
+    terminated = models.IntegerField(default=0)
+    restored = models.IntegerField(default=0)
+
+    objects = PostcodeImportManager()
+
+    class Meta:
+        ordering = ('-imported', '-id')
+
+    def __str__(self):
+        return '%s, %s (%d new, %d changed, %d same, %d terminated, %d restored)' % (
+            self.source, self.imported, self.created, self.updated, self.unchanged, self.terminated, self.restored)
+
+
+class PostcodeChange(models.Model):
+    CHANGES = (
+        ('created', 'created'),
+        ('updated', 'updated'),
+        ('terminated', 'terminated'),
+        ('restored', 'restored'),
+    )
+
+    postcode_import = models.ForeignKey(PostcodeImport, related_name='changes', on_delete=models.CASCADE)
+    postcode = models.ForeignKey(Postcode, related_name='changes', on_delete=models.CASCADE)
+    change = models.CharField(max_length=10, choices=CHANGES)
+
+    def __str__(self):
+        return '%s %s [%s]' % (self.postcode, self.change, self.postcode_import_id)
+
+
+class PostcodeTerminated(models.Model):
+
+    # Postcodes that have gone from the source are kept, so old links keep
+    # working, but are listed here until they reappear.
+
+    postcode = models.OneToOneField(Postcode, related_name='termination', on_delete=models.CASCADE)
+    postcode_import = models.ForeignKey(
+        PostcodeImport, related_name='terminations', null=True, on_delete=models.SET_NULL)
+
+    class Meta:
+        verbose_name_plural = 'terminated postcodes'
+
+    def __str__(self):
+        return '%s (terminated)' % self.postcode
+
+
+class PostcodeMembershipBuildManager(models.Manager):
+    def invalidate(self, area=None):
+        """Mark precomputed postcode areas as out of date, either for the
+        generations an area is in, or (if no area is given) for all
+        generations. The rows are left until the next build."""
+        builds = self.get_queryset()
+        if area is not None:
+            if area.generation_low_id is None or area.generation_high_id is None:
+                return
+            builds = builds.filter(
+                generation__gte=area.generation_low_id, generation__lte=area.generation_high_id)
+        builds.delete()
+
+    def invalidate_generations(self, ranges):
+        """Mark precomputed postcode areas as out of date for every
+        generation in the given (low, high) ranges of generation IDs."""
+        q = Q()
+        for low, high in ranges:
+            q |= Q(generation__gte=low, generation__lte=high)
+        if q:
+            self.filter(q).delete()
+
+
+class PostcodeMembershipBuild(models.Model):
+
+    # Postcode lookups normally find their areas with a point-in-polygon
+    # query, but the answer only changes when polygons or postcodes do. The
+    # mapit_postcode_membership_build command stores every postcode's areas
+    # for a generation in PostcodeMembership, and records that it has done
+    # so here; while this record exists, postcode lookups in that generation
+    # use the stored rows. Changing polygons, importing postcodes or moving
+    # areas into or out of the generation removes the record, so the stored
+    # rows are not used until they are rebuilt.
+
+    generation = models.OneToOneField(
+        Generation, related_name='postcode_membership_build', on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = PostcodeMembershipBuildManager()
+
+    def __str__(self):
+        return 'Postcode areas for %s, built %s' % (self.generation, self.created)
+
+
+class PostcodeMembershipManager(models.Manager):
+    def build(self, generation, low, high):
+        """Store the areas in the given generation containing each postcode
+        with an ID from low up to (but not including) high, found either by
+        location or by the postcode's own areas. Returns the number of rows
+        created."""
+        query = '''
+INSERT INTO mapit_postcodemembership (generation_id, postcode_id, area_id)
+WITH locations AS %s (
+    SELECT id, ST_Transform(location, %%(srid)s) AS location
+    FROM mapit_postcode
+    WHERE id >= %%(low)s AND id < %%(high)s AND location IS NOT NULL
+)
+SELECT %%(generation)s, locations.id, mapit_area.id
+FROM locations
+    JOIN mapit_geometrysubdivided ON ST_Covers(mapit_geometrysubdivided.division, locations.location)
+    JOIN mapit_geometry ON mapit_geometrysubdivided.geometry_id = mapit_geometry.id
+    JOIN mapit_area ON mapit_geometry.area_id = mapit_area.id
+WHERE mapit_area.generation_low_id <= %%(generation)s AND mapit_area.generation_high_id >= %%(generation)s
+UNION
+SELECT %%(generation)s, postcode_areas.postcode_id, mapit_area.id
+FROM %s postcode_areas
+    JOIN mapit_area ON postcode_areas.area_id = mapit_area.id
+WHERE postcode_areas.postcode_id >= %%(low)s AND postcode_areas.postcode_id < %%(high)s
+    AND mapit_area.generation_low_id <= %%(generation)s AND mapit_area.generation_high_id >= %%(generation)s
+''' % (materialized(), Postcode.areas.through._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(query, {
+                'srid': settings.MAPIT_AREA_SRID, 'generation': generation, 'low': low, 'high': high})
+            return cursor.rowcount
+
+
+class PostcodeMembership(models.Model):
+    generation = models.ForeignKey(Generation, related_name='postcode_memberships', on_delete=models.CASCADE)
+    postcode = models.ForeignKey(Postcode, related_name='memberships', on_delete=models.CASCADE)
+    area = models.ForeignKey(Area, related_name='postcode_memberships', on_delete=models.CASCADE)
+
+    objects = PostcodeMembershipManager()
+
+    class Meta:
+        unique_together = ('generation', 'postcode', 'area')
+
+    def __str__(self):
+        return '%s in %s [%s]' % (self.postcode, smart_str(self.area), self.generation_id)
+
+
+class AreaRelationBuildManager(models.Manager):
+    def fresh(self, generation):
+        """Whether the relations between areas in a generation have been
+        built, and no area has changed since."""
+        return self.filter(generation=generation, stale__isnull=True).exists()
+
+    def invalidate(self, area):
+        """Mark an area's relations as out of date in any built generation
+        it is in, until the next refresh."""
+        if area.generation_low_id is None or area.generation_high_id is None:
+            return
+        builds = self.filter(generation__gte=area.generation_low_id, generation__lte=area.generation_high_id)
+        for build in builds:
+            build.stale.add(area)
+
+    def invalidate_generations(self, ranges):
+        """Mark areas' relations as out of date in any built generation in
+        their (low, high) ranges of generation IDs, given as a dict of area
+        ID to a list of ranges, until the next refresh."""
+        for build in self.all():
+            area_ids = [
+                id for id, area_ranges in ranges.items()
+                if any(low <= build.generation_id <= high for low, high in area_ranges)]
+            if area_ids:
+                build.stale.add(*area_ids)
+
+    def refresh(self):
+        """Recompute the relations of every area marked out of date, in
+        each built generation. Returns the number of rows created."""
+        total = 0
+        for build in self.filter(stale__isnull=False).distinct():
+            area_ids = list(build.stale.values_list('id', flat=True))
+            AreaRelation.objects.filter(generation=build.generation_id).filter(
+                Q(area__in=area_ids) | Q(other__in=area_ids)).delete()
+            total += AreaRelation.objects.build(build.generation_id, area_ids)
+            build.stale.clear()
+        return total
+
+
+class AreaRelationBuild(models.Model):
+
+    # The area touches, overlaps, covers and covered views normally run a
+    # spatial join, but the answer only changes when polygons do. The
+    # mapit_area_relation_build command stores every relation between areas
+    # in a generation in AreaRelation, and records that it has done so here;
+    # while this record exists and no area is listed as stale, those views
+    # use the stored rows. Changing an area's polygons, or moving it into or
+    # out of the generation, lists it as stale until the next refresh, which
+    # imports do when they finish.
+
+    generation = models.OneToOneField(Generation, related_name='area_relation_build', on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+    stale = models.ManyToManyField(Area, related_name='+', blank=True)
+
+    objects = AreaRelationBuildManager()
+
+    def __str__(self):
+        return 'Area relations for %s, built %s' % (self.generation, self.created)
+
+
+class AreaRelationManager(models.Manager):
+    def build(self, generation, area_ids=None):
+        """Store the relations between areas in the given generation, either
+        all of them, or only those involving the areas with the given IDs
+        (whose existing rows should have been removed first). As with
+        AreaManager.intersect, two areas are related if any pair of their
+        subdivisions is. Returns the number of rows created."""
+        params = {'generation': generation, 'area_ids': area_ids}
+        query_changed = ''
+        query_mirror = ''
+        if area_ids is not None:
+            query_changed = 'AND mapit_area.id = ANY(%(area_ids)s)'
+            # Relations found from the changed areas also give the relations
+            # of the areas they meet the other way round
+            query_mirror = '''
+UNION
+SELECT %(generation)s, other_id, area_id,
+    CASE relation WHEN 'covers' THEN 'coveredby' WHEN 'coveredby' THEN 'covers' ELSE relation END
+FROM relations
+WHERE NOT other_id = ANY(%(area_ids)s)
+'''
+        query = '''
+INSERT INTO mapit_arearelation (generation_id, area_id, other_id, relation)
+WITH changed AS %s (
+    SELECT mapit_geometry.area_id, mapit_geometrysubdivided.division
+    FROM mapit_area
+        JOIN mapit_geometry ON mapit_geometry.area_id = mapit_area.id
+        JOIN mapit_geometrysubdivided ON mapit_geometrysubdivided.geometry_id = mapit_geometry.id
+    WHERE mapit_area.generation_low_id <= %%(generation)s AND mapit_area.generation_high_id >= %%(generation)s
+        %s
+),
+relations AS %s (
+    SELECT DISTINCT changed.area_id, geometry.area_id AS other_id, relation.name AS relation
+    FROM changed
+        JOIN mapit_geometrysubdivided geometry_sd ON geometry_sd.division && changed.division
+        JOIN mapit_geometry geometry ON geometry_sd.geometry_id = geometry.id
+        JOIN mapit_area ON geometry.area_id = mapit_area.id
+        CROSS JOIN LATERAL (VALUES
+            ('touches', ST_Touches(geometry_sd.division, changed.division)),
+            ('overlaps', ST_Overlaps(geometry_sd.division, changed.division)),
+            ('covers', ST_Covers(geometry_sd.division, changed.division)),
+            ('coveredby', ST_CoveredBy(geometry_sd.division, changed.division))
+        ) relation (name, holds)
+    WHERE mapit_area.generation_low_id <= %%(generation)s AND mapit_area.generation_high_id >= %%(generation)s
+        AND geometry.area_id != changed.area_id
+        AND relation.holds
+)
+SELECT %%(generation)s, area_id, other_id, relation
+FROM relations
+%s
+''' % (materialized(), query_changed, materialized(), query_mirror)
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.rowcount
+
+    def related_ids(self, query_type, area, types, generation):
+        """As AreaManager.intersect_ids, from the stored relations."""
+        if 'intersects' in query_type:
+            # Two polygons that intersect must do one of these
+            query_type = [relation for relation, label in AreaRelation.RELATIONS]
+        relations = self.filter(generation=generation, area=area, relation__in=query_type)
+        if types:
+            relations = relations.filter(other__type__code__in=types)
+        return set(relations.values_list('other_id', flat=True))
+
+
+class AreaRelation(models.Model):
+    RELATIONS = (
+        ('touches', 'touches'),
+        ('overlaps', 'overlaps'),
+        ('covers', 'covers'),
+        ('coveredby', 'is covered by'),
+    )
+
+    # other (relation) area, as in ST_<relation>(other, area)
+    generation = models.ForeignKey(Generation, related_name='area_relations', on_delete=models.CASCADE)
+    area = models.ForeignKey(Area, related_name='relations', on_delete=models.CASCADE)
+    other = models.ForeignKey(Area, related_name='+', on_delete=models.CASCADE)
+    relation = models.CharField(max_length=10, choices=RELATIONS)
+
+    objects = AreaRelationManager()
+
+    class Meta:
+        unique_together = ('generation', 'area', 'relation', 'other')
+
+    def __str__(self):
+        return '%s %s %s [%s]' % (
+            smart_str(self.other), self.get_relation_display(), smart_str(self.area), self.generation_id)
+
+
+def bump_area_cache(sender, **kwargs):
+    """Mark every worker's cached area output, and the cached results of
+    intersection queries, as out of date whenever anything they are made
+    from is saved or deleted, however that is done."""
+    if kwargs.get('action', 'post_').startswith('post_'):
+        area_cache.bump()
+
+
+# Which generation is current, as well as the areas themselves, affects what
+# is output for areas
+for model in (Generation, Area, Geometry, Name, NameType, Code, CodeType, Type, Country):
+    post_save.connect(bump_area_cache, sender=model, dispatch_uid='area-cache-save-%s' % model.__name__)
+    post_delete.connect(bump_area_cache, sender=model, dispatch_uid='area-cache-delete-%s' % model.__name__)
+m2m_changed.connect(bump_area_cache, sender=Area.countries.through, dispatch_uid='area-cache-countries')
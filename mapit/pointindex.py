@@ -0,0 +1,111 @@
+# An optional in-process spatial index of the subdivided polygons of one
+# generation, so that point lookups can be answered without a spatial query.
+#
+# Turn it on with the POINT_INDEX configuration option. The first point
+# lookup in each worker process loads every GeometrySubdivided row for the
+# current generation into a Shapely STRtree of prepared polygons; later
+# lookups only touch the database to fetch the matching Area rows. The index
+# is rebuilt automatically when a different generation becomes current, or
+# when the polygons of the current one are changed in place, which is noticed
+# through the version number of the area cache (see areacache.py), and so
+# needs a cache shared between workers in the same way.
+
+import threading
+
+import numpy
+import shapely
+from django.conf import settings
+from django.db import connection
+
+from mapit.areacache import area_cache
+from mapit.models import Generation
+
+
+class PointIndexSnapshot(object):
+    """An immutable, loaded index for one generation, at one version of the
+    area cache."""
+
+    def __init__(self, generation, version, area_ids, divisions):
+        self.generation = generation
+        self.version = version
+        self.area_ids = numpy.array(area_ids, dtype=numpy.int64)
+        self.divisions = numpy.array(divisions, dtype=object)
+        shapely.prepare(self.divisions)
+        self.tree = shapely.STRtree(self.divisions)
+
+    def lookup(self, x, y, box=False):
+        point = shapely.Point(x, y)
+        candidates = self.tree.query(point)
+        if not box:
+            candidates = candidates[shapely.covers(self.divisions[candidates], point)]
+        return set(self.area_ids[candidates].tolist())
+
+
+class PointIndex(object):
+    fetch_size = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'MAPIT_POINT_INDEX', False)
+
+    def generation_for(self, request):
+        """If the index can answer this request, return the generation ID it
+        should be looked up in, otherwise None. Only lookups in a single
+        generation (the current one, or one given explicitly) can be used;
+        anything with min_generation or max_generation goes to the database."""
+        if not self.enabled:
+            return None
+        current = Generation.objects.current()
+        if not current or Generation.objects.requested(request) != current.id:
+            return None
+        return current.id
+
+    def get(self, generation):
+        version = area_cache.check()
+        snapshot = self.snapshot
+        if snapshot is not None and (snapshot.generation, snapshot.version) == (generation, version):
+            return snapshot
+        with self.lock:
+            # Another thread may have loaded it while we were waiting
+            snapshot = self.snapshot
+            if snapshot is None or (snapshot.generation, snapshot.version) != (generation, version):
+                self.snapshot = self.load(generation, version)
+            return self.snapshot
+
+    def load(self, generation, version):
+        area_ids = []
+        divisions = []
+        with connection.cursor() as cursor:
+            cursor.execute('''
+SELECT mapit_geometry.area_id, ST_AsBinary(mapit_geometrysubdivided.division)
+FROM mapit_geometrysubdivided
+    JOIN mapit_geometry ON mapit_geometrysubdivided.geometry_id = mapit_geometry.id
+    JOIN mapit_area ON mapit_geometry.area_id = mapit_area.id
+WHERE mapit_area.generation_low_id <= %s AND mapit_area.generation_high_id >= %s
+''', [generation, generation])
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                for area_id, division in rows:
+                    area_ids.append(area_id)
+                    divisions.append(shapely.from_wkb(bytes(division)))
+        return PointIndexSnapshot(generation, version, area_ids, divisions)
+
+    def lookup(self, location, generation, box=False):
+        """Return the set of IDs of areas in the given generation whose
+        subdivided polygons cover the location, which must be in the area
+        SRID. If box is true, only the bounding boxes of the subdivisions are
+        considered, as with a bbcovers query."""
+        return self.get(generation).lookup(location.x, location.y, box=box)
+
+    def clear(self):
+        with self.lock:
+            self.snapshot = None
+
+
+point_index = PointIndex()
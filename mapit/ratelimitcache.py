@@ -1,10 +1,15 @@
-from datetime import datetime, timedelta
+from collections import Counter, OrderedDict
 import functools
 import hashlib
+import threading
+import time
 
 from django.http import HttpResponseForbidden
 from django.core.cache import cache
 from django.conf import settings
+from django.db import connection
+
+from mapit.middleware.metrics import QueryCounter
 
 CONFIG = settings.MAPIT_RATE_LIMIT or {}
 if isinstance(CONFIG, list):
@@ -14,6 +19,10 @@ if isinstance(CONFIG, list):
     }
 _sentinel = object()
 
+# Counts of requests allowed and limited for each class of endpoint, and the
+# time spent checking them, in this process
+stats = Counter()
+
 
 def ratelimit(_f=_sentinel, **kwargs):
     if _f is _sentinel:
@@ -21,25 +30,132 @@ def ratelimit(_f=_sentinel, **kwargs):
     return RateLimiter()(_f)
 
 
+# Each backend adds the cost of requests (by default, one each) up in fixed
+# windows of the given length, and returns an estimate of the total in the
+# sliding window ending now: all of that in the current window, plus the
+# proportion of that in the previous one the sliding window still overlaps.
+
+def window_position(window):
+    now = time.time()
+    return int(now // window), (now % window) / window
+
+
+class CacheBackend(object):
+    """Counts in the Django cache, e.g. memcached. An atomic increment and a
+    fetch of the previous window's count."""
+
+    def hit(self, key, window, cost=1):
+        current, elapsed = window_position(window)
+        current_key = '%s-%d' % (key, current)
+        try:
+            count = cache.incr(current_key, cost)
+        except ValueError:
+            if cache.add(current_key, cost, window * 2):
+                count = cost
+            else:
+                count = cache.incr(current_key, cost)
+        previous = cache.get('%s-%d' % (key, current - 1), 0)
+        return count + previous * (1 - elapsed)
+
+
+class RedisBackend(object):
+    """Counts in Redis, in one round trip, by running a script that
+    increments the current window and fetches the previous one atomically."""
+
+    script = '''
+local count = redis.call('INCRBY', KEYS[1], ARGV[2])
+if count == tonumber(ARGV[2]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return {count, tonumber(redis.call('GET', KEYS[2]) or '0')}
+'''
+
+    def __init__(self, url):
+        import redis
+        self.hit_script = redis.Redis.from_url(url).register_script(self.script)
+
+    def hit(self, key, window, cost=1):
+        current, elapsed = window_position(window)
+        count, previous = self.hit_script(
+            keys=['%s-%d' % (key, current), '%s-%d' % (key, current - 1)], args=[window * 2, cost])
+        return count + previous * (1 - elapsed)
+
+
+class LocalBackend(object):
+    """Counts in this process's memory, so each worker has its own limit,
+    with no round trip at all."""
+
+    maximum = 100000  # Clients remembered at most
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # In order of when each client was last seen, so those not seen for
+        # longest, starting with any whose windows have expired, are
+        # forgotten first
+        self.counts = OrderedDict()
+
+    def hit(self, key, window, cost=1):
+        current, elapsed = window_position(window)
+        now = time.time()
+        with self.lock:
+            start, previous, count, expires = self.counts.pop(key, (current, 0, 0, 0))
+            if start != current:
+                previous = count if start == current - 1 else 0
+                count = 0
+            count += cost
+            # Once the window after this one has passed, nothing is left
+            self.counts[key] = (current, previous, count, (current + 2) * window)
+            while self.counts:
+                expires = next(iter(self.counts.values()))[3]
+                if len(self.counts) <= self.maximum and expires > now:
+                    break
+                self.counts.popitem(last=False)
+        return count + previous * (1 - elapsed)
+
+
+@functools.lru_cache()
+def get_backend():
+    backend = CONFIG.get('backend', 'cache')
+    if backend == 'redis':
+        return RedisBackend(CONFIG.get('redis_url', 'redis://localhost:6379/0'))
+    elif backend == 'local':
+        return LocalBackend()
+    return CacheBackend()
+
+
 class RateLimiter(object):
     "Instances of this class can be used as decorators"
     # This class is designed to be sub-classed
     minutes = CONFIG.get('minutes', 3)  # The time period
-    requests = CONFIG.get('requests', 100)  # Number of allowed requests in that time period
+    requests = CONFIG.get('requests', 100)  # Total cost of requests allowed in that time period
+    # What each request costs; expensive views are given a higher cost, which
+    # can be overridden by view function name in the costs configuration
+    cost = 1
+    # If set, each request is also charged this much per second of CPU and
+    # database time it took, once it has been made
+    cost_per_second = CONFIG.get('cost_per_second', 0)
     # IP addresses or user agents that aren't rate limited
     excluded_ips = CONFIG.get('ips', [])
     excluded_uas = CONFIG.get('user_agents', [])
     excluded_fns = CONFIG.get('functions', [])
+    # The class of endpoint, which can be given its own minutes and requests
+    # in the classes part of the configuration, and is counted separately
+    rate_class = 'default'
+    backend = None  # Where requests are counted; by default, as configured
 
     prefix = 'rl-'  # Prefix for memcache key
 
     def __init__(self, **options):
         for key, value in options.items():
             setattr(self, key, value)
+        for key, value in CONFIG.get('classes', {}).get(self.rate_class, {}).items():
+            if key in ('minutes', 'requests'):
+                setattr(self, key, value)
 
     def __call__(self, fn):
         if fn.__name__ in self.excluded_fns:
             return fn
+        self.cost = CONFIG.get('costs', {}).get(fn.__name__, self.cost)
 
         def wrapper(request, *args, **kwargs):
             return self.view_wrapper(request, fn, *args, **kwargs)
@@ -58,54 +174,63 @@ class RateLimiter(object):
         # If we're using the DummyCache backend then no data will
         # actually be stored in the cache, and as a result cache.incr
         # for a key will fail even immediately after cache.add.
+        backend = self.backend or get_backend()
         cache_backend = settings.CACHES['default']['BACKEND']
-        if cache_backend == 'django.core.cache.backends.dummy.DummyCache':
+        if isinstance(backend, CacheBackend) and cache_backend == 'django.core.cache.backends.dummy.DummyCache':
             return fn(request, *args, **kwargs)
 
-        counts = self.get_counters(request).values()
-
-        # Increment rate limiting counter
-        self.cache_incr(self.current_key(request))
-
-        # Have they failed?
-        if sum(int(c) for c in counts) >= self.requests:
+        # Charge for this request, and see if they have gone over
+        key = self.key(request)
+        start = time.perf_counter()
+        count = backend.hit(key, self.minutes * 60, self.cost)
+        stats[self.rate_class, 'seconds'] += time.perf_counter() - start
+        if count > self.requests:
+            stats[self.rate_class, 'limited'] += 1
             return self.disallowed(request)
+        stats[self.rate_class, 'allowed'] += 1
+        stats[self.rate_class, 'cost'] += self.cost
 
-        return fn(request, *args, **kwargs)
+        if not self.cost_per_second:
+            return fn(request, *args, **kwargs)
 
-    def cache_get_many(self, keys):
-        return cache.get_many(keys)
+        # Charge again for the time the request took, for their next ones
+        timer = QueryCounter()
+        cpu = time.thread_time()
+        with connection.execute_wrapper(timer):
+            response = fn(request, *args, **kwargs)
+        seconds = time.thread_time() - cpu
+        if response.streaming:
+            # Streamed output is generated, and queried for, as it is sent,
+            # so that is charged for too once it has been
+            response.streaming_content = self.charge_streamed(
+                response.streaming_content, backend, key, timer, seconds)
+        else:
+            self.charge(backend, key, seconds + timer.seconds)
+        return response
 
-    def cache_incr(self, key):
+    def charge(self, backend, key, seconds):
+        cost = int(seconds * self.cost_per_second)
+        if cost:
+            backend.hit(key, self.minutes * 60, cost)
+            stats[self.rate_class, 'cost'] += cost
+
+    def charge_streamed(self, content, backend, key, timer, seconds):
         try:
-            cache.incr(key)
-        except ValueError:
-            cache.add(key, 0, self.expire_after())
-            cache.incr(key)
+            with connection.execute_wrapper(timer):
+                cpu = time.thread_time()
+                for chunk in content:
+                    seconds += time.thread_time() - cpu
+                    yield chunk
+                    cpu = time.thread_time()
+                seconds += time.thread_time() - cpu
+        finally:
+            self.charge(backend, key, seconds + timer.seconds)
 
     def should_ratelimit(self, request):
         return len(settings.MAPIT_RATE_LIMIT)
 
-    def get_counters(self, request):
-        return self.cache_get_many(self.keys_to_check(request))
-
-    def keys_to_check(self, request):
-        extra = self.key_extra(request)
-        now = datetime.now()
-        return [
-            '%s%s-%s' % (
-                self.prefix,
-                extra,
-                (now - timedelta(minutes=minute)).strftime('%Y%m%d%H%M')
-            ) for minute in range(self.minutes + 1)
-        ]
-
-    def current_key(self, request):
-        return '%s%s-%s' % (
-            self.prefix,
-            self.key_extra(request),
-            datetime.now().strftime('%Y%m%d%H%M')
-        )
+    def key(self, request):
+        return '%s%s-%s' % (self.prefix, self.rate_class, self.key_extra(request))
 
     def key_extra(self, request):
         # By default, their IP address is used
@@ -115,10 +240,6 @@ class RateLimiter(object):
         "Over-ride this method if you want to log incidents"
         return HttpResponseForbidden('Rate limit exceeded')
 
-    def expire_after(self):
-        "Used for setting the memcached cache expiry"
-        return (self.minutes + 1) * 60
-
 
 class ratelimit_post(RateLimiter):
     "Rate limit POSTs - can be used to protect a login form"
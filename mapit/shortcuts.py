@@ -75,7 +75,11 @@ def output_json(out, code=200):
 
 
 def output_polygon(content_type, output):
-    response = http.HttpResponse(content_type='%s; charset=utf-8' % content_type)
+    # output is either a string, or an iterator of strings to be streamed
+    if isinstance(output, str):
+        response = http.HttpResponse(output, content_type='%s; charset=utf-8' % content_type)
+    else:
+        response = http.StreamingHttpResponse(output, content_type='%s; charset=utf-8' % content_type)
     response['Access-Control-Allow-Origin'] = '*'
 
     # HACK: Some polygons are too large to store in memcached.
@@ -85,7 +89,6 @@ def output_polygon(content_type, output):
     # 2419200 is 4 weeks.
     response['Cache-Control'] = 's-maxage=2419200, max-age=0'
 
-    response.write(output)
     return response
 
 
@@ -0,0 +1,100 @@
+# Logs the plans of database queries, in the spatial lookups, that take
+# longer than SLOW_QUERY_SECONDS, so that there is a history to compare
+# against when something (such as a PostGIS upgrade) slows them down.
+#
+# A fraction (SLOW_QUERY_SAMPLE) of the slow queries are run again with
+# EXPLAIN (ANALYZE, BUFFERS), and the plan logged, along with the query, its
+# parameters and the arguments of the view, to the mapit.slow_queries logger.
+# Queries cancelled by the statement timeout have their plan logged without
+# running them again. Running a query again doubles the time and database load
+# of those sampled, just when the query is already slow, so keep the sample
+# small on a busy server, or use PostgreSQL's auto_explain module instead.
+
+import functools
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+
+logger = logging.getLogger('mapit.slow_queries')
+
+
+class SlowQuerySampler(object):
+    """A database execute wrapper logging the plans of slow queries."""
+
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments
+        self.threshold = getattr(settings, 'MAPIT_SLOW_QUERY_SECONDS', 0)
+        self.sample = getattr(settings, 'MAPIT_SLOW_QUERY_SAMPLE', 0.1)
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            result = execute(sql, params, many, context)
+        except DatabaseError as e:
+            if not many and 'canceling statement due to statement timeout' in e.args[0]:
+                self.log(context['connection'], sql, params, time.perf_counter() - start, analyze=False)
+            raise
+        seconds = time.perf_counter() - start
+        if not many and seconds >= self.threshold and random.random() < self.sample:
+            self.log(context['connection'], sql, params, seconds, analyze=True)
+        return result
+
+    def log(self, connection, sql, params, seconds, analyze):
+        if connection.in_atomic_block and not analyze:
+            # The failed query has left the transaction unusable
+            plan = '(no plan, the transaction was aborted)'
+        else:
+            try:
+                plan = self.explain(connection, sql, params, analyze)
+            except DatabaseError as e:
+                plan = '(no plan: %s)' % e
+        logger.warning(
+            '%s query took %.3fs, arguments %r\n%s\nparameters %r\n%s',
+            self.name, seconds, self.arguments, sql, params, plan)
+
+    def explain(self, connection, sql, params, analyze):
+        # This uses the underlying connection, so as not to come back through
+        # here or disturb the cursor of the original query. EXPLAIN ANALYZE
+        # runs the query again, so it is rolled back in case it writes.
+        explain = 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+        start, end = ('SAVEPOINT mapit_explain', 'ROLLBACK TO SAVEPOINT mapit_explain') \
+            if connection.in_atomic_block else ('BEGIN', 'ROLLBACK')
+        with connection.wrap_database_errors, connection.connection.cursor() as cursor:
+            cursor.execute(start)
+            try:
+                cursor.execute(explain + sql, params)
+                return '\n'.join(row[0] for row in cursor.fetchall())
+            finally:
+                cursor.execute(end)
+
+
+def sample_slow_queries(fn):
+    """Decorate a view (or a function it calls) to log the plans of slow
+    queries it makes, if SLOW_QUERY_SECONDS is set. The queries of a streamed
+    response, made as its content is read, are included."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not getattr(settings, 'MAPIT_SLOW_QUERY_SECONDS', 0):
+            return fn(*args, **kwargs)
+        arguments = dict(kwargs, args=[arg for arg in args if isinstance(arg, (str, int, float))])
+        sampler = SlowQuerySampler(fn.__name__, arguments)
+        with connection.execute_wrapper(sampler):
+            response = fn(*args, **kwargs)
+        if getattr(response, 'streaming', False):
+            response.streaming_content = stream(response.streaming_content, sampler)
+        return response
+    return wrapper
+
+
+def stream(content, sampler):
+    content = iter(content)
+    while True:
+        with connection.execute_wrapper(sampler):
+            chunk = next(content, None)
+        if chunk is None:
+            return
+        yield chunk
@@ -331,3 +331,10 @@ class KMLSuccess(WithKML, Base):
         self.assertEqual(area.generation_low.id, generation().id)
         self.assertEqual(area.generation_high.id, generation().id)
         self.assertEqual(area.type.code, "BIG")
+
+
+class KMLJobsSuccess(KMLSuccess):
+    def parameters(self):
+        parameters = super().parameters()
+        parameters.jobs = 2
+        return parameters
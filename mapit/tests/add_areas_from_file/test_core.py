@@ -6,6 +6,7 @@ from .skeletons import (
     CodeTypeWithoutCode,
     CodeWithoutCodeType,
     CountryAndFromFirstLetter,
+    KMLJobsSuccess,
     KMLSuccess,
     MissingRequiredArguments,
     NameFieldAndOverride,
@@ -60,3 +61,7 @@ class NameFieldNotFoundTest(Executor, NameFieldNotFound, TestCase):
 
 class KMLSuccessTest(Executor, KMLSuccess, TestCase):
     pass
+
+
+class KMLJobsSuccessTest(Executor, KMLJobsSuccess, TestCase):
+    pass
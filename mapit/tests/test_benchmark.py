@@ -0,0 +1,49 @@
+import json
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from mapit import benchmark
+from mapit.models import Area, Postcode
+
+
+class BenchmarkTest(TestCase):
+    def setUp(self):
+        call_command(
+            'mapit_benchmark_fixtures', countries=2, councils=2, wards=2, output_areas=2, vertices=3,
+            postcodes=50, stdout=StringIO())
+
+    def test_fixtures(self):
+        self.assertEqual(benchmark.fixture_counts(), {
+            'BMCTY': 2, 'BMCOU': 8, 'BMWAR': 32, 'BMOA': 128, 'postcodes': 50})
+        self.assertEqual(len(set(benchmark.postcode(n) for n in range(10000))), 10000)
+
+        # Each level covers its parent exactly, with shared boundaries
+        for country in Area.objects.filter(type__code='BMCTY'):
+            polygon = country.polygons.get().polygon
+            for council in country.children.all():
+                self.assertTrue(polygon.covers(council.polygons.get().polygon))
+            self.assertAlmostEqual(
+                sum(council.polygons.get().polygon.area for council in country.children.all()) / polygon.area, 1)
+        ward = Area.objects.filter(type__code='BMWAR').first()
+        self.assertTrue(ward.polygons.get().polygon.valid)
+        self.assertEqual(ward.children.count(), 4)
+
+        postcode = Postcode.objects.get(postcode=benchmark.postcode(49))
+        self.assertTrue(benchmark.WEST <= postcode.location.x <= benchmark.EAST)
+
+    def test_run(self):
+        stdout, stderr = StringIO(), StringIO()
+        call_command(
+            'mapit_benchmark', requests=5, warmup=1,
+            endpoints=['areas_by_point', 'area_intersect', 'areas_by_type', 'area_polygon'],
+            stdout=stdout, stderr=stderr)
+        results = json.loads(stdout.getvalue())
+        self.assertEqual(results['fixtures']['BMWAR'], 32)
+        self.assertEqual(list(results['endpoints']), [
+            'areas_by_point', 'area_intersect', 'areas_by_type', 'area_polygon'])
+        for result in results['endpoints'].values():
+            self.assertEqual(result['requests'], 5)
+            self.assertEqual(result['errors'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
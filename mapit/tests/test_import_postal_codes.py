@@ -0,0 +1,80 @@
+import contextlib
+import os
+import tempfile
+from io import StringIO
+
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from mapit.models import Postcode, PostcodeImport, PostcodeTerminated
+
+
+@override_settings(MAPIT_COUNTRY='')
+class ImportPostalCodesTest(TestCase):
+    rows = [
+        'NEW1,51.5,-0.1',
+        'SAME,52.0,-1.0',
+        'MOVED,53.0,-2.0',
+        'NEW1,51.5,-0.1',
+        'NEW1,51.6,-0.1',
+    ]
+
+    def setUp(self):
+        Postcode.objects.create(postcode='SAME', location=Point(-1.0, 52.0, srid=4326))
+        Postcode.objects.create(postcode='MOVED', location=Point(-2.5, 53.0, srid=4326))
+
+    def import_file(self, **options):
+        fd, filename = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('\n'.join(self.rows) + '\n')
+        self.addCleanup(os.unlink, filename)
+        output = StringIO()
+        with contextlib.redirect_stdout(output):
+            call_command('mapit_import_postal_codes', filename, **options)
+        return output.getvalue()
+
+    def check_import(self, output):
+        self.assertEqual(output.strip(), 'Imported 5 (1 new, 2 changed, 2 same)')
+        self.assertEqual(Postcode.objects.count(), 3)
+        location = Postcode.objects.get(postcode='NEW1').location
+        self.assertEqual((round(location[0], 6), round(location[1], 6)), (-0.1, 51.6))
+        location = Postcode.objects.get(postcode='MOVED').location
+        self.assertEqual((round(location[0], 6), round(location[1], 6)), (-2.0, 53.0))
+
+    def test_import(self):
+        self.check_import(self.import_file())
+
+    def test_import_bulk(self):
+        self.check_import(self.import_file(bulk=True))
+
+    def test_import_bulk_after_row_import(self):
+        self.import_file(bulk=True)
+        original = self.rows
+        self.rows = ['MOVED,54.0,-2.0']
+        self.import_file()
+        self.assertEqual(Postcode.objects.get(postcode='MOVED').source_hash, '')
+
+        self.rows = original
+        self.import_file(bulk=True)
+        location = Postcode.objects.get(postcode='MOVED').location
+        self.assertEqual((round(location[0], 6), round(location[1], 6)), (-2.0, 53.0))
+
+    def test_import_bulk_terminate_missing(self):
+        self.import_file(bulk=True)
+        self.rows = ['NEW1,51.6,-0.1', 'SAME,52.0,-1.0']
+        self.import_file(bulk=True, **{'terminate-missing': True})
+
+        postcode_import = PostcodeImport.objects.first()
+        self.assertEqual(
+            (postcode_import.created, postcode_import.updated, postcode_import.unchanged,
+             postcode_import.terminated, postcode_import.restored), (0, 0, 2, 1, 0))
+        self.assertTrue(PostcodeTerminated.objects.filter(postcode__postcode='MOVED').exists())
+        self.assertEqual(
+            list(postcode_import.changes.values_list('postcode__postcode', 'change')), [('MOVED', 'terminated')])
+
+        self.rows = ['MOVED,53.0,-2.0']
+        self.import_file(bulk=True)
+        postcode_import = PostcodeImport.objects.first()
+        self.assertEqual((postcode_import.unchanged, postcode_import.restored), (1, 1))
+        self.assertFalse(PostcodeTerminated.objects.exists())
@@ -1,8 +1,10 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.test.client import RequestFactory
 from django import http
 
 from ..middleware import JSONPMiddleware
+from ..middleware.metrics import MetricsMiddleware, metrics
+from ..views.metrics import metrics as metrics_view
 
 
 class JSONPMiddlewareTest(TestCase):
@@ -49,3 +51,45 @@ class JSONPMiddlewareTest(TestCase):
         self.fake_response = http.HttpResponse(content="blah", content_type='application/json')
         middleware_response = self.middleware(request)
         self.assertEqual(middleware_response, self.fake_response)
+
+
+class MetricsMiddlewareTest(TestCase):
+
+    def setUp(self):
+        self.middleware = MetricsMiddleware(self.fake_get_response)
+        self.factory = RequestFactory()
+
+    def fake_get_response(self, request):
+        return self.fake_response
+
+    def test_records_response(self):
+        before = metrics.requests['render', 'none'], metrics.bytes['render']
+        self.fake_response = http.HttpResponse(content="blah")
+        self.middleware(self.factory.get("/"))
+        self.assertEqual(metrics.requests['render', 'none'], before[0] + 1)
+        self.assertEqual(metrics.bytes['render'], before[1] + 4)
+        self.assertIn('mapit_request_seconds_bucket{view="render",le="+Inf"}', metrics.render())
+
+    def test_records_streaming_response_once_sent(self):
+        before = metrics.requests['render', 'none'], metrics.bytes['render']
+        self.fake_response = http.StreamingHttpResponse(["bl", "ah"])
+        response = self.middleware(self.factory.get("/"))
+        self.assertEqual(metrics.requests['render', 'none'], before[0])
+        self.assertEqual(b''.join(response.streaming_content), b"blah")
+        self.assertEqual(metrics.requests['render', 'none'], before[0] + 1)
+        self.assertEqual(metrics.bytes['render'], before[1] + 4)
+
+    @override_settings(MAPIT_METRICS_IPS=['192.0.2.1'], MAPIT_METRICS_TOKEN='secret')
+    def test_metrics_view_restricted(self):
+        response = metrics_view(self.factory.get('/metrics', REMOTE_ADDR='192.0.2.1'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'mapit_requests_total', response.content)
+
+        response = metrics_view(self.factory.get('/metrics', REMOTE_ADDR='192.0.2.2'))
+        self.assertEqual(response.status_code, 403)
+        response = metrics_view(self.factory.get(
+            '/metrics', REMOTE_ADDR='192.0.2.2', HTTP_AUTHORIZATION='Bearer wrong'))
+        self.assertEqual(response.status_code, 403)
+        response = metrics_view(self.factory.get(
+            '/metrics', REMOTE_ADDR='192.0.2.2', HTTP_AUTHORIZATION='Bearer secret'))
+        self.assertEqual(response.status_code, 200)
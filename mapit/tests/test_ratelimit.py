@@ -0,0 +1,76 @@
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+
+from mapit.ratelimitcache import LocalBackend, RateLimiter, stats
+
+
+@override_settings(MAPIT_RATE_LIMIT={'minutes': 1, 'requests': 2})
+class RateLimitTest(TestCase):
+    def test_sliding_window(self):
+        limiter = RateLimiter(backend=LocalBackend(), requests=2, minutes=1, rate_class='test')
+        view = limiter(lambda request: HttpResponse('OK'))
+        factory = RequestFactory()
+        request = factory.get('/', REMOTE_ADDR='192.0.2.1')
+        other = factory.get('/', REMOTE_ADDR='192.0.2.2')
+
+        allowed, limited = stats['test', 'allowed'], stats['test', 'limited']
+        self.assertEqual(view(request).status_code, 200)
+        self.assertEqual(view(request).status_code, 200)
+        self.assertEqual(view(request).status_code, 403)
+        self.assertEqual(view(other).status_code, 200)
+        self.assertEqual(stats['test', 'allowed'] - allowed, 3)
+        self.assertEqual(stats['test', 'limited'] - limited, 1)
+
+    def test_previous_window(self):
+        backend = LocalBackend()
+        backend.counts['key'] = (0, 0, 10, 120)
+        # A long time later, the old window no longer counts
+        self.assertEqual(backend.hit('key', 60), 1)
+
+    def test_local_eviction(self):
+        backend = LocalBackend()
+        backend.maximum = 2
+        backend.counts['expired'] = (0, 0, 10, 120)
+        backend.hit('a', 600)
+        # Expired clients are forgotten as soon as they are seen at the front
+        self.assertEqual(list(backend.counts), ['a'])
+        backend.hit('b', 600)
+        backend.hit('a', 600)
+        # Too many clients forgets whoever was seen longest ago, not everyone
+        backend.hit('c', 600)
+        self.assertEqual(list(backend.counts), ['a', 'c'])
+        self.assertEqual(backend.counts['a'][2], 2)
+
+    def test_cost(self):
+        limiter = RateLimiter(backend=LocalBackend(), requests=10, minutes=1, cost=4)
+        view = limiter(lambda request: HttpResponse('OK'))
+        request = RequestFactory().get('/', REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(view(request).status_code, 200)
+        self.assertEqual(view(request).status_code, 200)
+        self.assertEqual(view(request).status_code, 403)
+
+    def test_cost_per_second(self):
+        def slow(request):
+            sum(range(100000))
+            return HttpResponse('OK')
+
+        limiter = RateLimiter(backend=LocalBackend(), requests=10, minutes=1, cost_per_second=10 ** 9)
+        view = limiter(slow)
+        request = RequestFactory().get('/', REMOTE_ADDR='192.0.2.1')
+        self.assertEqual(view(request).status_code, 200)
+        self.assertEqual(view(request).status_code, 403)
+
+    def test_cost_per_second_streamed(self):
+        def output():
+            yield 'O'
+            sum(range(100000))
+            yield 'K'
+
+        limiter = RateLimiter(backend=LocalBackend(), requests=10, minutes=1, cost_per_second=10 ** 9)
+        view = limiter(lambda request: StreamingHttpResponse(output()))
+        request = RequestFactory().get('/', REMOTE_ADDR='192.0.2.1')
+        response = view(request)
+        self.assertEqual(view(request).status_code, 200)
+        # The time taken to generate the output is charged once it is sent
+        self.assertEqual(b''.join(response.streaming_content), b'OK')
+        self.assertEqual(view(request).status_code, 403)
@@ -1,12 +1,23 @@
 import json
+import os
+import tempfile
 import unittest
+from io import StringIO
 
 from django.test import TestCase, override_settings
 from django.conf import settings
-from django.contrib.gis.geos import Polygon, Point
-
-from mapit.models import CodeType, NameType, Type, Area, Geometry, Generation, Postcode
+from django.core.management import call_command
+from django.contrib.gis.geos import MultiPolygon, Polygon, Point
+
+from mapit.models import (
+    CodeType, NameType, Type, Area, AreaRelation, AreaRelationBuild, Geometry, GeometrySimplified, Generation,
+    Postcode, PostcodeMembership, PostcodeMembershipBuild)
+from mapit.areacache import area_cache
+from mapit.geometryserialiser import GeometrySerialiser, TransformError
+from mapit.management.command_utils import save_polygons
+from mapit.pointindex import point_index
 from mapit.tests.utils import get_content
+from mapit.views.areas import add_codes
 
 
 class AreaViewsTest(TestCase):
@@ -97,6 +108,19 @@ class AreaViewsTest(TestCase):
             set((x.id for x in (self.big_area, self.small_area_1)))
             )
 
+    @override_settings(MAPIT_SLOW_QUERY_SECONDS=1e-9, MAPIT_SLOW_QUERY_SAMPLE=1)
+    def test_slow_query_plans(self):
+        with self.assertLogs('mapit.slow_queries', 'WARNING') as logs:
+            response = self.client.get('/point/4326/-3.4,51.5.json')
+            content = get_content(response)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(content), 2)
+        spatial = [output for output in logs.output if 'ST_Covers' in output]
+        self.assertTrue(spatial)
+        self.assertIn('areas_by_point query took', spatial[0])
+        self.assertIn('mapit_geometrysubdivided', spatial[0])
+        self.assertIn('actual time=', spatial[0])
+
     def test_subdivided_areas_by_point(self):
         # Choose a point that is directly on the boundary of a subdivision, and ensure that
         # looking up the areas for that point returns the correct area.
@@ -111,6 +135,92 @@ class AreaViewsTest(TestCase):
             self.big_area.id
         )
 
+    @override_settings(MAPIT_POINT_INDEX=True)
+    def test_areas_by_point_index(self):
+        point_index.clear()
+        for url, expected in (
+            ('/point/4326/-3.4,51.5.json', (self.big_area, self.small_area_1)),
+            ('/point/4326/-1.5,53.5.json', (self.big_area, self.small_area_2)),
+            ('/point/4326/-3.4,51.5.json?type=SML', (self.small_area_1,)),
+            ('/point/4326/10,10.json', ()),
+        ):
+            content = get_content(self.client.get(url))
+            self.assertEqual(set(int(x) for x in content.keys()), set(x.id for x in expected))
+
+        # Looking up in another generation falls back to the database
+        url = '/point/4326/-3.4,51.5.json?generation=%d' % self.old_generation.id
+        content = get_content(self.client.get(url))
+        self.assertEqual(set(int(x) for x in content.keys()), set([self.small_area_1.id, self.small_area_3.id]))
+
+    @override_settings(
+        MAPIT_POINT_INDEX=True,
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_areas_by_point_index_changed(self):
+        point_index.clear()
+        url = '/point/4326/-3.4,51.5.json?type=SML'
+        content = get_content(self.client.get(url))
+        self.assertEqual(set(int(x) for x in content.keys()), set([self.small_area_1.id]))
+
+        # Moving a polygon of the current generation is seen straight away
+        polygon = Polygon(((-2, 53), (-2, 54), (-1, 54), (-1, 53), (-2, 53)), srid=4326)
+        polygon.transform(settings.MAPIT_AREA_SRID)
+        self.small_shape_1.polygon = polygon
+        self.small_shape_1.save()
+        content = get_content(self.client.get(url))
+        self.assertEqual(content, {})
+        content = get_content(self.client.get('/point/4326/-1.5,53.5.json?type=SML'))
+        self.assertEqual(set(int(x) for x in content.keys()), set([self.small_area_1.id, self.small_area_2.id]))
+
+    @override_settings(MAPIT_AREA_CACHE_SIZE=10)
+    def test_area_cache(self):
+        area_cache.clear()
+        url = '/point/4326/-3.4,51.5.json'
+        content = get_content(self.client.get(url))
+        self.assertEqual(content[str(self.small_area_1.id)]['name'], 'Small Area 1')
+        self.assertIn(self.small_area_1.id, area_cache.entries)
+
+        # Changes however they are made are seen straight away
+        self.small_area_1.name = 'Renamed'
+        self.small_area_1.save()
+        content = get_content(self.client.get(url))
+        self.assertEqual(content[str(self.small_area_1.id)]['name'], 'Renamed')
+
+        Area.objects.filter(id=self.small_area_1.id).update(name='Renamed again')
+        content = get_content(self.client.get(url))
+        self.assertEqual(content[str(self.small_area_1.id)]['name'], 'Renamed again')
+
+        code_type = CodeType.objects.create(code='test', description='A test code')
+        self.small_area_1.codes.create(type=code_type, code='123')
+        content = get_content(self.client.get(url))
+        self.assertEqual(content[str(self.small_area_1.id)]['codes'], {'test': '123'})
+
+    def test_areas_by_points(self):
+        points = {'a': [-3.4, 51.5], 'b': [-1.5, 53.5], 'c': [10, 10]}
+        response = self.client.post('/points', json.dumps(points), content_type='application/json')
+        content = get_content(response)
+        self.assertEqual(list(content.keys()), ['a', 'b', 'c'])
+        self.assertEqual(set(int(x) for x in content['a']), set((self.big_area.id, self.small_area_1.id)))
+        self.assertEqual(set(int(x) for x in content['b']), set((self.big_area.id, self.small_area_2.id)))
+        self.assertEqual(content['c'], {})
+        self.assertEqual(content['a'][str(self.small_area_1.id)]['name'], 'Small Area 1')
+
+        body = 'a,-3.4,51.5\r\nb,-1.5,53.5\r\n'
+        response = self.client.post('/points/4326?type=SML', body, content_type='text/csv')
+        content = get_content(response)
+        self.assertEqual(list(content['a'].keys()), [str(self.small_area_1.id)])
+        self.assertEqual(list(content['b'].keys()), [str(self.small_area_2.id)])
+
+    def test_areas_by_points_bad_input(self):
+        response = self.client.post('/points', 'a,-3.4', content_type='text/csv')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/points', '[1, 2]', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/points')
+        self.assertEqual(response.status_code, 405)
+        with self.settings(MAPIT_BATCH_MAXIMUM=1):
+            response = self.client.post('/points', 'a,1,2\nb,1,2', content_type='text/csv')
+            self.assertEqual(response.status_code, 400)
+
     @override_settings(MAPIT_WITHIN_MAXIMUM=1000)
     def test_areas_by_point_within(self):
         url = '/point/4326/-4.001,51.json?within=Bad'
@@ -158,6 +268,40 @@ class AreaViewsTest(TestCase):
         content = get_content(response)
         self.assertIn(str(self.small_area_3.id), content['areas'])
 
+    def test_postcodes_endpoint(self):
+        body = json.dumps(['PO141NT', 'SW1A1AA', 'NOTAPOSTCODE'])
+        response = self.client.post('/postcodes', body, content_type='application/json')
+        content = get_content(response)
+        self.assertEqual(list(content.keys()), ['PO141NT', 'SW1A1AA', 'NOTAPOSTCODE'])
+        single = get_content(self.client.get('/postcode/PO141NT'))
+        self.assertEqual(content['PO141NT'], single)
+        self.assertEqual(content['SW1A1AA']['code'], 404)
+        self.assertEqual(content['NOTAPOSTCODE']['code'], 400)
+
+        response = self.client.post('/postcodes?min_generation=1', 'PO141NT\n', content_type='text/plain')
+        content = get_content(response)
+        self.assertIn(str(self.small_area_3.id), content['PO141NT']['areas'])
+
+    def test_postcode_membership(self):
+        before = get_content(self.client.get('/postcode/PO141NT'))
+        call_command('mapit_postcode_membership_build', stdout=StringIO())
+        self.assertTrue(PostcodeMembership.objects.filter(
+            generation=self.generation, postcode=self.postcode).exists())
+        after = get_content(self.client.get('/postcode/PO141NT'))
+        self.assertEqual(before, after)
+
+        # Changing a polygon means the stored areas are no longer used
+        self.small_area_1.polygons.all()[0].save()
+        self.assertFalse(PostcodeMembershipBuild.objects.exists())
+
+        # As does an area joining the generation in a bulk update, but not
+        # other bulk updates
+        call_command('mapit_postcode_membership_build', stdout=StringIO())
+        Area.objects.filter(id=self.small_area_3.id).update(name='Renamed')
+        self.assertTrue(PostcodeMembershipBuild.objects.exists())
+        Area.objects.filter(id=self.small_area_3.id).update(generation_high=self.generation)
+        self.assertFalse(PostcodeMembershipBuild.objects.exists())
+
     def test_json_links(self):
         id = self.big_area.id
         url = '/area/%d/covers.html?type=SML' % id
@@ -199,8 +343,9 @@ class AreaViewsTest(TestCase):
         url = '/areas/%d,%d.geojson' % (id1, id2)
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
-        content = json.loads(response.content.decode('utf-8'))
+        content = get_content(response)
         self.assertEqual(len(content), 2)
+        self.assertEqual(len(content['features']), 2)
 
     def test_areas_children(self):
         id = self.small_area_1.id
@@ -223,6 +368,28 @@ class AreaViewsTest(TestCase):
         content = get_content(self.client.get(url))
         self.assertEqual(len(content), 2)
 
+    def test_areas_by_type_paginated(self):
+        first, second = sorted((self.small_area_1.id, self.small_area_2.id))
+        response = self.client.get('/areas/SML?limit=1')
+        self.assertEqual(list(get_content(response)), [str(first)])
+        self.assertEqual(response['Link'], '</areas/SML?limit=1&after=%d>; rel="next"' % first)
+
+        response = self.client.get('/areas/SML?limit=1&after=%d' % first)
+        self.assertEqual(list(get_content(response)), [str(second)])
+        self.assertNotIn('Link', response)
+
+        response = self.client.get('/areas/SML?limit=0')
+        self.assertEqual(response.status_code, 400)
+
+    def test_add_codes_chunked(self):
+        code_type = CodeType.objects.create(code='gss', description='GSS')
+        for area in (self.small_area_1, self.small_area_2, self.small_area_3):
+            area.codes.create(type=code_type, code='S%d' % area.id)
+        areas = Area.objects.filter(type=self.small_type)
+        self.assertEqual(
+            [(area.name, area.all_codes) for area in add_codes(areas, chunk_size=2)],
+            [(area.name, {'gss': 'S%d' % area.id}) for area in areas])
+
     def test_areas_polygon_one_id(self):
         id = self.small_area_1.id
 
@@ -239,11 +406,204 @@ class AreaViewsTest(TestCase):
         url_areas = '/areas/%d.geojson' % id
         response_areas = self.client.get(url_areas)
         self.assertEqual(response_areas.status_code, 200)
-        content_areas = json.loads(response_areas.content.decode('utf-8'))
+        content_areas = get_content(response_areas)
 
         self.assertEqual(content_area, content_areas['features'][0]['geometry'])
         self.assertEqual(content_areas['type'], 'FeatureCollection')
 
+    def test_areas_polygon_kml_stream(self):
+        response = self.client.get('/areas/SML.kml')
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(content.count('<Placemark>'), 2)
+        self.assertIn('<name>Small Area 2</name>', content)
+        self.assertTrue(content.rstrip().endswith('</kml>'))
+
+    def test_areas_polygon_omits_failures(self):
+        tiny_area = Area.objects.create(
+            name="Small Area 9", type=self.small_type,
+            generation_low=self.generation, generation_high=self.generation)
+        polygon = Polygon(((-1, 51), (-1, 51.0001), (-0.9999, 51.0001), (-0.9999, 51), (-1, 51)), srid=4326)
+        polygon.transform(settings.MAPIT_AREA_SRID)
+        Geometry.objects.create(area=tiny_area, polygon=polygon)
+
+        # Simplifying leaves nothing of the last area, so it is left out
+        for serialiser in ('python', 'database'):
+            with override_settings(MAPIT_GEOMETRY_SERIALISER=serialiser), \
+                    self.assertLogs('mapit.geometryserialiser', 'WARNING') as logs:
+                response = self.client.get('/areas/SML.geojson?simplify_tolerance=0.01')
+                content = get_content(response)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [feature['properties']['name'] for feature in content['features']],
+                ['Small Area 1', 'Small Area 2'])
+            self.assertIn('Left Small Area 9 (%d) out' % tiny_area.id, logs.output[0])
+
+    def test_areas_polygon_batch_failure(self):
+        # Fetching a batch failing (e.g. because of one bad geometry in the
+        # database serialiser's query) only loses the area that fails
+        bad_id = self.small_area_2.id
+
+        class Serialiser(GeometrySerialiser):
+            def _fetch_polygons(self, area_ids, format):
+                if bad_id in area_ids:
+                    raise TransformError('Bad geometry')
+                return super()._fetch_polygons(area_ids, format)
+
+        areas = [self.small_area_1, self.small_area_2, self.big_area]
+        with self.assertLogs('mapit.geometryserialiser', 'WARNING') as logs:
+            output, content_type = Serialiser(areas, 4326, 0).geojson_stream()
+            content = json.loads(''.join(output))
+        self.assertEqual(
+            [feature['properties']['name'] for feature in content['features']], ['Small Area 1', 'Big Area'])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('Left Small Area 2 (%d) out' % bad_id, logs.output[0])
+
+    def test_database_geometry_serialiser(self):
+        def rounded(geometry):
+            return json.loads(json.dumps(geometry), parse_float=lambda x: round(float(x), 6))
+
+        for url in (
+            '/area/%d.geojson' % self.small_area_1.id,
+            '/area/%d.geojson' % self.small_area_2.id,
+            '/area/%d.geojson?simplify_tolerance=0.0001' % self.small_area_1.id,
+        ):
+            python = get_content(self.client.get(url))
+            with override_settings(MAPIT_GEOMETRY_SERIALISER='database'):
+                database = get_content(self.client.get(url))
+            self.assertEqual(rounded(database), rounded(python))
+
+        with override_settings(MAPIT_GEOMETRY_SERIALISER='database'):
+            response = self.client.get('/areas/SML.kml')
+            content = b''.join(response.streaming_content).decode('utf-8')
+            self.assertEqual(content.count('<Placemark>'), 2)
+
+            response = self.client.get('/area/%d.geojson?simplify_tolerance=10' % self.small_area_1.id)
+            self.assertEqual(response.status_code, 400)
+
+    def test_geometry_simplified(self):
+        areas = Area.objects.filter(type=self.small_type, generation_high=self.generation)
+        self.assertEqual(GeometrySimplified.objects.build(areas, [0.01]), 2)
+
+        url = '/area/%d.geojson?simplify_tolerance=0.01' % self.small_area_2.id
+        self.assertEqual(get_content(self.client.get(url))['type'], 'MultiPolygon')
+
+        # Requests near a stored level are served from it
+        url = '/area/%d.geojson?simplify_tolerance=%s' % (self.small_area_1.id, '%s')
+        level = GeometrySimplified.objects.get(area=self.small_area_1)
+        level.polygon = MultiPolygon(Polygon(((0, 0), (0, 1), (1, 1), (1, 0), (0, 0))), srid=4326)
+        level.save()
+        content = get_content(self.client.get(url % 0.015))
+        self.assertEqual(content['type'], 'Polygon')
+        self.assertEqual(content['coordinates'][0][0], [0, 0])
+        content = get_content(self.client.get(url % 0.1))
+        self.assertNotEqual(content['coordinates'][0][0], [0, 0])
+
+        # Changing the polygons removes the levels
+        self.small_shape_1.save()
+        self.assertFalse(GeometrySimplified.objects.filter(area=self.small_area_1).exists())
+
+    def test_areas_tile(self):
+        # Zoom 6 tile 31/21 covers roughly -5.6 to 0 lon, 49.0 to 52.5 lat
+        response = self.client.get('/tiles/SML/6/31/21.mvt')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertIn(b'Small Area 1', response.content)
+        self.assertNotIn(b'Big Area', response.content)
+
+        response = self.client.get('/tiles/SML/0/0/0.mvt?generation=%d' % self.old_generation.id)
+        self.assertIn(b'Small Area 3', response.content)
+
+        # From TILE_SUBDIVIDED_ZOOM, tiles are made from subdivided polygons
+        response = self.client.get('/tiles/SML/12/2008/1362.mvt')
+        self.assertIn(b'Small Area 1', response.content)
+        self.assertNotIn(b'Small Area 2', response.content)
+
+        response = self.client.get('/tiles/SML/6/31/99.mvt')
+        self.assertEqual(response.status_code, 400)
+
+    def test_area_extent(self):
+        content = get_content(self.client.get('/area/%d?extent=1' % self.small_area_1.id))
+        extent = content['extent']
+        self.assertEqual(extent['points'], 5)
+        self.assertEqual(round(extent['centre_lon'], 6), -3.5)
+        self.assertEqual(round(extent['centre_lat'], 6), 51.5)
+        self.assertNotIn('extent', get_content(self.client.get('/area/%d' % self.small_area_1.id)))
+
+        content = get_content(self.client.get('/areas/SML?extent=1'))
+        self.assertEqual(content[str(self.small_area_2.id)]['extent']['points'], 10)
+
+        self.small_area_2.polygons.all().delete()
+        Area.objects.update_extent([self.small_area_2.id])
+        self.small_area_2.refresh_from_db()
+        self.assertIsNone(self.small_area_2.bbox)
+        self.assertIsNone(self.small_area_2.extent_dict())
+
+    def test_save_polygons(self):
+        polygon = Polygon(((-3, 51), (-3, 52), (-2.5, 52), (-2.5, 51), (-3, 51)), srid=4326)
+        polygon.transform(settings.MAPIT_AREA_SRID)
+        save_polygons({'SML2': (self.small_area_2, [polygon.ogr])}, write_to_stdout=False)
+        self.assertEqual(self.small_area_2.polygons.count(), 1)
+        self.assertTrue(self.small_area_2.polygons.get().subdivided.exists())
+        self.assertEqual(self.small_area_2.point_count, 5)
+        content = get_content(self.client.get('/point/4326/-2.7,51.5.json'))
+        self.assertIn(str(self.small_area_2.id), content)
+        content = get_content(self.client.get('/point/4326/-2.2,51.5.json'))
+        self.assertNotIn(str(self.small_area_2.id), content)
+
+    def test_area_intersect(self):
+        big, small_1, small_2 = self.big_area.id, self.small_area_1.id, self.small_area_2.id
+        content = get_content(self.client.get('/area/%d/covers.json' % big))
+        self.assertEqual(set(int(id) for id in content), {small_1, small_2})
+        content = get_content(self.client.get('/area/%d/touches.json' % small_1))
+        self.assertEqual(set(int(id) for id in content), {small_2})
+        content = get_content(self.client.get('/area/%d/coverlaps.json?type=BIG' % small_2))
+        self.assertEqual(set(int(id) for id in content), {big})
+        content = get_content(self.client.get('/area/%d/intersects.json?type=SML' % big))
+        self.assertEqual(set(int(id) for id in content), {small_1, small_2})
+
+    def test_area_relations(self):
+        urls = ['/area/%d/%s.json' % (area.id, relation)
+                for area in (self.big_area, self.small_area_1, self.small_area_2)
+                for relation in ('touches', 'overlaps', 'covers', 'covered', 'coverlaps', 'intersects')]
+        before = [get_content(self.client.get(url)) for url in urls]
+        call_command('mapit_area_relation_build', stdout=StringIO())
+        self.assertTrue(AreaRelation.objects.filter(
+            generation=self.generation, area=self.small_area_1, other=self.big_area, relation='covers').exists())
+        self.assertTrue(AreaRelationBuild.objects.fresh(self.generation))
+        self.assertEqual([get_content(self.client.get(url)) for url in urls], before)
+
+        # Changing a polygon means the stored relations are not used until refreshed
+        self.small_area_1.polygons.all()[0].save()
+        self.assertFalse(AreaRelationBuild.objects.fresh(self.generation))
+        call_command('mapit_area_relation_build', refresh=True, stdout=StringIO())
+        self.assertTrue(AreaRelationBuild.objects.fresh(self.generation))
+        self.assertEqual([get_content(self.client.get(url)) for url in urls], before)
+
+        # As does an area leaving the generation in a bulk update
+        Area.objects.filter(id=self.small_area_1.id).update(generation_high=self.old_generation)
+        self.assertFalse(AreaRelationBuild.objects.fresh(self.generation))
+        call_command('mapit_area_relation_build', refresh=True, stdout=StringIO())
+        self.assertFalse(AreaRelation.objects.filter(generation=self.generation, area=self.small_area_1).exists())
+
+    def test_geometry_cache(self):
+        id = self.small_area_1.id
+        url = '/area/%d.geojson' % id
+        uncached = get_content(self.client.get(url))
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(MAPIT_GEOMETRY_CACHE_DIR=directory):
+            content = get_content(self.client.get(url))
+            self.assertEqual(content, uncached)
+            self.assertEqual(len(os.listdir(os.path.join(directory, str(id)))), 1)
+
+            # The multiple area output uses the same stored geometry
+            content = get_content(self.client.get('/areas/%d.geojson' % id))
+            self.assertEqual(content['features'][0]['geometry'], uncached)
+            self.assertEqual(len(os.listdir(os.path.join(directory, str(id)))), 1)
+
+            self.small_shape_1.save()
+            self.assertFalse(os.path.exists(os.path.join(directory, str(id))))
+
     def test_areas_polygon_geometry(self):
         id = self.small_area_1.id
 
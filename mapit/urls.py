@@ -21,6 +21,7 @@ urlpatterns = [
 
     re_path(r'^postcode/$', postcodes.form_submitted),
     re_path(r'^postcode/(?P<postcode>[A-Za-z0-9 +]+)%s$' % format_end, postcodes.postcode, name="mapit-postcode"),
+    re_path(r'^postcodes$', postcodes.postcodes, name='mapit-postcodes'),
     re_path(r'^postcode/partial/(?P<postcode>[A-Za-z0-9 ]+)%s$' % format_end,
             postcodes.partial_postcode, name="mapit-postcode-partial"),
 
@@ -46,6 +47,7 @@ urlpatterns = [
             areas.areas_by_point_latlon, name='areas-by-point-latlon'),
     re_path(r'^point/osgb/(?P<e>%s),(?P<n>%s)(?:/(?P<bb>box))?%s$' % (number, number, map_format_end),
             areas.areas_by_point_osgb, name='areas-by-point-osgb'),
+    re_path(r'^points(?:/(?P<srid>[0-9]+))?$', areas.areas_by_points, name='areas-by-points'),
 
     re_path(r'^nearest/(?P<srid>[0-9]+)/(?P<x>%s),(?P<y>%s)%s$' % (number, number, format_end), postcodes.nearest),
 
@@ -55,11 +57,17 @@ urlpatterns = [
     re_path(r'^areas/(?P<area_ids>[0-9]+(?:,[0-9]+)*)/geometry$', areas.areas_geometry),
     re_path(r'^areas/(?P<type>[A-Z0-9,]*[A-Z0-9]+)%s$' % map_format_end, areas.areas_by_type),
     re_path(r'^areas/(?P<type>[A-Z0-9,]*[A-Z0-9]+)%s$' % data_format_end, areas.areas_by_type),
+    re_path(r'^tiles/(?P<type>[A-Z0-9,]*[A-Z0-9]+)/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)\.mvt$',
+            areas.areas_tile, name='areas-tile'),
     re_path(r'^areas/(?P<name>.+?)%s$' % map_format_end, areas.areas_by_name),
     re_path(r'^areas$', areas.deal_with_POST, {'call': 'areas'}),
     re_path(r'^code/(?P<code_type>[^/]+)/(?P<code_value>[^/]+?)%s$' % format_end, areas.area_from_code),
 ]
 
+if getattr(settings, 'MAPIT_METRICS', False):
+    from mapit.views import metrics
+    urlpatterns.append(re_path(r'^metrics$', metrics.metrics, name='mapit-metrics'))
+
 # Include app-specific urls
 if settings.MAPIT_COUNTRY == 'IT':
     urlpatterns.append(
@@ -1,3 +1,8 @@
+import csv
+import hashlib
+import io
+import itertools
+import json
 import re
 from psycopg2 import InternalError
 from django.db.utils import DatabaseError
@@ -5,58 +10,134 @@ from django.db.utils import DatabaseError
 from django.utils.translation import gettext as _
 from django.contrib.gis.geos import Point
 from django.contrib.gis.db.models import Collect
-from django.db.models import Q, prefetch_related_objects
+from django.db.models import Q
 from django.db.models.query import QuerySet
 from django.http import HttpResponse, HttpResponseRedirect
 from django.urls import resolve, reverse, NoReverseMatch
 from django.conf import settings
+from django.core.cache import cache
 from django.shortcuts import redirect, render
 from django.views.decorators.csrf import csrf_exempt
 
-from mapit.models import Area, Generation, Code, CodeType, Name, NameType, Type
+from mapit.areacache import area_cache
+from mapit.models import Area, Generation, Code, CodeType, Name, NameType, Type, extent_covers
 from mapit.shortcuts import output_json, output_html, output_polygon, get_object_or_404, set_timeout
 from mapit.middleware import ViewException
 from mapit.ratelimitcache import ratelimit
+from mapit.slowqueries import sample_slow_queries
+from mapit.pointindex import point_index
 from mapit.utils import re_number
 from mapit import countries
 from mapit.iterables import iterdict
-from mapit.geometryserialiser import GeometrySerialiser, TransformError
+from mapit.geometryserialiser import get_serialiser, TransformError
 
 
-def add_codes(areas):
+def add_codes(areas, chunk_size=1000):
     """Given an iterable of areas, return an iterator of those areas with codes
     and m2m countries attached. We don't use prefetch_related because this can
-    use a lot of memory."""
-    codes = Code.objects.select_related('type').filter(area__in=areas)
-    countries = Area.countries.through.objects.select_related('country').filter(area__in=areas)
-
-    lookup = {}
-    lookup_countries = {}
-    for code in codes.iterator():
-        lookup.setdefault(code.area_id, {})[code.type.code] = code.code
-    for m2m in countries.iterator():
-        c = m2m.country
-        lookup_countries.setdefault(m2m.area_id, []).append({'code': c.code, 'name': c.name})
-
+    use a lot of memory; instead, the areas are read in chunks (a queryset
+    through a server-side cursor), and the codes and countries fetched for
+    each chunk in turn, so memory use stays flat however many areas there are
+    and the first areas can be output before the rest are read."""
     if isinstance(areas, QuerySet):
         if hasattr(countries, 'sorted_areas'):
             areas = countries.sorted_areas(areas)
+        areas = areas.iterator(chunk_size=chunk_size)
+    areas = iter(areas)
+
+    while True:
+        chunk = list(itertools.islice(areas, chunk_size))
+        if not chunk:
+            break
+        ids = [area.id for area in chunk]
+        codes = Code.objects.select_related('type').filter(area__in=ids)
+        m2ms = Area.countries.through.objects.select_related('country').filter(area__in=ids)
+
+        lookup = {}
+        lookup_countries = {}
+        for code in codes:
+            lookup.setdefault(code.area_id, {})[code.type.code] = code.code
+        for m2m in m2ms:
+            c = m2m.country
+            lookup_countries.setdefault(m2m.area_id, []).append({'code': c.code, 'name': c.name})
+
+        for area in chunk:
+            area.all_codes = lookup.get(area.id, {})
+            area.all_m2m_countries = lookup_countries.get(area.id, [])
+            yield area
+
+
+def area_dicts(areas, chunk_size=1000, extent=False):
+    """Given an iterable of areas, return an iterator of (area, dict) pairs,
+    the dict being what as_dict would return after add_codes. If the area
+    cache is turned on, dicts are taken from it where possible, and only the
+    missing areas have their codes fetched. The areas themselves are returned
+    without codes attached."""
+    if not area_cache.size:
+        for area in add_codes(areas, chunk_size):
+            yield area, area.as_dict(extent=extent)
+        return
+
+    version = area_cache.check()
+    if isinstance(areas, QuerySet):
         areas = areas.iterator()
-
-    for area in areas:
-        area.all_codes = lookup.get(area.id, {})
-        area.all_m2m_countries = lookup_countries.get(area.id, [])
-        yield area
+    areas = iter(areas)
+    while True:
+        chunk = list(itertools.islice(areas, chunk_size))
+        if not chunk:
+            break
+        dicts = area_cache.get_many(area.id for area in chunk)
+        missing = [area for area in chunk if area.id not in dicts]
+        if missing:
+            new = dict((area.id, area.as_dict()) for area in add_codes(missing))
+            area_cache.set_many(new, version)
+            dicts.update(new)
+        for area in chunk:
+            if extent:
+                yield area, dict(dicts[area.id], extent=area.extent_dict())
+            else:
+                yield area, dicts[area.id]
 
 
 def output_areas(request, title, format, areas, **kwargs):
-    areas = add_codes(areas)
     if format == 'map.html':
         format = 'html'
         kwargs['show_map'] = True
     if format == 'html':
-        return output_html(request, title, areas, **kwargs)
-    return output_json(iterdict((area.id, area.as_dict()) for area in areas))
+        return output_html(request, title, add_codes(areas), **kwargs)
+    extent = bool(request.GET.get('extent'))
+    return output_json(iterdict((area.id, area_dict) for area, area_dict in area_dicts(areas, extent=extent)))
+
+
+def paginate_areas(request, format, areas):
+    """If a limit is asked for, return a page of that many of the areas, in
+    ID order, starting after the ID given as the after cursor, along with the
+    URL of the next page, or None if there isn't one. Otherwise, return the
+    areas as they are. As each page has its own URL, each is cached on its
+    own."""
+    if 'limit' not in request.GET:
+        return areas, None
+    try:
+        limit = int(request.GET['limit'])
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        raise ViewException(format, _('Bad limit or cursor specified'), 400)
+    if limit < 1:
+        raise ViewException(format, _('Bad limit or cursor specified'), 400)
+
+    page = list(areas.filter(id__gt=after).order_by('id')[:limit + 1])
+    if len(page) <= limit:
+        return page, None
+    page = page[:limit]
+    query = request.GET.copy()
+    query['after'] = page[-1].id
+    return page, '%s?%s' % (request.path, query.urlencode())
+
+
+def add_next_link(response, next_url):
+    if next_url:
+        response['Link'] = '<%s>; rel="next"' % next_url
+    return response
 
 
 def query_args(request, format, type=None):
@@ -161,10 +242,10 @@ def area(request, area_id, format=''):
             'alternative_names': alternative_names,
             'geotype': geotype,
         })
-    return output_json(area.as_dict(names))
+    return output_json(area.as_dict(names, extent=bool(request.GET.get('extent'))))
 
 
-@ratelimit
+@ratelimit(rate_class='geometry', cost=5)
 def area_polygon(request, srid='', area_id='', format='kml'):
     if not srid and hasattr(countries, 'area_code_lookup'):
         resp = countries.area_code_lookup(request, area_id, format)
@@ -191,11 +272,13 @@ def area_children(request, area_id, format=''):
     q = query_args(request, format)
     area = get_object_or_404(Area, format=format, id=area_id)
     children = area.children.filter(q).distinct()
+    children, next_url = paginate_areas(request, format, children)
     if format in ('kml', 'geojson'):
-        return _areas_polygon(request, format, children)
-    return output_areas(request, _('Children of %s') % area.name, format, children)
+        return add_next_link(_areas_polygon(request, format, children), next_url)
+    return add_next_link(output_areas(request, _('Children of %s') % area.name, format, children), next_url)
 
 
+@sample_slow_queries
 def area_intersect(query_type, title, request, area_id, format):
     area = get_object_or_404(Area, format=format, id=area_id)
     if not area.polygons.count():
@@ -206,9 +289,7 @@ def area_intersect(query_type, title, request, area_id, format):
 
     set_timeout(format)
     try:
-        # Cast to list so that it's evaluated here, and output_areas doesn't get
-        # confused with a RawQuerySet
-        areas = list(Area.objects.intersect(query_type, area, types, generation))
+        ids = Area.objects.intersect_ids(query_type, area, types, generation)
     except DatabaseError as e:
         if 'canceling statement due to statement timeout' not in e.args[0] \
            and 'canceling statement due to user request' not in e.args[0]:
@@ -219,39 +300,38 @@ def area_intersect(query_type, title, request, area_id, format):
     except InternalError:
         raise ViewException(format, _('There was an internal error performing that query.'), 500)
 
-    # Each object will need type which hasn't been fetched by the RawQuerySet
-    prefetch_related_objects(areas, 'type')
+    areas = Area.objects.filter(id__in=ids).select_related('type').order_by('id')
 
     title = title % ('<a href="%sarea/%d.html">%s</a>' % (reverse('mapit_index'), area.id, area.name))
     return output_areas(request, title, format, areas, norobots=True)
 
 
-@ratelimit
+@ratelimit(cost=10)
 def area_touches(request, area_id, format=''):
     return area_intersect('touches', _('Areas touching %s'), request, area_id, format)
 
 
-@ratelimit
+@ratelimit(cost=10)
 def area_overlaps(request, area_id, format=''):
     return area_intersect('overlaps', _('Areas overlapping %s'), request, area_id, format)
 
 
-@ratelimit
+@ratelimit(cost=10)
 def area_covers(request, area_id, format=''):
     return area_intersect('coveredby', _('Areas covered by %s'), request, area_id, format)
 
 
-@ratelimit
+@ratelimit(cost=10)
 def area_coverlaps(request, area_id, format=''):
     return area_intersect(['overlaps', 'coveredby'], _('Areas covered by or overlapping %s'), request, area_id, format)
 
 
-@ratelimit
+@ratelimit(cost=10)
 def area_covered(request, area_id, format=''):
     return area_intersect('covers', _('Areas that cover %s'), request, area_id, format)
 
 
-@ratelimit
+@ratelimit(cost=10)
 def area_intersects(request, area_id, format=''):
     return area_intersect('intersects', _('Areas that intersect %s'), request, area_id, format)
 
@@ -267,9 +347,42 @@ def areas(request, area_ids, format=''):
 def areas_by_type(request, type, format=''):
     q = query_args(request, format, type)
     areas = Area.objects.filter(q).distinct()
+    areas, next_url = paginate_areas(request, format, areas)
     if format in ('kml', 'geojson'):
-        return _areas_polygon(request, format, areas)
-    return output_areas(request, _('Areas in %s') % type, format, areas)
+        return add_next_link(_areas_polygon(request, format, areas), next_url)
+    return add_next_link(output_areas(request, _('Areas in %s') % type, format, areas), next_url)
+
+
+@ratelimit(rate_class='geometry')
+def areas_tile(request, type, z, x, y):
+    z, x, y = int(z), int(x), int(y)
+    if z > 22 or x >= 2 ** z or y >= 2 ** z:
+        raise ViewException('json', _('Bad tile specified'), 400)
+
+    q = query_args(request, 'json', type)
+    # Tiles are cached by the generation asked for, and the area cache
+    # version, as they will not change until one of those does; ranges of
+    # generations are keyed by their parameters
+    key = 'mapit-tile:%s:%s:%s:%d/%d/%d:%s' % (
+        Generation.objects.requested(request), area_cache.check(), type, z, x, y, request.GET.urlencode())
+    key = 'mapit-tile-%s' % hashlib.md5(key.encode('utf-8')).hexdigest()
+    tile = cache.get(key)
+    if tile is None:
+        set_timeout('json')
+        try:
+            tile = Area.objects.tile(q, z, x, y)
+        except DatabaseError as e:
+            if 'canceling statement due to statement timeout' not in e.args[0]:
+                raise
+            raise ViewException('json', _('That query was taking too long to compute.'), 500)
+        # Some tiles are too large to store in memcached
+        if len(tile) < 1000000:
+            cache.set(key, tile, getattr(settings, 'CACHE_MIDDLEWARE_SECONDS', 86400))
+
+    response = HttpResponse(tile, content_type='application/vnd.mapbox-vector-tile')
+    response['Cache-Control'] = 'max-age=2419200'  # 4 weeks
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
 
 
 @ratelimit
@@ -277,10 +390,11 @@ def areas_by_name(request, name, format=''):
     q = query_args(request, format)
     q &= Q(name__istartswith=name)
     areas = Area.objects.filter(q).distinct()
-    return output_areas(request, _('Areas starting with %s') % name, format, areas)
+    areas, next_url = paginate_areas(request, format, areas)
+    return add_next_link(output_areas(request, _('Areas starting with %s') % name, format, areas), next_url)
 
 
-@ratelimit
+@ratelimit(rate_class='geometry', cost=5)
 def areas_polygon(request, area_ids, srid='', format='kml'):
     area_ids = area_ids.split(',')
     check_area_ids(format, area_ids)
@@ -294,21 +408,21 @@ def areas_polygon(request, area_ids, srid='', format='kml'):
 
 def _areas_polygon(request, format, areas, srid=None):
     args = query_args_polygon(request, format, srid)
-    areas = add_codes(areas)
-    serialiser = GeometrySerialiser(list(areas), args['srid'], args['simplify_tolerance'])
+    # The areas are read, and have their codes added, as they are output
+    serialiser = get_serialiser(add_codes(areas), args['srid'], args['simplify_tolerance'])
 
     try:
         if format == 'kml':
-            output, content_type = serialiser.kml('full')
+            output, content_type = serialiser.kml_stream('full')
         elif format == 'geojson':
-            output, content_type = serialiser.geojson()
+            output, content_type = serialiser.geojson_stream()
     except TransformError as e:
         return output_json({'error': e.args[0]}, code=400)
 
     return output_polygon(content_type, output)
 
 
-@ratelimit
+@ratelimit(rate_class='geometry')
 def area_geometry(request, area_id):
     area = _area_geometry(area_id)
     if isinstance(area, HttpResponse):
@@ -345,7 +459,7 @@ def _area_geometry(area_id):
     return out
 
 
-@ratelimit
+@ratelimit(rate_class='geometry')
 def areas_geometry(request, area_ids):
     area_ids = area_ids.split(',')
     out = {}
@@ -389,13 +503,14 @@ def area_from_code(request, code_type, code_value, format='', area_type=None):
 
 
 @ratelimit
+@sample_slow_queries
 def areas_by_point(request, srid, x, y, bb=False, format=''):
     location = Point(float(x), float(y), srid=int(srid))
 
     use_exceptions()
 
     try:
-        location.transform(settings.MAPIT_AREA_SRID, clone=True)
+        area_location = location.transform(settings.MAPIT_AREA_SRID, clone=True)
     except:
         raise ViewException(format, _('Point outside the area geometry'), 400)
 
@@ -411,12 +526,15 @@ def areas_by_point(request, srid, x, y, bb=False, format=''):
     except ValueError:
         raise ViewException(format, _('Bad "within" parameter specified'), 400)
 
-    if method == 'box':
-        q &= Q(polygons__subdivided__division__bbcovers=location)
+    generation = point_index.generation_for(request) if not within else None
+    if generation:
+        q &= Q(id__in=point_index.lookup(area_location, generation, box=method == 'box'))
+    elif method == 'box':
+        q &= Q(polygons__subdivided__division__bbcovers=location) & extent_covers(location)
     elif within:
         q &= Q(polygons__subdivided__division__dwithin=(location, within))
     else:
-        q &= Q(polygons__subdivided__division__covers=location)
+        q &= Q(polygons__subdivided__division__covers=location) & extent_covers(location)
     areas = Area.objects.filter(q).distinct()
 
     return output_areas(
@@ -424,6 +542,55 @@ def areas_by_point(request, srid, x, y, bb=False, format=''):
         format, areas, indent_areas=True)
 
 
+def parse_points(request):
+    """Read (id, x, y) tuples from the body of a batch point request. This is
+    either a JSON object mapping each ID to an [x, y] pair, or CSV rows of
+    id,x,y with no header row."""
+    points = []
+    try:
+        body = request.body.decode('utf-8')
+        if request.content_type == 'application/json':
+            for id, (x, y) in json.loads(body).items():
+                points.append((str(id), float(x), float(y)))
+        else:
+            for row in csv.reader(io.StringIO(body)):
+                if not row:
+                    continue
+                id, x, y = row
+                points.append((id.strip(), float(x), float(y)))
+    except (ValueError, TypeError, AttributeError):
+        raise ViewException('json', _('Badly specified points'), 400)
+    return points
+
+
+@csrf_exempt
+@ratelimit(rate_class='batch')
+def areas_by_points(request, srid='4326'):
+    if request.method != 'POST':
+        raise ViewException('json', _('Points must be sent in the body of a POST request'), 405)
+
+    points = parse_points(request)
+    maximum = getattr(settings, 'MAPIT_BATCH_MAXIMUM', 10000)
+    if len(points) > maximum:
+        raise ViewException('json', _('Too many points specified (maximum %d)') % maximum, 400)
+
+    q = query_args(request, 'json')
+    try:
+        lookup = Area.objects.by_points(points, int(srid), q)
+    except DatabaseError as e:
+        if 'Cannot find SRID' not in e.args[0] and 'transform' not in e.args[0]:
+            raise
+        raise ViewException('json', _('Point outside the area geometry'), 400)
+
+    areas = Area.objects.filter(id__in=set().union(*lookup.values()))
+    areas = dict((area.id, area_dict) for area, area_dict in area_dicts(areas))
+    ids = dict.fromkeys(id for id, x, y in points)
+    return output_json(iterdict(
+        (id, dict((area_id, areas[area_id]) for area_id in sorted(lookup.get(id, ()))))
+        for id in ids
+    ))
+
+
 def _areas_by_point(x, y, srid, **kwargs):
     kwargs.update({'srid': srid, 'x': kwargs.pop(x), 'y': kwargs.pop(y)})
     kwargs = {k: v for k, v in kwargs.items() if v}
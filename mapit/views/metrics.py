@@ -0,0 +1,24 @@
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.cache import never_cache
+
+from mapit.middleware.metrics import metrics as recorded
+
+
+def allowed(request):
+    """Whether the request comes from one of METRICS_IPS, or carries the
+    METRICS_TOKEN as a bearer token."""
+    if request.META.get('REMOTE_ADDR', '') in getattr(settings, 'MAPIT_METRICS_IPS', ['127.0.0.1', '::1']):
+        return True
+    token = getattr(settings, 'MAPIT_METRICS_TOKEN', '')
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and hmac.compare_digest(authorization.encode(), ('Bearer %s' % token).encode())
+
+
+@never_cache
+def metrics(request):
+    if not allowed(request):
+        return HttpResponseForbidden('Forbidden')
+    return HttpResponse(recorded.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,8 +1,10 @@
 from operator import attrgetter
+import json
 import re
 import itertools
 from django.db.utils import DatabaseError
 
+from django.conf import settings
 from django.utils.translation import gettext as _
 from django.shortcuts import redirect, render
 from django.contrib.gis.geos import Point
@@ -19,7 +21,9 @@ from mapit.utils import is_valid_postcode, is_valid_partial_postcode
 from mapit.shortcuts import output_json, get_object_or_404, set_timeout
 from mapit.middleware import ViewException
 from mapit.ratelimitcache import ratelimit
-from mapit.views.areas import add_codes
+from mapit.slowqueries import sample_slow_queries
+from mapit.views.areas import add_codes, area_dicts
+from mapit.iterables import iterdict
 from mapit import countries
 
 # Stupid fixed IDs from old MaPit
@@ -55,6 +59,32 @@ class GeometryCentroidDistance(Func):
             expression, PostGISAdapter(geom), output_field=FloatField(), **extra)
 
 
+def postcode_shortcuts(areas):
+    shortcuts = {}
+    for area in areas:
+        if area.type.code in ('COP', 'LBW', 'LGE', 'MTW', 'UTE', 'UTW'):
+            shortcuts['ward'] = area.id
+            shortcuts['council'] = area.parent_area_id
+        elif area.type.code == 'CED':
+            shortcuts.setdefault('ward', {})['county'] = area.id
+            shortcuts.setdefault('council', {})['county'] = area.parent_area_id
+        elif area.type.code == 'DIW':
+            shortcuts.setdefault('ward', {})['district'] = area.id
+            shortcuts.setdefault('council', {})['district'] = area.parent_area_id
+        elif area.type.code in ('WMC',):
+            # XXX Also maybe 'EUR', 'NIE', 'SPC', 'SPE', 'WAC', 'WAE', 'OLF', 'OLG', 'OMF', 'OMG'):
+            shortcuts[area.type.code] = area.id
+    return shortcuts
+
+
+def enclosing_area_ids(areas):
+    extra = []
+    for area in areas:
+        if area.type.code in enclosing_areas.keys():
+            extra.extend(enclosing_areas[area.type.code])
+    return extra
+
+
 @ratelimit
 def postcode(request, postcode, format=None):
     if hasattr(countries, 'canonical_postcode'):
@@ -71,47 +101,103 @@ def postcode(request, postcode, format=None):
     query = Generation.objects.query_args(request, format)
 
     if not hasattr(countries, 'is_special_postcode') or not countries.is_special_postcode(postcode.postcode):
-        areas = list(add_codes(Area.objects.by_postcode(postcode, query)))
+        areas = Area.objects.by_postcode(postcode, query, Generation.objects.requested(request))
     else:
         areas = []
 
-    # Shortcuts
-    shortcuts = {}
-    for area in areas:
-        if area.type.code in ('COP', 'LBW', 'LGE', 'MTW', 'UTE', 'UTW'):
-            shortcuts['ward'] = area.id
-            shortcuts['council'] = area.parent_area_id
-        elif area.type.code == 'CED':
-            shortcuts.setdefault('ward', {})['county'] = area.id
-            shortcuts.setdefault('council', {})['county'] = area.parent_area_id
-        elif area.type.code == 'DIW':
-            shortcuts.setdefault('ward', {})['district'] = area.id
-            shortcuts.setdefault('council', {})['district'] = area.parent_area_id
-        elif area.type.code in ('WMC',):
-            # XXX Also maybe 'EUR', 'NIE', 'SPC', 'SPE', 'WAC', 'WAE', 'OLF', 'OLG', 'OMF', 'OMG'):
-            shortcuts[area.type.code] = area.id
+    shortcuts = postcode_shortcuts(areas)
 
     # Add manual enclosing areas.
-    extra = []
-    for area in areas:
-        if area.type.code in enclosing_areas.keys():
-            extra.extend(enclosing_areas[area.type.code])
-    areas = itertools.chain(areas, Area.objects.filter(id__in=extra))
+    extra = enclosing_area_ids(areas)
+    areas = list(itertools.chain(areas, Area.objects.filter(id__in=extra)))
 
     if format == 'html':
         return render(request, 'mapit/postcode.html', {
             'postcode': postcode.as_dict(),
-            'areas': areas,
+            'areas': add_codes(areas),
             'json_view': 'mapit-postcode',
         })
 
     out = postcode.as_dict()
-    out['areas'] = dict((area.id, area.as_dict()) for area in areas)
+    out['areas'] = dict((area.id, area_dict) for area, area_dict in area_dicts(areas))
     if shortcuts:
         out['shortcuts'] = shortcuts
     return output_json(out)
 
 
+def parse_postcodes(request):
+    """Read the postcodes from the body of a bulk postcode request, either a
+    JSON array of strings, or one postcode per line."""
+    try:
+        body = request.body.decode('utf-8')
+        if request.content_type == 'application/json':
+            postcodes = json.loads(body)
+            if not isinstance(postcodes, list) or not all(isinstance(pc, str) for pc in postcodes):
+                raise ValueError
+        else:
+            postcodes = [pc.strip() for pc in body.splitlines() if pc.strip()]
+    except ValueError:
+        raise ViewException('json', _('Badly specified postcodes'), 400)
+    return postcodes
+
+
+@csrf_exempt
+@ratelimit(rate_class='batch')
+def postcodes(request):
+    if request.method != 'POST':
+        raise ViewException('json', _('Postcodes must be sent in the body of a POST request'), 405)
+
+    requested = parse_postcodes(request)
+    maximum = getattr(settings, 'MAPIT_BATCH_MAXIMUM', 10000)
+    if len(requested) > maximum:
+        raise ViewException('json', _('Too many postcodes specified (maximum %d)') % maximum, 400)
+
+    canonical = {}
+    for pc in requested:
+        if hasattr(countries, 'canonical_postcode'):
+            canonical[pc] = countries.canonical_postcode(pc)
+        else:
+            canonical[pc] = pc
+    found = Postcode.objects.filter(postcode__in=[pc for pc in canonical.values() if is_valid_postcode(pc)])
+    found = dict((postcode.postcode, postcode) for postcode in found)
+    if hasattr(countries, 'prepare_postcodes'):
+        countries.prepare_postcodes(found.values())
+
+    query = Generation.objects.query_args(request, 'json')
+    lookup = Area.objects.by_postcodes([
+        postcode for postcode in found.values()
+        if not hasattr(countries, 'is_special_postcode') or not countries.is_special_postcode(postcode.postcode)
+    ], query, Generation.objects.requested(request))
+
+    # Fetch every area needed, including any manual enclosing ones, at once
+    area_ids = set().union(*lookup.values())
+    area_ids.update(itertools.chain(*enclosing_areas.values()))
+    areas = {}
+    dicts = {}
+    for area, area_dict in area_dicts(Area.objects.filter(id__in=area_ids)):
+        areas[area.id] = area
+        dicts[area.id] = area_dict
+
+    def output(pc):
+        if not is_valid_postcode(canonical[pc]):
+            return {'code': 400, 'error': _("Postcode '%s' is not valid.") % canonical[pc]}
+        postcode = found.get(canonical[pc])
+        if not postcode:
+            return {'code': 404, 'error': _('No Postcode matches the given query.')}
+        postcode_areas = sorted(
+            (areas[area_id] for area_id in lookup.get(postcode.id, ())),
+            key=lambda area: (area.name, area.type.code))
+        out = postcode.as_dict()
+        shortcuts = postcode_shortcuts(postcode_areas)
+        extra = [areas[area_id] for area_id in enclosing_area_ids(postcode_areas) if area_id in areas]
+        out['areas'] = dict((area.id, dicts[area.id]) for area in itertools.chain(postcode_areas, extra))
+        if shortcuts:
+            out['shortcuts'] = shortcuts
+        return out
+
+    return output_json(iterdict((pc, output(pc)) for pc in dict.fromkeys(requested)))
+
+
 @ratelimit
 def partial_postcode(request, postcode, format=''):
     postcode = re.sub(r'\s+', '', postcode.upper())
@@ -137,7 +223,8 @@ def partial_postcode(request, postcode, format=''):
     return output_json(postcode.as_dict())
 
 
-@ratelimit
+@ratelimit(cost=5)
+@sample_slow_queries
 def example_postcode_for_area(request, area_id, format=''):
     area = get_object_or_404(Area, format=format, id=area_id)
     try:
@@ -170,7 +257,8 @@ def form_submitted(request):
     return redirect('mapit-postcode', postcode=pc, format='html')
 
 
-@ratelimit
+@ratelimit(cost=5)
+@sample_slow_queries
 def nearest(request, srid, x, y, format=''):
     location = Point(float(x), float(y), srid=int(srid))
     set_timeout(format)
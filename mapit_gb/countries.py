@@ -61,6 +61,13 @@ def get_postcode_display(pc):
     return re.sub('([0-9]..)$', r' \1', pc).strip()
 
 
+def prepare_postcodes(postcodes):
+    """Work out the grid co-ordinates of any of the postcodes about to be
+    output that do not have them stored, all at once."""
+    from mapit.models import Postcode
+    Postcode.objects.fill_uk_grid(postcodes)
+
+
 def augment_postcode(postcode, result):
     pc = postcode.postcode
     if is_special_postcode(pc):
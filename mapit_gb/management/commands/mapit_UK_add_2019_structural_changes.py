@@ -8,7 +8,7 @@ from django.core.management.base import BaseCommand
 from django.contrib.gis.geos import GEOSGeometry
 from django.contrib.gis.db.models import Union
 from django.db.models import Q
-from mapit.models import Area, Generation, Type, Country, NameType, CodeType
+from mapit.models import Area, Generation, Geometry, Type, Country, NameType, CodeType
 
 
 def legis_row(id):
@@ -113,7 +113,7 @@ class Command(BaseCommand):
             m.names.update_or_create(type=self.name_type, defaults={'name': name})
             if gss:
                 m.codes.update_or_create(type=self.code_type, defaults={'code': gss})
-            m.polygons.create(polygon=geom)
+            Geometry.objects.replace([(m, [geom.wkb])])
         else:
             print('Would create', name, typ)
 
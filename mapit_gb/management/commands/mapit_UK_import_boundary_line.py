@@ -3,6 +3,7 @@
 # Great Britain. Northern Ireland is handled separately, during the
 # postcode import phase.
 
+import itertools
 import re
 import sys
 
@@ -11,8 +12,8 @@ from django.core.management.base import LabelCommand
 # from django.contrib.gis.utils import LayerMapping
 from django.contrib.gis.gdal import DataSource
 
-from mapit.models import Area, Generation, Country, Type, CodeType, NameType, Code
-from mapit.management.command_utils import save_polygons, fix_invalid_geos_geometry
+from mapit.models import Area, Generation, Country, Type, CodeType, NameType, Code, GeometrySimplified
+from mapit.management.command_utils import save_polygons, fix_invalid_geos_geometry, simplify_levels
 
 
 class Command(LabelCommand):
@@ -25,6 +26,9 @@ class Command(LabelCommand):
             '--control', action='store', dest='control',
             help='Refer to a Python module that can tell us what has changed')
         parser.add_argument('--commit', action='store_true', dest='commit', help='Actually update the database')
+        parser.add_argument(
+            '--simplify-levels', action='store', type=simplify_levels, dest='simplify_levels',
+            help='Comma-separated tolerances (in degrees) at which to store simplified polygons')
 
     ons_code_to_shape = {}
     unit_id_to_shape = {}
@@ -175,6 +179,11 @@ class Command(LabelCommand):
         if options['commit']:
             save_polygons(self.unit_id_to_shape)
             save_polygons(self.ons_code_to_shape)
+            if options['simplify_levels']:
+                # Build all areas at once, so areas of a type share boundaries
+                area_ids = [m.id for m, _ in itertools.chain(
+                    self.unit_id_to_shape.values(), self.ons_code_to_shape.values())]
+                GeometrySimplified.objects.build(Area.objects.filter(id__in=area_ids), options['simplify_levels'])
 
     def patch_boundary_line(self, name, ons_code, unit_id, area_code):
         """Used to fix mistakes in Boundary-Line. This patch function should
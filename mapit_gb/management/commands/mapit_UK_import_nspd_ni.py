@@ -15,7 +15,7 @@
 
 import csv
 import os.path
-from mapit.models import Area
+from mapit.models import Area, Postcode
 from mapit.management.commands.mapit_import_postal_codes import Command
 
 
@@ -54,6 +54,8 @@ class Command(Command):
                 code_to_area['NIE' + parl_code] = nia_area
                 code_to_area['NIE' + gss_code] = nia_area
         self.code_to_area = code_to_area
+        # The areas of each postcode, for post_rows with --bulk
+        self.postcode_areas = {}
 
         # Start the main import process
         self.process(file, options)
@@ -90,9 +92,18 @@ class Command(Command):
             self.code_to_area[parl_code],  # Parliament
             self.euro_area,
         ]
+        if options.get('bulk'):
+            self.postcode_areas[self.code] = self.areas
 
         return True
 
     def post_row(self, pc):
         pc.areas.clear()
         pc.areas.add(*self.areas)
+
+    def post_rows(self, postcodes):
+        through = Postcode.areas.through
+        through.objects.filter(postcode__in=postcodes).delete()
+        through.objects.bulk_create([
+            through(postcode=pc, area=area) for pc in postcodes for area in self.postcode_areas[pc.postcode]
+        ], ignore_conflicts=True)
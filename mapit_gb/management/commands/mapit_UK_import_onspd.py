@@ -1,10 +1,21 @@
 # This script is used to import postcodes from the ONS Postcode Directory:
 # https://www.ons.gov.uk/methodology/geography/geographicalproducts/postcodeproducts
+#
+# A hash of each postcode's co-ordinates is stored, so that rows unchanged
+# since the last import are skipped, and each import is recorded, with every
+# postcode it changed, in PostcodeImport. With --terminate-missing, postcodes
+# that are terminated in or missing from the ONSPD (within the parts of it
+# being imported) are marked as terminated, rather than left as they were.
+#
+# Each postcode's easting and northing are stored as given, so they need
+# not be transformed back from its location when output.
 
 import csv
+import os.path
 from django.db import connection, transaction
 from django.core.management.base import LabelCommand
 from mapit.iterables import iterable_to_stream
+from mapit.models import PostcodeImport, PostcodeMembershipBuild
 
 
 FIELD_CODE = 0
@@ -70,6 +81,15 @@ class Command(LabelCommand):
                   ' run mapit_UK_import_onspd_ni_areas before trying to import '
                   'any NI postcodes.')
         )
+        parser.add_argument(
+            '--terminate-missing',
+            action='store_true',
+            dest='terminate-missing',
+            default=False,
+            help=('Set to mark postcodes that are terminated in or missing from '
+                  'the ONSPD as terminated. Only postcodes of the kinds being '
+                  'imported (GB, NI, Crown Dependencies) are considered.')
+        )
 
     def handle_label(self, file, **options):
         self.check_options_are_valid(options)
@@ -77,21 +97,35 @@ class Command(LabelCommand):
         reader = csv.reader(open(file))
         next(reader)
 
-        reader = filter(lambda row: self.pre_row(row, options), reader)
-        reader = map(strip_spaces, reader)
-        reader = map(lambda row: f'{row[FIELD_CODE]},{row[FIELD_COORD_LON]},{row[FIELD_COORD_LAT]}\n'.encode(), reader)
+        # Every row is copied in, noting whether to import it and whether
+        # the postcode is live, so that missing postcodes can be found
+        reader = map(lambda row: (self.pre_row(row, options), not row[FIELD_END_DATE], strip_spaces(row)), reader)
+        reader = map(lambda r: (
+            f'{r[2][FIELD_CODE]},{r[2][FIELD_COORD_LON]},{r[2][FIELD_COORD_LAT]},{r[0]},{r[1]}\n'.encode()), reader)
         reader = iterable_to_stream(reader)
 
         with transaction.atomic():
             cursor = connection.cursor()
             self.stdout.write("Creating temporary table")
             cursor.execute('CREATE TEMPORARY TABLE mapit_postcode_new '
-                           '(postcode varchar(7), location geometry(Point, 4326), easting int, northing int) '
+                           '(postcode varchar(7), location geometry(Point, 4326), easting int, northing int, '
+                           'import boolean, live boolean, source_hash varchar(32)) '
                            'ON COMMIT DROP')
             self.stdout.write("Copying in data:")
-            cursor.copy_expert('COPY mapit_postcode_new(postcode, easting, northing) '
+            cursor.copy_expert('COPY mapit_postcode_new(postcode, easting, northing, import, live) '
                                'FROM STDIN WITH (FORMAT csv)', reader)
             self.stdout.write(f"{cursor.rowcount} rows")
+            cursor.execute('CREATE TEMPORARY TABLE mapit_postcode_seen ON COMMIT DROP AS '
+                           'SELECT postcode FROM mapit_postcode_new WHERE live')
+            cursor.execute('DELETE FROM mapit_postcode_new WHERE NOT import')
+            self.stdout.write("Skipping unchanged rows:")
+            cursor.execute("UPDATE mapit_postcode_new "
+                           "SET source_hash = md5(coalesce(easting::text, '') || ',' || coalesce(northing::text, ''))")
+            cursor.execute('DELETE FROM mapit_postcode_new n USING mapit_postcode p '
+                           'WHERE n.postcode = p.postcode AND n.source_hash = p.source_hash '
+                           'AND (p.easting IS NOT NULL OR n.easting IS NULL)')
+            unchanged = cursor.rowcount
+            self.stdout.write(f"{unchanged} rows unchanged")
             self.stdout.write("Setting geometry column")
             cursor.execute("UPDATE mapit_postcode_new "
                            "SET location = ST_Transform(ST_SetSRID(ST_Point(easting, northing), 27700), 4326) "
@@ -99,16 +133,47 @@ class Command(LabelCommand):
             cursor.execute("UPDATE mapit_postcode_new "
                            "SET location = ST_Transform(ST_SetSRID(ST_Point(easting, northing), 29902), 4326) "
                            "WHERE postcode LIKE 'BT%'")
+            cursor.execute('CREATE TEMPORARY TABLE mapit_postcode_changed ON COMMIT DROP AS '
+                           "SELECT n.postcode, CASE WHEN p.id IS NULL THEN 'created' ELSE 'updated' END AS change "
+                           'FROM mapit_postcode_new n LEFT JOIN mapit_postcode p ON n.postcode = p.postcode '
+                           'WHERE p.id IS NULL OR n.location IS DISTINCT FROM p.location')
             self.stdout.write("Updating existing rows:")
             cursor.execute('UPDATE mapit_postcode SET location = n.location FROM mapit_postcode_new n '
                            'WHERE (n.location IS DISTINCT FROM mapit_postcode.location) '
                            'AND n.postcode = mapit_postcode.postcode')
             self.stdout.write(f"{cursor.rowcount} rows updated")
+            cursor.execute('UPDATE mapit_postcode SET source_hash = n.source_hash, '
+                           'easting = n.easting, northing = n.northing FROM mapit_postcode_new n '
+                           'WHERE n.postcode = mapit_postcode.postcode')
             self.stdout.write("Adding new data:")
-            cursor.execute('INSERT INTO mapit_postcode (postcode, location) '
-                           'SELECT n.postcode, n.location FROM mapit_postcode_new n '
+            cursor.execute('INSERT INTO mapit_postcode (postcode, location, source_hash, easting, northing) '
+                           'SELECT n.postcode, n.location, n.source_hash, n.easting, n.northing '
+                           'FROM mapit_postcode_new n '
                            'LEFT JOIN mapit_postcode p ON n.postcode = p.postcode WHERE p.postcode IS NULL')
             self.stdout.write(f"{cursor.rowcount} rows created")
+            cursor.execute("SELECT count(*) FROM mapit_postcode_new WHERE postcode NOT IN "
+                           "(SELECT postcode FROM mapit_postcode_changed)")
+            unchanged += cursor.fetchone()[0]
+            postcode_import = PostcodeImport.objects.record(
+                'onspd %s' % os.path.basename(file), 'mapit_postcode_seen', unchanged=unchanged,
+                terminate=options['terminate-missing'], scope=self.termination_scope(options))
+            self.stdout.write(f"{postcode_import.terminated} postcodes terminated, "
+                              f"{postcode_import.restored} restored")
+            PostcodeMembershipBuild.objects.invalidate()
+
+    def termination_scope(self, options):
+        """An SQL condition on mapit_postcode matching the postcodes this
+        import covers, given the options."""
+        conditions = []
+        crown_dependency = "substring(mapit_postcode.postcode, 1, 2) IN ('GY', 'JE', 'IM')"
+        northern_ireland = "mapit_postcode.postcode LIKE 'BT%%'"
+        for option, condition in (
+                ('crown-dependencies', crown_dependency), ('northern-ireland', northern_ireland)):
+            if options[option] == 'exclude':
+                conditions.append('NOT ' + condition)
+            elif options[option] == 'only':
+                conditions.append(condition)
+        return ' AND '.join(conditions) or None
 
     def pre_row(self, row, options):
         if self.reject_row_based_on_termination_data(row, options):
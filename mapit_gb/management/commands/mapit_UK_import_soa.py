@@ -6,7 +6,7 @@
 
 from django.core.management.base import LabelCommand
 from django.contrib.gis.gdal import DataSource
-from mapit.models import Area, Generation, Country, Type, NameType, CodeType
+from mapit.models import Area, Generation, Geometry, Country, Type, NameType, CodeType
 
 
 class Command(LabelCommand):
@@ -65,5 +65,4 @@ class Command(LabelCommand):
                 shapes = [p]
             else:
                 shapes = p
-            for g in shapes:
-                m.polygons.create(polygon=g.wkt)
+            Geometry.objects.replace([(m, [g.wkb for g in shapes])])
@@ -24,13 +24,11 @@ class Command(BaseCommand):
             geometry = Geometry.objects.filter(**args)
             p = geometry.aggregate(Union('polygon'))['polygon__union']
             if options['commit']:
-                area.polygons.all().delete()
                 if p.geom_type == 'Polygon':
                     shapes = [p]
                 else:
                     shapes = p
-                for g in shapes:
-                    area.polygons.create(polygon=g)
+                Geometry.objects.replace([(area, [g.wkb for g in shapes])])
             done.append(area.id)
             print('done')
 
@@ -0,0 +1,24 @@
+# This script stores the easting and northing of postcodes imported before
+# they were stored, or by a command that does not store them, so they need
+# not be worked out each time a postcode is output.
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mapit.models import Postcode
+
+
+class Command(BaseCommand):
+    help = 'Store the grid co-ordinates of postcodes that do not have them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true', help='Recalculate the grid co-ordinates of every postcode')
+
+    @transaction.atomic
+    def handle(self, **options):
+        postcodes = Postcode.objects.all()
+        if not options['all']:
+            postcodes = postcodes.filter(easting__isnull=True)
+        count = postcodes.update_uk_grid()
+        self.stdout.write('%d postcodes updated' % count)
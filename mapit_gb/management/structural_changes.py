@@ -4,7 +4,7 @@ from __future__ import print_function
 from django.core.management.base import BaseCommand
 from django.contrib.gis.geos import Polygon
 from django.contrib.gis.db.models import Union
-from mapit.models import Area, Generation, Type, Country, NameType, CodeType
+from mapit.models import Area, Generation, Geometry, Type, Country, NameType, CodeType
 
 
 class Command(BaseCommand):
@@ -71,7 +71,7 @@ class Command(BaseCommand):
             m.names.update_or_create(type=self.name_type, defaults={'name': name})
             if gss:
                 m.codes.update_or_create(type=self.code_type, defaults={'code': gss})
-            m.polygons.create(polygon=geom)
+            Geometry.objects.replace([(m, [geom.wkb])])
         else:
             print('Would create', name, typ)
 
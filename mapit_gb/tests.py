@@ -93,6 +93,13 @@ class GBViewsTest(TestCase):
         grid = postcode.as_uk_grid()
         self.assertEqual(grid, [327011, 369351])
 
+    def test_stored_uk_grid(self):
+        call_command('mapit_UK_store_postcode_grid', stdout=StringIO())
+        postcode = models.Postcode.objects.get(postcode='SW1A1AA')
+        self.assertEqual((postcode.easting, postcode.northing), (529090, 179645))
+        with self.assertNumQueries(0):
+            self.assertEqual(postcode.as_uk_grid(), [529090, 179645])
+
     def test_postcode_json(self):
         pc = self.postcode.postcode
         url = '/postcode/%s' % urllib.parse.quote(pc)
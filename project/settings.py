@@ -29,14 +29,65 @@ MAPIT_WITHIN_MAXIMUM = float(config.get('WITHIN_MAXIMUM', 0))
 if MAPIT_WITHIN_MAXIMUM.is_integer():
     MAPIT_WITHIN_MAXIMUM = int(MAPIT_WITHIN_MAXIMUM)
 
+# Set this to True to answer point lookups from an in-process spatial index of
+# the current generation's polygons, rather than a query to PostGIS. Each
+# worker loads the index on first use. Optional, defaults to False.
+MAPIT_POINT_INDEX = bool(config.get('POINT_INDEX', False))
+
+# The maximum number of points or postcodes that can be looked up in one batch
+# request. Optional, defaults to 10000.
+MAPIT_BATCH_MAXIMUM = int(config.get('BATCH_MAXIMUM', 10000))
+
+# Set this to True to store the areas containing every postcode when a new
+# generation is activated (see mapit_postcode_membership_build), so postcode
+# lookups need no spatial query. Optional, defaults to False.
+MAPIT_POSTCODE_MEMBERSHIP = bool(config.get('POSTCODE_MEMBERSHIP', False))
+
+# Set this to True to store which areas touch, overlap or cover each other when
+# a new generation is activated (see mapit_area_relation_build), so those
+# lookups need no spatial join. Optional, defaults to False.
+MAPIT_AREA_RELATIONS = bool(config.get('AREA_RELATIONS', False))
+
+# The number of areas' output each worker keeps in memory, so that codes and
+# countries need not be looked up again. Needs a cache shared between workers
+# (e.g. memcached) to know when to forget them. Optional, defaults to 0 (off).
+MAPIT_AREA_CACHE_SIZE = int(config.get('AREA_CACHE_SIZE', 0))
+
+# A directory in which to store the serialised polygons of areas, so they need
+# not be generated again. Optional, defaults to not storing them.
+MAPIT_GEOMETRY_CACHE_DIR = config.get('GEOMETRY_CACHE_DIR', None)
+
+# Where to transform, simplify and serialise polygons for output, 'python'
+# (using GEOS) or 'database' (using PostGIS). Optional, defaults to 'python'.
+MAPIT_GEOMETRY_SERIALISER = config.get('GEOMETRY_SERIALISER', 'python')
+
 # Country is currently one of GB, NO, IT, KE, SA, or ZA.
 # Optional; country specific things won't happen if not set.
 MAPIT_COUNTRY = config.get('COUNTRY', '')
 
 # A dictionary of IP addresses, User Agents, or functions that should be
-# excluded from rate limiting. Optional.
+# excluded from rate limiting, the limits for each class of endpoint, and where
+# requests are counted. Optional.
 MAPIT_RATE_LIMIT = config.get('RATE_LIMIT', {})
 
+# Set this to True to record the time, database queries and output size of
+# every request, per view, in each worker, and output them in Prometheus's
+# format at /metrics. Optional, defaults to False.
+MAPIT_METRICS = bool(config.get('METRICS', False))
+# /metrics is only served to these IP addresses (by default, only locally),
+# or to requests with an "Authorization: Bearer <METRICS_TOKEN>" header, if a
+# token is set.
+MAPIT_METRICS_IPS = config.get('METRICS_IPS', ['127.0.0.1', '::1'])
+MAPIT_METRICS_TOKEN = config.get('METRICS_TOKEN', '')
+
+# Queries in the spatial lookups (intersections, point, nearest and example
+# postcode lookups) taking at least this many seconds have their plans logged,
+# for SLOW_QUERY_SAMPLE (default 0.1) of them, to SLOW_QUERY_LOG if given, or
+# the mapit.slow_queries logger. Those sampled are run again with EXPLAIN
+# ANALYZE, doubling their time and database load. Optional, defaults to 0 (off).
+MAPIT_SLOW_QUERY_SECONDS = float(config.get('SLOW_QUERY_SECONDS', 0))
+MAPIT_SLOW_QUERY_SAMPLE = float(config.get('SLOW_QUERY_SAMPLE', 0.1))
+
 # A GA code for analytics
 GOOGLE_ANALYTICS = config.get('GOOGLE_ANALYTICS', '')
 
@@ -181,6 +232,8 @@ MIDDLEWARE = [
     'mapit.middleware.JSONPMiddleware',
     'mapit.middleware.ViewExceptionMiddleware',
 ]
+if MAPIT_METRICS:
+    MIDDLEWARE.insert(0, 'mapit.middleware.metrics.MetricsMiddleware')
 
 ROOT_URLCONF = 'project.urls'
 
@@ -233,6 +286,21 @@ LOGGING = {
     },
 }
 
+if config.get('SLOW_QUERY_LOG'):
+    LOGGING['handlers']['slow_queries'] = {
+        'class': 'logging.handlers.RotatingFileHandler',
+        'filename': config['SLOW_QUERY_LOG'],
+        'maxBytes': 10 * 1024 * 1024,
+        'backupCount': 5,
+    }
+    LOGGING['loggers'] = {
+        'mapit.slow_queries': {
+            'handlers': ['slow_queries'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    }
+
 if MAPIT_COUNTRY:
     c = 'mapit_%s' % MAPIT_COUNTRY.lower()
     c_spec = find_module(c)
@@ -55,7 +55,7 @@ setup(
         'libsass >= 0.13.3',
         'psycopg2',
         'PyYAML',
-        'Shapely',
+        'Shapely >= 2.0',
         'uk-postcode-utils',
     ],
     classifiers=[